@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+"""Select the SHM/FPS implementation used by all the tools.
+
+By default this is pyMilk. Setting the environment variable
+`CENT_BACKEND=local` swaps in the mmap-based stand-in from
+`centroidertools.localshm` (and makes `cent start` launch the Python
+centroider from `centroidertools.pycentroider` instead of the milk one), so
+the pipeline can be run without milk, e.g.:
+
+    CENT_BACKEND=local cent start
+"""
+
+import os
+
+BACKEND = os.environ.get("CENT_BACKEND", "milk")
+
+if BACKEND == "local":
+    from centroidertools.localshm import SHM, FPS, SHM_DIR  # noqa: F401
+    LOCAL = True
+elif BACKEND == "milk":
+    from pyMilk.interfacing.shm import SHM  # noqa: F401
+    from pyMilk.interfacing.fps import FPS  # noqa: F401
+    SHM_DIR = os.environ.get("MILK_SHM_DIR", "/milk/shm")
+    LOCAL = False
+else:
+    raise ValueError(
+        f"unknown CENT_BACKEND={BACKEND}, must be one of: milk, local"
+    )
@@ -0,0 +1,456 @@
+#!/usr/bin/env python3
+"""Benchmark suite for the hot paths of centroidertools, on synthetic data
+and the local SHM stand-in (so it runs without cameras or milk), used by
+`cent bench suite`. Each benchmark is run over a range of problem sizes, and
+the results are saved as json, which `cent bench compare` compares between
+two runs, flagging regressions.
+
+The example RTC (simulator/example_rtc.py) is included if it can be found
+next to this package and torch is installed, and skipped otherwise.
+"""
+
+import contextlib
+import datetime
+import importlib.util
+import io
+import itertools
+import json
+import os
+import platform
+import time
+import tracemalloc
+import numpy as np
+import scipy.linalg as la
+from centroidertools import build_subap_lut as bld
+from centroidertools import fit_subap_lut as fit
+from centroidertools import reconstructor
+from centroidertools.localshm import SHM
+
+EXAMPLE_RTC_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "simulator",
+    "example_rtc.py"
+)
+
+# problem sizes, as (subapertures across, image size)
+GEOMETRIES = [(16, 128), (32, 256), (64, 512)]
+NWFS = [1, 2, 4]
+
+# synthetic atmosphere for the reconstructor comparison, as (fraction of
+# the turbulence, footprint shift between on-axis and a WFS, in
+# subapertures) of each layer
+LAYERS = [(0.7, 0.0), (0.3, 4.0)]
+
+
+def timeit(func, *, setup=None, min_repeat=3, max_repeat=1000,
+           min_time=0.5):
+    """time `func()` (after `setup()`, untimed, if given), repeating until
+    both `min_repeat` calls and `min_time` seconds have been done.
+    Returns a dict of statistics (in seconds)."""
+    dts = []
+    t_start = time.perf_counter()
+    while len(dts) < max_repeat and (
+        len(dts) < min_repeat or time.perf_counter() - t_start < min_time
+    ):
+        if setup is not None:
+            setup()
+        t0 = time.perf_counter()
+        func()
+        dts.append(time.perf_counter() - t0)
+    dts = np.array(dts)
+    return {
+        "n": int(dts.size),
+        "mean": float(dts.mean()),
+        "median": float(np.median(dts)),
+        "min": float(dts.min()),
+        "std": float(dts.std()),
+    }
+
+
+def _lut_kwargs(nsub, img):
+    # pitch chosen to fill ~85% of the image, like ULTIMATE-START
+    pitch = 0.85*img/nsub
+    return dict(n_subx=nsub, n_suby=nsub, pitch_x=pitch, pitch_y=pitch,
+                theta=0.0, img_w=img, img_h=img)
+
+
+def synthetic_image(nsub, img, *, shift=(1, -2), noise=0.01, seed=0):
+    """image of a grid of spots, shifted by whole pixels, with noise"""
+    im = 1 - fit.build_mask(**_lut_kwargs(nsub, img), sigma=1.5)
+    im = np.roll(im, shift[::-1], axis=(0, 1))
+    rng = np.random.default_rng(seed)
+    return (im + noise*rng.standard_normal(im.shape)).astype(np.float32)
+
+
+def bench_build_lut(nsub, img):
+    kwargs = _lut_kwargs(nsub, img)
+    return timeit(lambda: bld.build_lut(
+        **kwargs, deltax=0.3, deltay=-0.2, fov_x=6, fov_y=6, unsafe=True
+    ))
+
+
+def bench_fit_config(nsub, img):
+    """the phases of fit.fit_config, and the whole thing"""
+    im = synthetic_image(nsub, img)
+    kwargs = _lut_kwargs(nsub, img)
+    pitch = kwargs["pitch_x"]
+    # the default pitch range is for ULTIMATE-START, so scale it
+    pitches = dict(min_pitch=0.8*pitch, max_pitch=1.2*pitch)
+    im_mask = fit.build_mask(**kwargs)
+    margin = int(img - pitch*nsub)
+    ranges = dict(x_range=margin, y_range=margin)
+
+    def fit_config():
+        with contextlib.redirect_stdout(io.StringIO()):
+            fit.fit_config(im, 0, n_subx=nsub, n_suby=nsub, **pitches)
+
+    return {
+        "estimate_pitch": timeit(
+            lambda: fit.estimate_pitch(im, **pitches)
+        ),
+        "build_mask": timeit(lambda: fit.build_mask(**kwargs)),
+        "search_shift": timeit(
+            lambda: fit.search_shift(im, im_mask, **ranges)
+        ),
+        "total": timeit(fit_config),
+    }
+
+
+def bench_reconstruct(nwfs, nsub=32, nphase=64*64):
+    """reconstructor.reconstruct_phase, through the local SHM"""
+    rng = np.random.default_rng(0)
+    nslopes = 2*nsub*nsub*nwfs
+    rcm = rng.standard_normal((nphase, nslopes)).astype(np.float32)
+    # shaped like slopevec
+    slopes = rng.standard_normal((nslopes, 1)).astype(np.float32)
+    ref = np.zeros_like(slopes)
+    shm_in = SHM("bench_slopevec", slopes)
+    shm_out = SHM("bench_recon_phi", np.zeros((64, 64), dtype=np.float32))
+    # reconstruct_phase waits for a new frame, so publish one before each
+    return timeit(
+        lambda: reconstructor.reconstruct_phase(rcm, shm_in, ref, shm_out),
+        setup=lambda: shm_in.set_data(slopes),
+    )
+
+
+def bench_wgui_encode(nwfs, size):
+    from centroidertools.wgui.app import encode_frame
+    rng = np.random.default_rng(0)
+    im = rng.random((size, size*nwfs)).astype(np.float32)
+    return timeit(lambda: encode_frame(im))
+
+
+def load_example_rtc():
+    """the example_rtc module, or None if it (or torch) isn't available"""
+    if not os.path.exists(EXAMPLE_RTC_FILE):
+        return None
+    try:
+        import torch  # noqa: F401
+    except ModuleNotFoundError:
+        return None
+    spec = importlib.util.spec_from_file_location(
+        "example_rtc", EXAMPLE_RTC_FILE
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def bench_rtc_step(example_rtc, nwfs, nsub=32, nact=64*64):
+    """UltimateRTC.step with synthetic matrices"""
+    import torch
+    nmeas = 2*nsub*nsub*nwfs
+    with contextlib.redirect_stdout(io.StringIO()):
+        rtc = example_rtc.UltimateRTC(
+            rcm=torch.randn(nact, nmeas)/nmeas,
+            dmc=torch.randn(nmeas, nact)/nact,
+        )
+    return timeit(lambda: rtc.step(blocking=False))
+
+
+def _structure_function(r, r0):
+    """Kolmogorov phase structure function (rad^2) at separations r (of
+    shape (..., 2), in subapertures)"""
+    return 6.88*(np.linalg.norm(r, axis=-1)/r0)**(5/3)
+
+
+def synthetic_covariances(nsub, nwfs, *, r0=0.1, layers=LAYERS, stride=2):
+    """Toeplitz cmm and ctm operators (see reconstructor.ToeplitzOperator)
+    for `nwfs` WFSs around the axis, looking through the `layers`, and the
+    on-axis phase sampled `stride` times per subaperture. Slopes are phase
+    differences across a subaperture."""
+    angles = 2*np.pi*np.arange(nwfs)/nwfs + np.pi/4
+    directions = np.stack([np.sin(angles), np.cos(angles)], axis=-1)
+    # (y, x) directions of the x and y slopes
+    axes = [np.array([0.0, 1.0]), np.array([1.0, 0.0])]
+
+    def lags(start, stop):
+        lag = np.arange(start, stop, dtype=float)
+        return np.stack(np.meshgrid(lag, lag, indexing="ij"), axis=-1)
+
+    lag = lags(1-nsub, nsub)
+    cmm = np.zeros((2*nwfs, 2*nwfs, *lag.shape[:2]))
+    for i, j in itertools.product(range(nwfs), repeat=2):
+        for (cu, u), (cv, v) in itertools.product(enumerate(axes), repeat=2):
+            for weight, altitude in layers:
+                w = lag + altitude*(directions[i] - directions[j])
+                cmm[2*i+cu, 2*j+cv] += weight*0.5*(
+                    - _structure_function(w + (u-v)/2, r0)
+                    + _structure_function(w + (u+v)/2, r0)
+                    + _structure_function(w - (u+v)/2, r0)
+                    - _structure_function(w - (u-v)/2, r0)
+                )
+    # phase points, in subapertures from the centre of subaperture 0
+    lag = (lags(-stride*(nsub-1), stride*nsub) - (stride-1)/2)/stride
+    ctm = np.zeros((1, 2*nwfs, *lag.shape[:2]))
+    for j in range(nwfs):
+        for cv, v in enumerate(axes):
+            for weight, altitude in layers:
+                w = lag - altitude*directions[j]
+                ctm[0, 2*j+cv] += weight*0.5*(
+                    _structure_function(w + v/2, r0)
+                    - _structure_function(w - v/2, r0)
+                )
+    return (
+        reconstructor.ToeplitzOperator(cmm, (nsub, nsub), (nsub, nsub)),
+        reconstructor.ToeplitzOperator(
+            ctm, (nsub, nsub), (stride*nsub, stride*nsub), stride=stride
+        ),
+    )
+
+
+def pupil_flux(nsub, *, obscuration=0.3, flux=1000.0, nsamples=8):
+    """flux of each subaperture (shape (nsub*nsub,)) of an annular pupil"""
+    points = (np.arange(nsub*nsamples) + 0.5)/nsamples - nsub/2
+    yy, xx = np.meshgrid(points, points, indexing="ij")
+    rr = np.hypot(yy, xx)
+    lit = (rr <= nsub/2) & (rr >= obscuration*nsub/2)
+    fraction = lit.reshape(nsub, nsamples, nsub, nsamples).mean(axis=(1, 3))
+    return flux*fraction.ravel()
+
+
+def _traced(fn):
+    """call `fn` twice, returns the result and time taken of the first call,
+    and the peak memory (bytes) allocated during the second, as traced by
+    tracemalloc (which includes numpy arrays, but slows down the call)"""
+    t0 = time.perf_counter()
+    result = fn()
+    dt = time.perf_counter() - t0
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, dt, peak
+
+
+def compare_recon(*, nsub=32, nwfs=4, nframes=200, block=10,
+                  correlation=0.99, tol=1e-3, quiet=False):
+    """compare the dense reconstructor (rcm, as `save_control_matrices`)
+    with `IterativeReconstructor` (from zero, with the Jacobi and spectral
+    preconditioners, and then warm started from the previous frame, and on
+    blocks of `block` frames), on synthetic covariances and
+    `nframes` of temporally correlated slopes with those statistics.
+
+    Returns a list of dicts of each method's relative rms error (to the
+    dense phase), mean CG iterations, median time per frame and memory
+    (after setup, and the peak traced by tracemalloc during setup)."""
+    def log(message):
+        if not quiet:
+            print(message)
+
+    rng = np.random.default_rng(0)
+    log("building covariances")
+    cmm, ctm = synthetic_covariances(nsub, nwfs)
+    flux = pupil_flux(nsub)
+    valid = reconstructor.valid_subaps(flux, 0.5)
+    index = reconstructor.slope_index([valid]*nwfs, nsub=nsub*nsub)
+    reg = reconstructor.noise_regularisation(np.tile(flux, 2*nwfs))[index]
+    ref = np.zeros(cmm.shape[1], dtype=np.float32)
+
+    def solve_dense():
+        cmm_dense = cmm.to_dense(index, index)
+        ctm_dense = ctm.to_dense(cols=index)
+        rcm = la.solve(
+            cmm_dense + np.diag(reg), ctm_dense.T, assume_a="pos"
+        ).T.astype(np.float32)
+        return cmm_dense, rcm
+
+    log(f"solving dense reconstructor ({len(index)} slopes)")
+    (cmm_dense, rcm), t_dense, dense_setup = _traced(solve_dense)
+
+    log("simulating slopes")
+    # AR(1) in time, with the statistics of cmm, plus noise
+    chol = la.cholesky(
+        cmm_dense + 1e-6*np.mean(np.diag(cmm_dense))*np.eye(len(index)),
+        lower=True
+    )
+    del cmm_dense
+    turb = rng.standard_normal((nframes, len(index))) @ chol.T
+    del chol
+    for t in range(1, nframes):
+        turb[t] = correlation*turb[t-1] + np.sqrt(1-correlation**2)*turb[t]
+    slopes = np.zeros((nframes, cmm.shape[1]), dtype=np.float32)
+    slopes[:, index] = turb + np.sqrt(reg)*rng.standard_normal(turb.shape)
+
+    log("reconstructing")
+    phi_dense = np.zeros((nframes, ctm.shape[0]), dtype=np.float32)
+    dts = []
+    for t in range(nframes):
+        t0 = time.perf_counter()
+        phi_dense[t] = rcm @ (slopes[t, index] - ref[index])
+        dts.append(time.perf_counter() - t0)
+    results = [{
+        "method": "dense", "error": 0.0, "niter": 0.0,
+        "time_per_frame": float(np.median(dts)), "memory": rcm.nbytes,
+        "setup_memory": dense_setup, "setup_time": t_dense,
+    }]
+
+    for method, preconditioner, frames_per_solve, warm in [
+        ("iterative (jacobi, cold)", "jacobi", 1, False),
+        ("iterative (cold)", "spectral", 1, False),
+        ("iterative (warm)", "spectral", 1, True),
+        (f"iterative (warm, {block} frames)", "spectral", block, True),
+    ]:
+        recon, t_setup, setup_memory = _traced(
+            lambda: reconstructor.IterativeReconstructor(
+                reconstructor.ToeplitzOperator(
+                    cmm.kernels, cmm.in_shape, cmm.out_shape
+                ),
+                reconstructor.ToeplitzOperator(
+                    ctm.kernels, ctm.in_shape, ctm.out_shape,
+                    stride=ctm.stride
+                ),
+                reg, ref, index=index, tol=tol,
+                preconditioner=preconditioner
+            )
+        )
+        phi = np.zeros_like(phi_dense)
+        dts = []
+        niters = []
+        for t in range(0, nframes, frames_per_solve):
+            frames = slice(t, t+frames_per_solve)
+            t0 = time.perf_counter()
+            phi[frames] = recon.reconstruct(slopes[frames], warm=warm)
+            dts.append((time.perf_counter() - t0)/len(phi[frames]))
+            niters.append(recon.niter)
+        results.append({
+            "method": method,
+            "error": float(
+                np.linalg.norm(phi - phi_dense)/np.linalg.norm(phi_dense)
+            ),
+            "niter": float(np.mean(niters)),
+            "time_per_frame": float(np.median(dts)),
+            "memory": recon.nbytes,
+            "setup_memory": setup_memory,
+            "setup_time": t_setup,
+        })
+    return results
+
+
+def print_recon_report(results):
+    print(f"{'method':32s} | {'error':>8s} | {'iters':>5s} | "
+          f"{'ms/frame':>8s} | {'MB':>8s} | {'setup MB':>8s} | "
+          f"{'setup s':>7s}")
+    for result in results:
+        print(f"{result['method']:32s} | {result['error']:8.2e} | "
+              f"{result['niter']:5.1f} | "
+              f"{1e3*result['time_per_frame']:8.3f} | "
+              f"{result['memory']/2**20:8.2f} | "
+              f"{result['setup_memory']/2**20:8.2f} | "
+              f"{result['setup_time']:7.3f}")
+
+
+def run_suite(*, quick=False, quiet=False):
+    """run every benchmark over its problem sizes (only the smallest ones
+    if `quick`), returns the results, to be saved with `save_result`"""
+    geometries = GEOMETRIES[:2] if quick else GEOMETRIES
+    nwfs_list = NWFS[:2] if quick else NWFS
+    results = []
+
+    def record(name, params, stats):
+        results.append(dict(name=name, params=params, **stats))
+        if not quiet:
+            print(f"{name:28s} {_format_params(params):24s} "
+                  f"{1e3*stats['median']:10.3f} ms")
+
+    for nsub, img in geometries:
+        params = {"nsub": nsub, "img": img}
+        record("build_lut", params, bench_build_lut(nsub, img))
+    # fit_config is much slower (the mask build scales with the number of
+    # subapertures times pixels), so only up to ULTIMATE-START's size
+    for nsub, img in GEOMETRIES[:2]:
+        params = {"nsub": nsub, "img": img}
+        for phase, stats in bench_fit_config(nsub, img).items():
+            record(f"fit_config.{phase}", params, stats)
+    for nwfs in nwfs_list:
+        record("reconstruct_phase", {"nwfs": nwfs}, bench_reconstruct(nwfs))
+    for nwfs in nwfs_list:
+        for size in [32, 256]:
+            record("wgui_encode", {"nwfs": nwfs, "size": size},
+                   bench_wgui_encode(nwfs, size))
+    example_rtc = load_example_rtc()
+    if example_rtc is None:
+        if not quiet:
+            print("skipping UltimateRTC.step (example_rtc or torch missing)")
+    else:
+        for nwfs in nwfs_list:
+            record("rtc_step", {"nwfs": nwfs},
+                   bench_rtc_step(example_rtc, nwfs))
+    return {
+        "meta": {
+            "date": datetime.datetime.now().isoformat(),
+            "host": platform.node(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "cpus": os.cpu_count(),
+        },
+        "results": results,
+    }
+
+
+def _format_params(params):
+    return ",".join(f"{key}={value}" for key, value in params.items())
+
+
+def _key(result):
+    return (result["name"], _format_params(result["params"]))
+
+
+def save_result(result, filename):
+    with open(filename, "w") as f:
+        json.dump(result, f, indent=2)
+
+
+def load_result(filename):
+    with open(filename, "r") as f:
+        return json.load(f)
+
+
+def compare(baseline, new, *, threshold=0.1):
+    """compare the median times of two suite results, flagging the
+    benchmarks that are more than `threshold` (fractionally) slower.
+    Returns a list of (name, params, baseline, new, ratio, regressed) for
+    the benchmarks in both."""
+    baseline = {_key(result): result for result in baseline["results"]}
+    rows = []
+    for result in new["results"]:
+        key = _key(result)
+        if key not in baseline:
+            continue
+        t_old = baseline[key]["median"]
+        t_new = result["median"]
+        ratio = t_new/t_old if t_old > 0 else np.inf
+        rows.append((*key, t_old, t_new, ratio, ratio > 1 + threshold))
+    return rows
+
+
+def print_compare(rows):
+    print(f"{'benchmark':28s} {'params':24s} {'baseline':>11s} "
+          f"{'new':>11s} {'ratio':>6s}")
+    for name, params, t_old, t_new, ratio, regressed in rows:
+        print(f"{name:28s} {params:24s} {1e3*t_old:8.3f} ms "
+              f"{1e3*t_new:8.3f} ms {ratio:6.2f}" +
+              (" REGRESSION" if regressed else ""))
+    nregressed = sum(row[-1] for row in rows)
+    print(f"{nregressed} of {len(rows)} benchmarks regressed")
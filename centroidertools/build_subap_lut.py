@@ -17,26 +17,65 @@ def build_lut(*, n_subx: int, n_suby: int, pitch_x: float, pitch_y: float,
         xx_0 : ((n_subx*nsub_y,), int) : subap starting pixel (x)
         yy_0 : ((n_subx*nsub_y,), int) : subap starting pixel (y)
     """
+    xx_c, yy_c, xx_0, yy_0, valid = build_lut_batch(
+        n_subx=n_subx, n_suby=n_suby, pitch_x=pitch_x, pitch_y=pitch_y,
+        theta=theta, deltax=deltax, deltay=deltay,
+        img_w=img_w, img_h=img_h, fov_x=fov_x, fov_y=fov_y
+    )
+    invalid_count = (valid == 0).sum()
+    if invalid_count > 0 and unsafe == 0:
+        raise ValueError(
+            f"{invalid_count:d} subapertures are invalid, " +
+            "increase image ROI"
+        )
+
+    # filter coordinates by valid only
+    xx_c = xx_c[valid]
+    yy_c = yy_c[valid]
+    xx_0 = xx_0[valid]
+    yy_0 = yy_0[valid]
+    return xx_c, yy_c, xx_0, yy_0
+
+
+def build_lut_batch(*, n_subx: int, n_suby: int, pitch_x, pitch_y, theta,
+                    deltax, deltay, img_w: int, img_h: int,
+                    fov_x: int, fov_y: int):
+    """Build the lookup tables for many candidate geometries at once.
+
+    `pitch_x`, `pitch_y`, `theta`, `deltax` and `deltay` can be scalars or
+    arrays, and are broadcast against each other to a common `batch` shape,
+    e.g., for a scan over offsets:
+        build_lut_batch(..., deltax=dxs[:, None], deltay=dys[None, :], ...)
+    Invalid subapertures are not removed (so that every candidate has the
+    same number of subapertures), but flagged in `valid` instead.
+    Returns:
+        xx_c : ((*batch, n_subx*nsub_y), float) : subap centers (x)
+        yy_c : ((*batch, n_subx*nsub_y), float) : subap centers (y)
+        xx_0 : ((*batch, n_subx*nsub_y), int) : subap starting pixel (x)
+        yy_0 : ((*batch, n_subx*nsub_y), int) : subap starting pixel (y)
+        valid : ((*batch, n_subx*nsub_y), bool) : subap within image bounds
+    """
+    pitch_x, pitch_y, theta, deltax, deltay = [
+        np.asarray(p, dtype=float)[..., None]
+        for p in np.broadcast_arrays(pitch_x, pitch_y, theta, deltax, deltay)
+    ]
     ########
     # These are the centres of the subaperture images, allowed to be floats
     ####
-    # build cartesian grid, aligned to x/y axes, centred at (0,0)
-    xx_c, yy_c = np.meshgrid(
-        (np.arange(n_subx)-n_subx/2+0.5)*pitch_x,
-        (np.arange(n_suby)-n_suby/2+0.5)*pitch_y,
+    # build cartesian grid (in units of pitch), aligned to x/y axes, centred
+    # at (0,0)
+    uu, vv = np.meshgrid(
+        np.arange(n_subx)-n_subx/2+0.5,
+        np.arange(n_suby)-n_suby/2+0.5,
         indexing="xy"
     )
-    xx_c = xx_c.flatten()
-    yy_c = yy_c.flatten()
+    xx_c = uu.flatten()*pitch_x
+    yy_c = vv.flatten()*pitch_y
 
     # rotate coordinates around (0,0)
-    pp = np.array([xx_c, yy_c])
-    rot_mat = np.array([
-        [np.cos(theta), -np.sin(theta)],
-        [np.sin(theta), np.cos(theta)],
-    ])
-    pp = rot_mat @ pp
-    xx_c, yy_c = pp
+    cos_t = np.cos(theta)
+    sin_t = np.sin(theta)
+    xx_c, yy_c = cos_t*xx_c - sin_t*yy_c, sin_t*xx_c + cos_t*yy_c
 
     # shift coordinates by (deltax,deltay), and centre in middle of array
     xx_c += deltax + img_w/2
@@ -47,48 +86,64 @@ def build_lut(*, n_subx: int, n_suby: int, pitch_x: float, pitch_y: float,
     yy_0 = np.round(yy_c - fov_y/2).astype(int)
 
     # determine invalid subapertures (accessing out of bounds)
-    valid = np.ones(xx_0.shape, dtype=bool)
-    valid = valid & (xx_0 >= 0)
-    valid = valid & ((xx_0 + fov_x - 1) < img_w)
-    valid = valid & (yy_0 >= 0)
-    valid = valid & ((yy_0 + fov_y - 1) < img_h)
-    invalid_count = (valid == 0).sum()
-    if invalid_count > 0 and unsafe == 0:
-        raise ValueError(
-            f"{invalid_count:d} subapertures are invalid, " +
-            "increase image ROI"
-        )
+    valid = (
+        (xx_0 >= 0) & ((xx_0 + fov_x - 1) < img_w) &
+        (yy_0 >= 0) & ((yy_0 + fov_y - 1) < img_h)
+    )
+    return xx_c, yy_c, xx_0, yy_0, valid
 
-    # filter coordinates by valid only
-    xx_c = xx_c[valid]
-    yy_c = yy_c[valid]
-    xx_0 = xx_0[valid]
-    yy_0 = yy_0[valid]
-    return xx_c, yy_c, xx_0, yy_0
+
+def overlap_map(*, img_w, img_h, fov_x, fov_y, xx_0, yy_0):
+    """Number of subaperture windows covering each pixel of the detector.
+
+    Computed in one pass by accumulating +/-1 at the corners of every window
+    and integrating (2D cumulative sum), rather than looping over windows.
+    """
+    # corners of each window, clipped to the (padded) image
+    x_lo = np.clip(xx_0, 0, img_w)
+    x_hi = np.clip(xx_0 + fov_x, 0, img_w)
+    y_lo = np.clip(yy_0, 0, img_h)
+    y_hi = np.clip(yy_0 + fov_y, 0, img_h)
+    edges = np.zeros([img_h+1, img_w+1])
+    np.add.at(edges, (y_lo, x_lo), 1.0)
+    np.add.at(edges, (y_lo, x_hi), -1.0)
+    np.add.at(edges, (y_hi, x_lo), -1.0)
+    np.add.at(edges, (y_hi, x_hi), 1.0)
+    return edges.cumsum(axis=0).cumsum(axis=1)[:img_h, :img_w]
+
+
+def overlap_stats(image):
+    """summary statistics of an overlap map (see `overlap_map`)"""
+    return {
+        "covered_pixels": int((image > 0).sum()),
+        "coverage": float((image > 0).mean()),
+        "overlapping_pixels": int((image > 1).sum()),
+        "max_overlap": int(image.max()),
+    }
 
 
 def plot_lut(*, img_w, img_h, fov_x, fov_y, xx_0, yy_0, xx_c, yy_c,
              title=None):
+    from matplotlib.collections import PolyCollection
     # project those pixels onto the detector
-    image = np.zeros([img_h, img_w])
-    for x0, y0 in zip(xx_0, yy_0):
-        image[y0:y0+fov_y, x0:x0+fov_x] += 1.0
-    overlapping_count = (image > 1.0).sum()
+    image = overlap_map(img_w=img_w, img_h=img_h, fov_x=fov_x, fov_y=fov_y,
+                        xx_0=xx_0, yy_0=yy_0)
+    overlapping_count = overlap_stats(image)["overlapping_pixels"]
     # Visualisation/sanity checks:
     ####
     # determine vertices of subapertures (for plotting only)
     xx_v = np.stack([
-        xx_0+0.5, xx_0+fov_x-0.5, xx_0+fov_x-0.5, xx_0+0.5, xx_0+0.5
-    ], axis=0)
+        xx_0+0.5, xx_0+fov_x-0.5, xx_0+fov_x-0.5, xx_0+0.5
+    ], axis=-1)
     yy_v = np.stack([
-        yy_0+0.5, yy_0+0.5, yy_0+fov_y-0.5, yy_0+fov_y-0.5, yy_0+0.5
-    ], axis=0)
+        yy_0+0.5, yy_0+0.5, yy_0+fov_y-0.5, yy_0+fov_y-0.5
+    ], axis=-1)
     fig, ax = plt.subplots(1, 2, figsize=[12, 6])
     ax[0].plot(xx_c.flatten(), yy_c.flatten(), ".")
-    for i in range(xx_v.shape[1]):
-        xv = xx_v[:, i]
-        yv = yy_v[:, i]
-        ax[0].plot(xv, yv, "k")
+    # all outlines as a single artist, rather than one Line2D per subap
+    ax[0].add_collection(PolyCollection(
+        np.stack([xx_v, yy_v], axis=-1), facecolors="none", edgecolors="k"
+    ))
     ax[0].axis("square")
     ax[0].set_title("subaperture coordinates and bounds")
     ax[1].imshow(image, origin="lower")
@@ -98,6 +153,7 @@ def plot_lut(*, img_w, img_h, fov_x, fov_y, xx_0, yy_0, xx_c, yy_c,
     plt.tight_layout()
     if title:
         fig.canvas.manager.set_window_title(title)
+    return fig
 
 
 if __name__ == "__main__":
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""Calibration-prep for the centroider.
+
+The centroider folds the static background, the flat field and the threshold
+into a gain frame and an offset frame, so that the per-pixel work in the hot
+loop is one multiply-subtract (plus the per-row background):
+
+    pixel = (raw - bg_row)*gain - offset,  gain = 1/flat,
+                                           offset = gain*bg + thresh
+
+and works out which image rows are read by any subaperture, so that the
+per-row background is only computed for those. This is rebuilt only when
+`scmos{idx}_bg`, `wfsflat{idx}`, the LUT or the parameters change (see
+`prepcalib` in `ltaomod_centroider/centroider.c`, which publishes the offset
+as `calib{idx}`). This module implements the same calibration, for the
+Python centroider and for checking the C one via `cent config calib`, and
+builds the flat published by `cent config flat`.
+"""
+
+import numpy as np
+
+
+def flat_gain(flat, shape):
+    """per-pixel gain for a flat field. A flat that's all 0 (as created by
+    the centroider if none has been published), or that doesn't match the
+    image, means no flat-fielding. Pixels with a flat <= 0 are dead."""
+    if flat is None or flat.shape != shape or not np.any(flat):
+        return np.ones(shape, dtype=np.float32)
+    gain = np.zeros(shape, dtype=np.float32)
+    np.divide(1.0, flat, out=gain, where=flat > 0)
+    return gain
+
+
+def prepare_calib(bg, luty, *, thresh, fovy, flat=None):
+    """fold background, flat and threshold into a gain and an offset frame
+    Returns:
+        offset : ((img_h, img_w), float) : value to subtract from each pixel
+        gain : ((img_h, img_w), float) : value to multiply each pixel by
+        rows : ((nrows,), int) : image rows read by at least one subaperture
+    """
+    img_h = bg.shape[0]
+    gain = flat_gain(flat, bg.shape)
+    offset = gain*bg.astype(np.float32)
+    if thresh > -1.0:
+        offset += np.float32(thresh)
+    # C integer division and round-half-away-from-zero
+    y0 = np.floor(luty - fovy//2 + 0.5).astype(int)
+    rows = (y0[:, None] + np.arange(fovy)[None, :]).flatten()
+    rows = np.unique(rows[(rows >= 0) & (rows < img_h)])
+    return offset, gain, rows
+
+
+def make_flat(frames, bg, lutx, luty, *, fovx, fovy, min_flat=0.1):
+    """build a flat field from illuminated frames
+
+    The background-subtracted mean frame is normalised by its mean within
+    each subaperture window, so the flat only corrects pixel-to-pixel
+    response and not the illumination of each subaperture (which the
+    flux-weighted centroid doesn't care about). Pixels outside all windows
+    are left at 1, pixels below `min_flat` are marked dead (0).
+
+    Args:
+        frames : ((nframes, img_h, img_w), float) : illuminated frames
+        bg : ((img_h, img_w), float) : static background
+    Returns:
+        flat : ((img_h, img_w), float32)
+    """
+    mean = np.mean(frames, axis=0, dtype=np.float64) - bg
+    flat = np.ones(bg.shape, dtype=np.float32)
+    # C integer division and round-half-away-from-zero
+    x0 = np.floor(lutx - fovx//2 + 0.5).astype(int)
+    y0 = np.floor(luty - fovy//2 + 0.5).astype(int)
+    img_h, img_w = bg.shape
+    for x, y in zip(x0, y0):
+        if x < 0 or y < 0 or x+fovx > img_w or y+fovy > img_h:
+            continue
+        window = mean[y:y+fovy, x:x+fovx]
+        norm = window.mean()
+        if norm <= 0:
+            # unilluminated subaperture, nothing to learn from it
+            continue
+        flat[y:y+fovy, x:x+fovx] = window/norm
+    flat[flat < min_flat] = 0.0
+    return flat
+
+
+def flat_summary(flat):
+    """statistics of the pixels corrected by a flat"""
+    corrected = flat[flat != 1.0]
+    live = corrected[corrected > 0]
+    return {
+        "dead_pixels": int((flat == 0).sum()),
+        "min": float(live.min()) if len(live) else 1.0,
+        "max": float(live.max()) if len(live) else 1.0,
+        "rms": float(np.std(live)) if len(live) else 0.0,
+    }
+
+
+def calib_summary(offset, rows, *, bgnpix):
+    """how much per-frame work the calibration saves"""
+    img_h = offset.shape[0]
+    return {
+        "rows_used": int(len(rows)),
+        "rows_total": int(img_h),
+        "bg_row_pixels": int(len(rows)*2*bgnpix),
+        "bg_row_pixels_all_rows": int(img_h*2*bgnpix),
+    }
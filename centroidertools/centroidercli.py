@@ -1,19 +1,29 @@
 #!/usr/bin/env python3
 
+# imported first, so that `--profile` can time the other imports
+from centroidertools import profiling
 import argparse
 import sys
 import os
 import subprocess
 import contextlib
 import yaml
-from pyMilk.interfacing.fps import FPS
-from pyMilk.interfacing.shm import SHM
-from pydantic import BaseModel
+from pydantic import BaseModel, ValidationError
+from typing import Optional
+from centroidertools import backend
+from centroidertools.backend import SHM, FPS
 from centroidertools import build_subap_lut as bld
 from centroidertools import fit_subap_lut as fit
 import numpy as np
 from centroidertools.wgui import app
 from centroidertools import reconstructor
+from centroidertools import latency
+from centroidertools import telemetry
+from centroidertools import calib
+from centroidertools import watch
+from centroidertools import lutbuf
+from centroidertools import tune
+from centroidertools import bench
 import time
 
 
@@ -52,6 +62,8 @@ class Config(BaseModel):
     theta: float
     cogthresh: float
     bgnpix: int
+    # valid subaperture indices (see `cent config valid`), None for all
+    valid: Optional[list[int]] = None
 
     @staticmethod
     def from_dict(config_dict: dict):
@@ -113,6 +125,16 @@ class CentroiderCLI():
         parser.add_argument("command", help="Subcommand to run")
         parser.add_argument("--verbose", "-v", action="count", default=0,
                             help="verbosity level")
+        parser.add_argument(
+            "--profile", nargs="?", const="", default=None, metavar="TRACE",
+            help=("print the time spent in each phase of the command, and "
+                  "write them as a Chrome trace if given (--profile=TRACE)")
+        )
+        parser.add_argument(
+            "--cprofile", nargs="?", const="", default=None, metavar="FILE",
+            help=("also run the command under cProfile, saving the stats if "
+                  "given (--cprofile=FILE)")
+        )
 
         split_args = [[], []]
         for i in range(len(sys.argv)):
@@ -121,12 +143,19 @@ class CentroiderCLI():
                 split_args[0].append(tmp)
                 split_args[1].append(tmp)
                 continue
-            if i == 1 or "-v" in tmp:
+            if i == 1 or "-v" in tmp or \
+                    tmp.startswith(("--profile", "--cprofile")):
                 split_args[0].append(tmp)
             else:
                 split_args[1].append(tmp)
         args = parser.parse_args(split_args[0][1:])
         self._verbosity = args.verbose
+        if args.profile is not None or args.cprofile is not None:
+            profiling.enable(
+                trace=args.profile or None,
+                cprofile=args.cprofile is not None,
+                cprofile_file=args.cprofile or None,
+            )
 
         if not hasattr(self, args.command):
             print(f"Unrecognized cent command: `{args.command}`")
@@ -136,7 +165,8 @@ class CentroiderCLI():
         sys.argv = split_args[1]
 
         # use dispatch pattern to invoke method with same name
-        getattr(self, args.command)()
+        with profiling.phase(args.command):
+            getattr(self, args.command)()
 
     def start(self):
         """Try to start the centroiders"""
@@ -169,23 +199,15 @@ class CentroiderCLI():
                         f"ltao.centroider {idx:01d};"
                         f"ltao.centroider _FPSINIT_;"
                         f"ltao.centroider _TMUXSTART_;")
-            cmd = ["milk-exec", "-n", milk_loopname, milk_cmd]
-            # start tmux session and fpsinit
-            result = subprocess.run(cmd, capture_output=True, cwd="/tmp/")
-            warning_string = self._parse_launch_result(result)
-            if self._verbosity > 0:
-                if result.returncode != 0:
-                    print(f"failed to create {milk_loopname}")
-                if warning_string:
-                    print(warning_string)
-                    print("")
+            self._launch(milk_loopname, milk_cmd, ["centroider", str(idx)])
 
         fps_list = self._fps_list()
         for fps in fps_list:
-            while not fps.conf_isrunning():
-                fps.conf_start()
-            while not fps.run_isrunning():
-                fps.run_start()
+            with profiling.phase(f"start {fps.name}"):
+                while not fps.conf_isrunning():
+                    fps.conf_start()
+                while not fps.run_isrunning():
+                    fps.run_start()
             if self._verbosity > 0:
                 print(f"started {fps.name}")
 
@@ -195,32 +217,61 @@ class CentroiderCLI():
                     "ltao.slopevec;"
                     "ltao.slopevec _FPSINIT_;"
                     "ltao.slopevec _TMUXSTART_;")
-        cmd = ["milk-exec", "-n", milk_loopname, milk_cmd]
-        # start tmux session and fpsinit
-        result = subprocess.run(cmd, capture_output=True, cwd="/tmp/")
-        warning_string = self._parse_launch_result(result)
-        if self._verbosity > 0:
-            if result.returncode != 0:
-                print(f"failed to create {milk_loopname}")
-            if warning_string:
-                print(warning_string)
-                print("")
+        self._launch(milk_loopname, milk_cmd, ["slopevec"])
 
         try:
-            fps = FPS(milk_loopname)
+            with profiling.phase("fps connect"):
+                fps = FPS(milk_loopname)
         except RuntimeError:
             print("couldnt connect to slopevec whattha?")
             fps = None
         if fps:
-            while not fps.conf_isrunning():
-                fps.conf_start()
-            while not fps.run_isrunning():
-                fps.run_start()
+            with profiling.phase(f"start {fps.name}"):
+                while not fps.conf_isrunning():
+                    fps.conf_start()
+                while not fps.run_isrunning():
+                    fps.run_start()
             if self._verbosity > 0:
                 print(f"started {fps.name}")
 
         self._clean()
 
+    def _launch(self, milk_loopname, milk_cmd, local_args, timeout=10.0):
+        """launch a centroider process, with milk or (for the local backend)
+        with the python stand-in from `pycentroider`"""
+        with profiling.phase(f"launch {milk_loopname}"):
+            self._launch_process(milk_loopname, milk_cmd, local_args, timeout)
+
+    def _launch_process(self, milk_loopname, milk_cmd, local_args, timeout):
+        if backend.LOCAL:
+            subprocess.Popen(
+                [sys.executable, "-m", "centroidertools.pycentroider",
+                 *local_args],
+                cwd="/tmp/", start_new_session=True,
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            )
+            # wait for the process to create its FPS
+            t0 = time.time()
+            while time.time()-t0 < timeout:
+                try:
+                    FPS(milk_loopname)
+                    return
+                except RuntimeError:
+                    time.sleep(0.01)
+            if self._verbosity > 0:
+                print(f"failed to create {milk_loopname}")
+            return
+        cmd = ["milk-exec", "-n", milk_loopname, milk_cmd]
+        # start tmux session and fpsinit
+        result = subprocess.run(cmd, capture_output=True, cwd="/tmp/")
+        warning_string = self._parse_launch_result(result)
+        if self._verbosity > 0:
+            if result.returncode != 0:
+                print(f"failed to create {milk_loopname}")
+            if warning_string:
+                print(warning_string)
+                print("")
+
     def _standard_args(self, parser):
         parser.add_argument(
             "--filename", help="centroider configuration filename",
@@ -239,25 +290,7 @@ class CentroiderCLI():
             if self._verbosity > 0:
                 print("all centroiders stopped already")
         for fps in valid_fps:
-            if self._verbosity > 0:
-                print(f"stopping {fps.name}")
-            # stop run (if running)
-            fps.run_stop()
-            # stop conf (if confing)
-            fps.conf_stop()
-            # close tmux (if tmuxing)
-            subprocess.run([
-                "tmux",
-                "kill-session",
-                "-t",
-                f"{fps.name}"
-            ], capture_output=True, check=False, cwd="/tmp/")
-            # delete FPS
-            dirname = os.environ["MILK_SHM_DIR"]
-            filename = fps.name+".fps.shm"
-            pathname = os.path.abspath(os.path.join(dirname, filename))
-            if pathname.startswith(dirname):
-                os.remove(pathname)
+            self._kill(fps)
 
         with redirect_stdout():
             try:
@@ -265,27 +298,32 @@ class CentroiderCLI():
             except RuntimeError:
                 fps = None
         if fps:
-            if self._verbosity > 0:
-                print(f"stopping {fps.name}")
-            # stop run (if running)
-            fps.run_stop()
-            # stop conf (if confing)
-            fps.conf_stop()
-            # close tmux (if tmuxing)
+            self._kill(fps)
+
+        self._clean(cleanshm=True)
+
+    def _kill(self, fps):
+        if self._verbosity > 0:
+            print(f"stopping {fps.name}")
+        # stop run (if running)
+        fps.run_stop()
+        # stop conf (if confing)
+        fps.conf_stop()
+        # close tmux (if tmuxing), the local backend processes exit by
+        # themselves once conf is stopped
+        if not backend.LOCAL:
             subprocess.run([
                 "tmux",
                 "kill-session",
                 "-t",
                 f"{fps.name}"
             ], capture_output=True, check=False, cwd="/tmp/")
-            # delete FPS
-            dirname = os.environ["MILK_SHM_DIR"]
-            filename = fps.name+".fps.shm"
-            pathname = os.path.abspath(os.path.join(dirname, filename))
-            if pathname.startswith(dirname):
-                os.remove(pathname)
-
-        self._clean(cleanshm=True)
+        # delete FPS
+        dirname = backend.SHM_DIR
+        filename = fps.name+".fps.shm"
+        pathname = os.path.abspath(os.path.join(dirname, filename))
+        if pathname.startswith(dirname):
+            os.remove(pathname)
 
     @staticmethod
     def _parse_launch_result(result):
@@ -304,7 +342,7 @@ class CentroiderCLI():
         fps_list = []
         for idx in self._indices:
             name = f"{self._fpsprefix:s}{idx:01d}"
-            with redirect_stdout():
+            with redirect_stdout(), profiling.phase("fps connect"):
                 try:
                     fps = FPS(name)
                     fps_list.append(fps)
@@ -322,11 +360,33 @@ class CentroiderCLI():
             )
         parser.add_argument(
             "action", help="action to perform on configuration",
-            choices=["load", "init", "edit", "plot", "fit"]
+            choices=[
+                "load", "init", "edit", "plot", "fit", "calib", "flat",
+                "valid", "watch", "tune", "refine",
+            ]
         )
         parser.add_argument(
             "--nframes", "-n", type=int, default=10,
-            help="number of frames to use (e.g., for `cent config fit -n=10`)",
+            help=("number of frames to use (e.g., for `cent config fit -n=10`"
+                  " or `cent config flat -n=100`)"),
+        )
+        parser.add_argument(
+            "--outdir", default=None,
+            help=("for `plot` (or after `fit`), don't show plots but write "
+                  "overlap statistics and a png for each WFS to this dir"),
+        )
+        parser.add_argument(
+            "--data", default=None,
+            help=("for `tune`, directory of recorded frames (as for "
+                  "scripts/play_images.py)"),
+        )
+        parser.add_argument(
+            "--workers", type=int, default=None,
+            help="for `tune`, number of processes (default: one per core)",
+        )
+        parser.add_argument(
+            "--niter", type=int, default=3,
+            help="for `refine`, number of least-squares iterations",
         )
         args = self._standard_args(parser)
 
@@ -337,9 +397,34 @@ class CentroiderCLI():
             self._config_init(filename)
         elif args.action == "fit":
             self._config_fit(filename, nframes=args.nframes)
+            if args.outdir:
+                self._config_plot(outdir=args.outdir)
         elif args.action == "plot":
             self._config_load(filename, apply=False)
-            self._config_plot()
+            self._config_plot(outdir=args.outdir)
+        elif args.action == "calib":
+            self._config_load(filename, apply=False)
+            self._config_calib()
+        elif args.action == "flat":
+            self._config_load(filename, apply=False)
+            self._config_flat(nframes=args.nframes)
+        elif args.action == "valid":
+            self._config_load(filename, apply=False)
+            self._config_valid(nframes=args.nframes)
+            self._config_save(filename)
+        elif args.action == "watch":
+            self._config_watch(filename)
+        elif args.action == "tune":
+            if args.data is None:
+                print("`config tune` needs recorded frames, see --data")
+                exit(1)
+            self._config_load(filename, apply=False)
+            self._config_tune(args.data, workers=args.workers)
+            self._config_save(filename)
+        elif args.action == "refine":
+            self._config_load(filename)
+            self._config_refine(niter=args.niter, nframes=args.nframes)
+            self._config_save(filename)
         elif args.action == "edit":
             editor = "nano"
             if "EDITOR" in os.environ:
@@ -353,7 +438,7 @@ class CentroiderCLI():
 
     def _config_load(self, filename, apply=True):
         # Loading configs from file
-        with open(filename, "r") as f:
+        with profiling.phase("yaml load"), open(filename, "r") as f:
             configs = yaml.safe_load(f)
         if self._verbosity > 0:
             print(f"reading configs from:\n{filename}")
@@ -366,10 +451,12 @@ class CentroiderCLI():
         for idx, config in configs.items():
             if self._verbosity > 0:
                 print(f"loading config {idx}")
-            _configs[idx] = Config.from_dict(config)
+            with profiling.phase("validate"):
+                _configs[idx] = Config.from_dict(config)
         self._configs = _configs
         if apply:
-            self._config_apply()
+            with profiling.phase("apply"):
+                self._config_apply()
 
     def _config_init(self, filename):
         configs = {
@@ -443,22 +530,24 @@ class CentroiderCLI():
             n_suby = config["n_suby"]
 
             # get wfs frame
-            shm = SHM(f"scmos{idx:01d}_data")
-            im = np.mean([
-                shm.get_data(check=True).astype(np.float32)
-                for _ in range(nframes)
-            ], axis=0)
-            im -= SHM(f"scmos{idx:01d}_bg").get_data()
+            with profiling.phase(f"acquire wfs{idx:01d}"):
+                shm = SHM(f"scmos{idx:01d}_data")
+                im = np.mean([
+                    shm.get_data(check=True).astype(np.float32)
+                    for _ in range(nframes)
+                ], axis=0)
+                im -= SHM(f"scmos{idx:01d}_bg").get_data()
             img_h, img_w = im.shape
 
             if not printed_header:
                 fit.print_header()
                 printed_header = True
             # fit config params
-            deltax, deltay, _, pitch_x, pitch_y = fit.fit_config(
-                im, idx, n_subx=n_subx, n_suby=n_suby,
-                min_pitch=5.0, max_pitch=8.0
-            )
+            with profiling.phase(f"fit wfs{idx:01d}"):
+                deltax, deltay, _, pitch_x, pitch_y = fit.fit_config(
+                    im, idx, n_subx=n_subx, n_suby=n_suby,
+                    min_pitch=5.0, max_pitch=8.0
+                )
 
             # save to local config dict
             config["pitch_x"] = pitch_x
@@ -488,32 +577,160 @@ class CentroiderCLI():
         # load config from disk and apply to shm
         self._config_load(filename, apply=True)
         for idx in self._indices:
-            result = fit.fine_tune(idx, nframes=nframes)
+            with profiling.phase(f"fine tune wfs{idx:01d}"):
+                result = fit.fine_tune(idx, nframes=nframes)
             if result is not None:
                 configs[idx].deltax += float(result[0])
                 configs[idx].deltay += float(result[1])
-            thresh_mean, thresh_std = fit.estimate_thresh(idx, nframes=nframes)
+            with profiling.phase(f"estimate thresh wfs{idx:01d}"):
+                thresh_mean, thresh_std = fit.estimate_thresh(
+                    idx, nframes=nframes
+                )
             if result is not None:
                 configs[idx].cogthresh += float(thresh_mean)
                 print(thresh_mean, thresh_std)
         self._config_save(filename, configs=configs)
         self._config_load(filename, apply=True)
 
-    def _config_plot(self, configs=None):
-        """plot the configuration provided"""
+    def _config_plot(self, configs=None, outdir=None):
+        """plot the configuration provided. If `outdir` is given, run
+        headless: save a png and the overlap statistics of each WFS there"""
         if not configs:
             if self._configs:
                 configs = self._configs
             else:
                 raise RuntimeError("configs not provided nor previously set")
         import matplotlib.pyplot as plt
+        if outdir:
+            plt.switch_backend("Agg")
+            os.makedirs(outdir, exist_ok=True)
+            print(f"{'index':10s} | {'coverage':10s} | {'overlaps':10s} | "
+                  f"{'max':10s}")
         for idx, config in configs.items():
             xx_c, yy_c, xx_0, yy_0 = config.build_lut()
-            bld.plot_lut(img_w=config.img_w, img_h=config.img_h,
-                         fov_x=config.fov_x, fov_y=config.fov_y,
-                         xx_0=xx_0, yy_0=yy_0, xx_c=xx_c, yy_c=yy_c,
-                         title=f"WFS {idx}")
-        plt.show()
+            xx_0 = xx_0.astype(int)
+            yy_0 = yy_0.astype(int)
+            fig = bld.plot_lut(img_w=config.img_w, img_h=config.img_h,
+                               fov_x=config.fov_x, fov_y=config.fov_y,
+                               xx_0=xx_0, yy_0=yy_0, xx_c=xx_c, yy_c=yy_c,
+                               title=f"WFS {idx}")
+            if not outdir:
+                continue
+            stats = bld.overlap_stats(bld.overlap_map(
+                img_w=config.img_w, img_h=config.img_h,
+                fov_x=config.fov_x, fov_y=config.fov_y, xx_0=xx_0, yy_0=yy_0
+            ))
+            print(f"{idx:10d} | {stats['coverage']:10.3f} | "
+                  f"{stats['overlapping_pixels']:10d} | "
+                  f"{stats['max_overlap']:10d}")
+            fig.savefig(os.path.join(outdir, f"lut{idx:01d}.png"))
+            plt.close(fig)
+            with open(os.path.join(outdir, f"lut{idx:01d}.yaml"), "w") as f:
+                yaml.dump(stats, f)
+        if outdir:
+            if self._verbosity > 0:
+                print(f"saved lut plots and stats to:\n{outdir}")
+        else:
+            plt.show()
+
+    def _config_calib(self, configs=None):
+        """prepare the centroider calibration from the live background, and
+        compare it with the one the centroider is using"""
+        if configs is None:
+            configs = self._configs
+        print(f"{'index':10s} | {'rows used':10s} | {'bg pixels':10s} | "
+              f"{'max diff':10s}")
+        for idx, config in configs.items():
+            try:
+                bg = SHM(f"scmos{idx:01d}_bg").get_data()
+            except FileNotFoundError:
+                if self._verbosity > 0:
+                    print(f"scmos{idx:01d}_bg doesn't exist, skipping")
+                continue
+            try:
+                flat = SHM(f"wfsflat{idx:01d}").get_data()
+            except FileNotFoundError:
+                flat = None
+            _, yy_c, _, _ = config.build_lut()
+            offset, _, rows = calib.prepare_calib(
+                bg, yy_c, thresh=config.cogthresh, fovy=config.fov_y,
+                flat=flat
+            )
+            summary = calib.calib_summary(offset, rows, bgnpix=config.bgnpix)
+            try:
+                live = SHM(f"calib{idx:01d}").get_data()
+                diff = f"{np.abs(live - offset).max():10.3g}"
+            except FileNotFoundError:
+                diff = f"{'n/a':>10s}"
+            print(f"{idx:10d} | "
+                  f"{summary['rows_used']:4d}/{summary['rows_total']:<5d} | "
+                  f"{summary['bg_row_pixels']:10d} | {diff}")
+
+    def _config_flat(self, configs=None, nframes=100):
+        """acquire a flat field from the (illuminated) live frames of each
+        WFS, and publish it to `wfsflat{idx}` for the centroider to use"""
+        if configs is None:
+            configs = self._configs
+        if self._verbosity > 0:
+            print(f"{'index':10s} | {'dead pix':10s} | {'min':10s} | "
+                  f"{'max':10s} | {'rms':10s}")
+        for idx, config in configs.items():
+            try:
+                shm = SHM(f"scmos{idx:01d}_data")
+                bg = SHM(f"scmos{idx:01d}_bg").get_data().astype(np.float32)
+            except FileNotFoundError:
+                if self._verbosity > 0:
+                    print(f"scmos{idx:01d}_data/bg doesn't exist, skipping")
+                continue
+            frames = np.array([
+                shm.get_data(check=True).astype(np.float32)
+                for _ in range(nframes)
+            ])
+            xx_c, yy_c, _, _ = config.build_lut()
+            flat = calib.make_flat(
+                frames, bg, xx_c, yy_c, fovx=config.fov_x, fovy=config.fov_y
+            )
+            flatname = f"wfsflat{idx:01d}"
+            with redirect_stdout():
+                try:
+                    flat_shm = SHM(flatname)
+                    if flat_shm.shape != flat.shape:
+                        raise FileNotFoundError
+                    flat_shm.set_data(flat)
+                except FileNotFoundError:
+                    flat_shm = SHM(flatname, flat)
+            if self._verbosity > 0:
+                summary = calib.flat_summary(flat)
+                print(f"{idx:10d} | {summary['dead_pixels']:10d} | "
+                      f"{summary['min']:10.3f} | {summary['max']:10.3f} | "
+                      f"{summary['rms']:10.3f}")
+
+    def _config_valid(self, configs=None, nframes=10):
+        """find the valid subapertures of each WFS from the mean flux and the
+        centroider's fluxthresh, and store them in the config, for the
+        reconstructor to use"""
+        if configs is None:
+            configs = self._configs
+        for idx, config in configs.items():
+            try:
+                flux = reconstructor.get_shm_stacked(
+                    f"flux{idx:01d}", nframes=nframes
+                )
+            except FileNotFoundError:
+                if self._verbosity > 0:
+                    print(f"flux{idx:01d} doesn't exist, skipping")
+                continue
+            try:
+                with redirect_stdout():
+                    fps = FPS(f"{self._fpsprefix:s}{idx:01d}")
+                fluxthresh = fps.get_param("fluxthresh")
+            except RuntimeError:
+                fluxthresh = 0.3
+            valid = reconstructor.valid_subaps(flux, fluxthresh)
+            config.valid = [int(i) for i in valid]
+            if self._verbosity > 0:
+                print(f"wfs{idx:01d}: {len(valid)}/{flux.size} valid "
+                      f"subapertures (fluxthresh={fluxthresh:.2f})")
 
     def _config_apply(self, configs=None):
         """apply config, either the provided one or the one in the object"""
@@ -524,56 +741,177 @@ class CentroiderCLI():
                 raise RuntimeError("configs not provided nor previously set")
 
         for idx in self._indices:
-            # build lookup table for shm based on config
-            xx_c, yy_c, _, _ = configs[idx].build_lut()
-            lutxname = f"lutx{idx:01d}"
-            lutyname = f"luty{idx:01d}"
-            with redirect_stdout():
-                try:
-                    shm = SHM(lutxname)
-                    shm.set_data(xx_c)
-                except FileNotFoundError:
-                    shm = SHM(lutxname, xx_c)
-                try:
-                    shm = SHM(lutyname)
-                    shm.set_data(yy_c)
-                except FileNotFoundError:
-                    shm = SHM(lutyname, yy_c)
-                # also apply fov from config to fps
-                try:
+            with profiling.phase(f"wfs{idx:01d}"):
+                self._config_apply_changes(
+                    idx, configs[idx], set(configs[idx].to_dict())
+                )
+            # could do other params here too, like fluxthresh
+
+            if self._verbosity > 0:
+                print(f"wrote lutx{idx:01d} and luty{idx:01d} to shm")
+
+    @staticmethod
+    def _build_lut(config):
+        with profiling.phase("build lut"):
+            xx_c, yy_c, _, _ = config.build_lut()
+        return xx_c, yy_c
+
+    def _write_lut(self, idx, config, lut=None, stopped=False):
+        """write the LUT of WFS idx (built from `config`, unless given as
+        `lut`), which can only change layout if the run loop is `stopped`
+        (see lutbuf.write_lut)"""
+        if lut is None:
+            lut = self._build_lut(config)
+        with redirect_stdout(), profiling.phase("write lut"):
+            lutbuf.write_lut(idx, *lut, stopped=stopped)
+
+    @staticmethod
+    def _set_param(fps, key, value):
+        with profiling.phase(f"set {key}"):
+            fps.set_param(key, value)
+            while fps.get_param(key) != value:
+                fps.set_param(key, value)
+
+    def _config_apply_changes(self, idx, config, fields):
+        """apply the `fields` of the config of WFS idx. The LUT is double
+        buffered (see lutbuf.py), so is swapped between two frames, and the
+        other params are read every frame, so the run loop is only stopped
+        if the FOV changes (a larger window around the other LUT could read
+        outside the image), or if the LUT changes layout (the number of
+        subapertures), which recreates its streams."""
+        with redirect_stdout():
+            try:
+                with profiling.phase("fps connect"):
                     fps = FPS(f"{self._fpsprefix:s}{idx:01d}")
-                except RuntimeError:
-                    if self._verbosity > 0:
-                        print(f"FPS doesn't exist, skipping wfs{idx:01d}")
-                    continue
-                running = fps.run_isrunning()
-                if running:
+            except RuntimeError:
+                if self._verbosity > 0:
+                    print(f"FPS doesn't exist, skipping wfs{idx:01d} params")
+                fps = None
+            lut = None
+            if fields & (watch.GEOMETRY_FIELDS | watch.FOV_FIELDS):
+                lut = self._build_lut(config)
+            running = fps is not None and fps.run_isrunning()
+            stop = running and (
+                fps.get_param("fovx") != config.fov_x or
+                fps.get_param("fovy") != config.fov_y or
+                (lut is not None and
+                 lutbuf.relayout_needed(idx, len(lut[0])))
+            )
+            if stop:
+                with profiling.phase("run stop"):
                     while fps.run_isrunning():
                         fps.run_stop()
-                fov_x = configs[idx].fov_x
-                fov_y = configs[idx].fov_y
-                cogthresh = configs[idx].cogthresh
-                bgnpix = configs[idx].bgnpix
-                fps.set_param("fovx", fov_x)
-                while fps.get_param("fovx") != fov_x:
-                    fps.set_param("fovx", fov_x)
-                fps.set_param("fovy", fov_y)
-                while fps.get_param("fovy") != fov_y:
-                    fps.set_param("fovy", fov_y)
-                fps.set_param("cogthresh", cogthresh)
-                while fps.get_param("cogthresh") != cogthresh:
-                    fps.set_param("cogthresh", cogthresh)
-                fps.set_param("bgnpix", bgnpix)
-                while fps.get_param("bgnpix") != bgnpix:
-                    fps.set_param("bgnpix", bgnpix)
-                if running:
+            if lut is not None:
+                self._write_lut(
+                    idx, config, lut=lut, stopped=stop or not running
+                )
+            if fps is not None:
+                for key, field in [("fovx", "fov_x"), ("fovy", "fov_y"),
+                                   ("cogthresh", "cogthresh"),
+                                   ("bgnpix", "bgnpix")]:
+                    if field in fields:
+                        self._set_param(fps, key, getattr(config, field))
+            if stop:
+                with profiling.phase("run start"):
                     while not fps.run_isrunning():
                         fps.run_start()
-            # could do other params here too, like bgnpix,
-            # cogthresh, fluxthresh
 
-            if self._verbosity > 0:
-                print(f"wrote lutx{idx:01d} and luty{idx:01d} to shm")
+    def _config_refine(self, niter=3, nframes=10):
+        """refine the geometry of each WFS from its live slopes, by linear
+        least-squares (see `fit.refine_step`), applying the LUT after each
+        iteration"""
+        print(f"{'index':>5s} | {'iter':>4s} | {'rms':>7s} | {'resid':>7s} | "
+              f"{'deltax':>9s} | {'deltay':>9s} | {'theta':>9s} | "
+              f"{'pitchx':>7s} | {'pitchy':>7s}")
+        for idx in self._indices:
+            with redirect_stdout():
+                try:
+                    running = FPS(
+                        f"{self._fpsprefix:s}{idx:01d}"
+                    ).run_isrunning()
+                except RuntimeError:
+                    running = False
+            if not running:
+                print(f"{self._fpsprefix}{idx:01d} not running, can't refine")
+                continue
+            config = self._configs[idx]
+            after = None
+            for i in range(niter):
+                slopemap, fluxmap = fit.mean_slopes(
+                    idx, nframes=nframes, after=after
+                )
+                update, rms, resid = fit.refine_step(
+                    slopemap, fluxmap,
+                    n_subx=config.n_subx, n_suby=config.n_suby,
+                    img_w=config.img_w, img_h=config.img_h,
+                    **{
+                        param: getattr(config, param)
+                        for param in fit.REFINE_PARAMS
+                    }
+                )
+                for param, value in update.items():
+                    setattr(config, param, getattr(config, param) + value)
+                self._write_lut(idx, config)
+                # don't average frames that may have used the old LUT
+                after = SHM(f"slopemap{idx:01d}").get_counter()
+                print(f"{idx:5d} | {i:4d} | {rms:7.4f} | {resid:7.4f} | "
+                      f"{config.deltax:9.4f} | {config.deltay:9.4f} | "
+                      f"{config.theta:9.6f} | {config.pitch_x:7.4f} | "
+                      f"{config.pitch_y:7.4f}")
+
+    def _config_tune(self, datadir, workers=None):
+        """search cogthresh, bgnpix and FOV on recorded frames (see tune.py),
+        and keep the best for each WFS"""
+        recording = tune.load_recording(datadir)
+        for idx in self._indices:
+            if idx not in recording or idx not in self._configs:
+                if self._verbosity > 0:
+                    print(f"no recording or config for wfs{idx:01d}")
+                continue
+            frames, bg = recording[idx]
+            config = self._configs[idx]
+            results = tune.tune(config, frames, bg, workers=workers)
+            tune.print_report(idx, config, results)
+            best = results[0]
+            config.fov_x = best["fov_x"]
+            config.fov_y = best["fov_y"]
+            config.bgnpix = best["bgnpix"]
+            config.cogthresh = best["cogthresh"]
+
+    def _config_watch(self, filename):
+        """apply changes to the config file as soon as it's saved"""
+        self._config_load(filename, apply=False)
+        watcher = watch.FileWatcher(filename)
+        print(f"watching {filename} for changes (ctrl-c to stop)")
+        try:
+            while True:
+                if not watcher.wait(timeout=1.0):
+                    continue
+                try:
+                    with open(filename, "r") as f:
+                        configs = {
+                            idx: Config.from_dict(config)
+                            for idx, config in yaml.safe_load(f).items()
+                        }
+                except (OSError, yaml.YAMLError, ValidationError,
+                        AttributeError, TypeError) as e:
+                    # e.g., a half-saved or invalid file, wait for the next
+                    print(f"invalid config, not applied:\n{e}")
+                    continue
+                changes = watch.diff_configs(self._configs, configs)
+                for idx, fields in changes.items():
+                    if idx not in self._indices:
+                        continue
+                    t0 = time.perf_counter()
+                    self._config_apply_changes(idx, configs[idx], fields)
+                    dt = time.perf_counter() - t0
+                    print(f"wfs{idx:01d}: applied {', '.join(sorted(fields))}"
+                          f" in {1e3*dt:.1f} ms")
+                self._configs = configs
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.close()
 
     def _config_save(self, filename, configs=None):
         if configs is None:
@@ -583,7 +921,7 @@ class CentroiderCLI():
                 print("refusing to save empty config")
                 exit(1)
         # Saving current config
-        with open(filename, "w") as f:
+        with profiling.phase("yaml save"), open(filename, "w") as f:
             yaml.dump(
                 {
                     idx: config.to_dict()
@@ -595,6 +933,10 @@ class CentroiderCLI():
 
     def _clean(self, cleanshm=False):
         """clean crumbs in shm dir. Shouldn't be necessary but it is"""
+        with profiling.phase("clean"):
+            self._clean_files(cleanshm)
+
+    def _clean_files(self, cleanshm):
         from glob import glob
 
         def rm(files):
@@ -603,17 +945,22 @@ class CentroiderCLI():
                     print(f"rm {file}")
                 os.remove(file)
 
-        rm(glob(os.environ["MILK_SHM_DIR"] + "/milkCLIstartup.centroider*"))
-        rm(glob(os.environ["MILK_SHM_DIR"] + "/milkCLIstartup.slopevec*"))
+        shmdir = backend.SHM_DIR
+        rm(glob(shmdir + "/milkCLIstartup.centroider*"))
+        rm(glob(shmdir + "/milkCLIstartup.slopevec*"))
         if cleanshm:
-            rm(glob(os.environ["MILK_SHM_DIR"] + "/flux*.im.shm"))
-            rm(glob(os.environ["MILK_SHM_DIR"] + "/lutx*.im.shm"))
-            rm(glob(os.environ["MILK_SHM_DIR"] + "/luty*.im.shm"))
-            rm(glob(os.environ["MILK_SHM_DIR"] + "/slopemap*.im.shm"))
-            rm(glob(os.environ["MILK_SHM_DIR"] + "/slopevec.im.shm"))
-            rm(glob(os.environ["MILK_SHM_DIR"] + "/proc.centroider*.shm"))
-            rm(glob(os.environ["MILK_SHM_DIR"] + "/proc.slopevec*.shm"))
-            rm(glob(os.environ["MILK_SHM_DIR"] + "/processinfo.list.shm"))
+            rm(glob(shmdir + "/flux*.im.shm"))
+            rm(glob(shmdir + "/lutx*.im.shm"))
+            rm(glob(shmdir + "/luty*.im.shm"))
+            rm(glob(shmdir + "/lutslot*.im.shm"))
+            rm(glob(shmdir + "/slopemap*.im.shm"))
+            rm(glob(shmdir + "/slopevec.im.shm"))
+            rm(glob(shmdir + "/telem*.im.shm"))
+            rm(glob(shmdir + "/synctelem.im.shm"))
+            rm(glob(shmdir + "/calib*.im.shm"))
+            rm(glob(shmdir + "/proc.centroider*.shm"))
+            rm(glob(shmdir + "/proc.slopevec*.shm"))
+            rm(glob(shmdir + "/processinfo.list.shm"))
 
     def status(self):
         """Print current status of centroider"""
@@ -626,6 +973,19 @@ class CentroiderCLI():
             print(f"{fps.name}")
             print(f"    running: {fps.conf_isrunning()}")
             print(f"    confing: {fps.run_isrunning()}")
+            try:
+                telem = telemetry.read_telemetry(
+                    fps.get_param("wfsnumber"), nframes=0
+                )
+            except FileNotFoundError:
+                continue
+            print(f"    valid subaps: {telem['num_valid']:.0f}")
+            print(f"    tip/tilt: {telem['tt_x']:.3f}, {telem['tt_y']:.3f}")
+            print(f"    max flux: {telem['max_flux']:.1f}")
+            print(f"    compute time: {telem['compute_us']:.1f} us "
+                  f"({telem['nthreads']:.0f} threads)")
+            if telem["timeouts"] is not None:
+                print(f"    sync timeouts: {telem['timeouts']:d}")
 
     def wgui(self):
         """Launch centroider ui"""
@@ -716,7 +1076,152 @@ class CentroiderCLI():
 
     def recon(self):
         """Run the local reconstructor for a while"""
-        reconstructor.main()
+        parser = argparse.ArgumentParser(
+            description='run the local reconstructor',
+            )
+        mode = parser.add_mutually_exclusive_group()
+        mode.add_argument(
+            "--pipelined", action="store_true",
+            help=("reconstruct from each slopemap as it arrives, rather than "
+                  "from the synchronised slopevec"),
+        )
+        mode.add_argument(
+            "--iterative", action="store_true",
+            help=("solve each frame with preconditioned conjugate gradients "
+                  "and FFT covariance operators, without forming rcm"),
+        )
+        parser.add_argument(
+            "--refit", action="store_true",
+            help=("with --iterative, refit the cached covariance kernels "
+                  "even if the input matrices haven't changed"),
+        )
+        args = self._standard_args(parser)
+        valids = None
+        if os.path.exists(args.filename):
+            self._config_load(os.path.abspath(args.filename), apply=False)
+            valids = {
+                idx: config.valid for idx, config in self._configs.items()
+            }
+        reconstructor.main(
+            pipelined=args.pipelined, valids=valids, iterative=args.iterative,
+            refit=args.refit,
+        )
+
+    def bench(self):
+        """Benchmark the running centroider pipeline"""
+        parser = argparse.ArgumentParser(
+            description='benchmark the running centroider pipeline',
+            usage=(
+                "   cent bench [-h]"
+                " {latency,sync,threads,suite,compare,recon}"
+                " [--nframes N] [--period T] [--output FILE]"
+                " [files ...]\n\n"
+                "e.g.,\n"
+                "    cent bench latency\n"
+                "    cent bench latency -n 5000 --output latency.json\n"
+                "    cent bench sync\n"
+                "    cent bench threads\n"
+                "    cent bench suite --output new.json\n"
+                "    cent bench compare baseline.json new.json\n"
+                "    cent bench recon -n 100\n"
+            )
+        )
+        parser.add_argument(
+            "action", help="benchmark to run",
+            choices=[
+                "latency", "sync", "threads", "suite", "compare", "recon"
+            ]
+        )
+        parser.add_argument(
+            "files", nargs="*",
+            help="for `compare`, the baseline and new `suite` results",
+        )
+        parser.add_argument(
+            "--nframes", "-n", type=int, default=1000,
+            help="number of frames to inject (or, for `recon`, reconstruct)",
+        )
+        parser.add_argument(
+            "--period", type=float, default=0.01,
+            help="time between injected frames (in seconds)",
+        )
+        parser.add_argument(
+            "--output", "-o", default=None,
+            help="save results to this file (json)",
+        )
+        parser.add_argument(
+            "--quick", action="store_true",
+            help=("for `suite`, only run the smaller problem sizes, and for "
+                  "`recon`, use 16x16 rather than 32x32 subapertures"),
+        )
+        parser.add_argument(
+            "--threshold", type=float, default=0.1,
+            help=("for `compare`, fractional slowdown flagged as a "
+                  "regression"),
+        )
+        args = self._standard_args(parser)
+
+        if args.action == "latency":
+            result = latency.measure_latency(
+                self._indices, nframes=args.nframes, period=args.period,
+                quiet=(self._verbosity == 0)
+            )
+            latency.print_report(result)
+            if args.output:
+                latency.save_result(result, args.output)
+                if self._verbosity > 0:
+                    print(f"saved latency results to:\n{args.output}")
+        elif args.action == "sync":
+            result = latency.compare_sync_modes(
+                self._indices, nframes=args.nframes, period=args.period,
+                quiet=(self._verbosity == 0)
+            )
+            latency.print_sync_report(result)
+            if args.output:
+                latency.save_result(result, args.output)
+                if self._verbosity > 0:
+                    print(f"saved sync results to:\n{args.output}")
+        elif args.action == "threads":
+            result = latency.compare_nthreads(
+                self._indices, nframes=args.nframes, period=args.period,
+                quiet=(self._verbosity == 0)
+            )
+            latency.print_threads_report(result)
+            if args.output:
+                latency.save_result(result, args.output)
+                if self._verbosity > 0:
+                    print(f"saved threads results to:\n{args.output}")
+        elif args.action == "suite":
+            result = bench.run_suite(quick=args.quick)
+            if args.output:
+                bench.save_result(result, args.output)
+                if self._verbosity > 0:
+                    print(f"saved suite results to:\n{args.output}")
+        elif args.action == "compare":
+            if len(args.files) != 2:
+                print("`bench compare` needs a baseline and a new result")
+                exit(1)
+            rows = bench.compare(
+                bench.load_result(args.files[0]),
+                bench.load_result(args.files[1]),
+                threshold=args.threshold
+            )
+            bench.print_compare(rows)
+            if any(row[-1] for row in rows):
+                exit(1)
+        elif args.action == "recon":
+            result = bench.compare_recon(
+                nsub=16 if args.quick else 32, nframes=args.nframes,
+                quiet=(self._verbosity == 0)
+            )
+            bench.print_recon_report(result)
+            if args.output:
+                bench.save_result(result, args.output)
+                if self._verbosity > 0:
+                    print(f"saved recon results to:\n{args.output}")
+        else:
+            raise RuntimeError(
+                "This should be unreachable, how did you get here?"
+            )
 
 
 def main():
@@ -1,9 +1,14 @@
 #!/usr/bin/env python3
 
 import numpy as np
-from pyMilk.interfacing.fps import FPS
-from pyMilk.interfacing.shm import SHM
-from centroidertools.build_subap_lut import build_lut
+from centroidertools.backend import SHM, FPS
+from centroidertools import profiling
+from centroidertools.build_subap_lut import build_lut, build_lut_batch
+
+# geometry parameters fitted by `refine_step`, and the finite difference
+# steps used for their jacobian
+REFINE_PARAMS = ["deltax", "deltay", "theta", "pitch_x", "pitch_y"]
+REFINE_STEPS = [0.1, 0.1, 1e-3, 1e-3, 1e-3]
 
 
 def print_header():
@@ -11,23 +16,20 @@ def print_header():
           f"{'theta':10s} | {'pitchx':10s} | {'pitchy':10s}")
 
 
-def fit_config(
-    im,  # wfs raw image used to fit parameters
-    idx,  # wfs index (for table)
+def estimate_pitch(
+    im,  # wfs raw image
     *,
-    n_subx: int = 32,  # number of subaps across x-dimension
-    n_suby: int = 32,  # number of subaps across y-dimension
     min_pitch: float = 5.0,  # minimum possible pitch (in pixels) of WFS
     max_pitch: float = 8.0,  # maximum possible pitch (in pixels) of WFS
 ):
+    """estimate the subaperture pitch (x, y) from the peak of the image
+    power spectrum"""
     ts = 1.0  # sampling period in space (1 -> pixel units)
     n = 2048  # size of fft support used to find "pitch"
     f = n/ts  # frequency domain sampling rate [pixels^-1]
     min_freq = int(f/max_pitch)  # minimum frequency to search for pitch
     max_freq = int(f/min_pitch)  # maximum frequency to search for pitch
 
-    img_h, img_w = im.shape
-
     im_fft = np.abs(np.fft.fft2(im, s=[n, n]))**2
     roi = im_fft[min_freq:max_freq,
                  min_freq:max_freq]
@@ -50,56 +52,90 @@ def fit_config(
     freq_y += min_freq
     pitch_x = f/freq_x  # estimated pitch in x [pixels]
     pitch_y = f/freq_y  # estimated pitch in y [pixels]
+    return pitch_x, pitch_y
 
-    def build_grid(deltax, deltay, theta):
-        xx_c, yy_c, xx_0, yy_0 = build_lut(
-            n_subx=n_subx,
-            n_suby=n_suby,
-            pitch_x=pitch_x,
-            pitch_y=pitch_y,
-            theta=theta,
-            deltax=deltax,
-            deltay=deltay,
-            img_w=img_w,
-            img_h=img_h,
-            fov_x=1,  # not relevant, since we ignore xx_0, yy_0
-            fov_y=1,  # not relevant, since we ignore yy_0
-            unsafe=True  # we shouldn't be accessing invalid pixels, so raise
-                         # an error if we do
-        )
-        return xx_c, yy_c
-
-    sigma = 6.9/2
-    # for the first round, do single pixel bins and roll the masking array
-    x_range = int(img_w - pitch_x*n_subx)
-    y_range = int(img_h - pitch_y*n_suby)
 
-    deltaxs, deltays = np.meshgrid(
-        np.arange(-x_range//2, x_range//2+1),
-        np.arange(-y_range//2, y_range//2+1),
-        indexing="ij"
+def build_mask(*, n_subx: int, n_suby: int, pitch_x: float, pitch_y: float,
+               theta: float, img_w: int, img_h: int, sigma: float = 6.9/2):
+    """mask that is ~0 on the (centred) subaperture spots and ~1 between
+    them, for `search_shift`"""
+    xx_c, yy_c, _, _ = build_lut(
+        n_subx=n_subx,
+        n_suby=n_suby,
+        pitch_x=pitch_x,
+        pitch_y=pitch_y,
+        theta=theta,
+        deltax=0,
+        deltay=0,
+        img_w=img_w,
+        img_h=img_h,
+        fov_x=1,  # not relevant, since we ignore xx_0, yy_0
+        fov_y=1,  # not relevant, since we ignore yy_0
+        unsafe=True  # we shouldn't be accessing invalid pixels, so raise
+                     # an error if we do
     )
-    deltaxs = deltaxs.flatten()
-    deltays = deltays.flatten()
-    theta = 0.0
-    best_cost = np.inf
     # Pixel coordinates used to build Gaussian
     xx, yy = np.meshgrid(
         np.arange(img_w),
         np.arange(img_h),
         indexing="xy"
     )
-    xx_c, yy_c = build_grid(0, 0, theta)
     # this is pretty expensive to build but we only do it once per WFS.
-    im_mask = np.zeros_like(im)
+    im_mask = np.zeros((img_h, img_w))
     for xc, yc in zip(xx_c, yy_c):
         im_mask += np.exp(-((xx-xc)**2+(yy-yc)**2)/((sigma)**2))
-    im_mask = 1 - im_mask
+    return 1 - im_mask
+
+
+def search_shift(im, im_mask, *, x_range: int, y_range: int):
+    """find the whole pixel shift (deltax, deltay) of the mask that puts the
+    least light between the spots"""
+    # for the first round, do single pixel bins and roll the masking array
+    deltaxs, deltays = np.meshgrid(
+        np.arange(-x_range//2, x_range//2+1),
+        np.arange(-y_range//2, y_range//2+1),
+        indexing="ij"
+    )
+    deltaxs = deltaxs.flatten()
+    deltays = deltays.flatten()
+    best_cost = np.inf
     for deltax, deltay in zip(deltaxs, deltays):
         cost = (im * np.roll(im_mask, [deltay, deltax], [0, 1])).sum()
         if cost < best_cost:
             best_cost = cost
-            deltax_best, deltay_best, theta_best = deltax, deltay, theta
+            deltax_best, deltay_best = deltax, deltay
+    return deltax_best, deltay_best
+
+
+def fit_config(
+    im,  # wfs raw image used to fit parameters
+    idx,  # wfs index (for table)
+    *,
+    n_subx: int = 32,  # number of subaps across x-dimension
+    n_suby: int = 32,  # number of subaps across y-dimension
+    min_pitch: float = 5.0,  # minimum possible pitch (in pixels) of WFS
+    max_pitch: float = 8.0,  # maximum possible pitch (in pixels) of WFS
+):
+    img_h, img_w = im.shape
+
+    with profiling.phase("pitch fft"):
+        pitch_x, pitch_y = estimate_pitch(
+            im, min_pitch=min_pitch, max_pitch=max_pitch
+        )
+
+    theta = 0.0
+    with profiling.phase("mask build"):
+        im_mask = build_mask(
+            n_subx=n_subx, n_suby=n_suby, pitch_x=pitch_x, pitch_y=pitch_y,
+            theta=theta, img_w=img_w, img_h=img_h
+        )
+    with profiling.phase("shift search"):
+        deltax_best, deltay_best = search_shift(
+            im, im_mask,
+            x_range=int(img_w - pitch_x*n_subx),
+            y_range=int(img_h - pitch_y*n_suby)
+        )
+    theta_best = theta
     print(f"{idx:10d} | {deltax_best:10.5f} | {deltay_best:10.5f} | "
           f"{theta_best:10.5f} | {pitch_x:10.3f} | {pitch_y:10.3f}")
 
@@ -187,3 +223,77 @@ def estimate_thresh(idx, box_size=2, nframes=1):
     ], axis=0)
 
     return samples.mean(), samples.std()
+
+
+def mean_slopes(idx, nframes=1, after=None):
+    """mean slopemap and flux map of the next `nframes` frames of WFS idx.
+
+    If `after` (a slopemap counter, read after a LUT flip) is given, the
+    frame after it is skipped too, since it may have started (and read the
+    LUT slot) before the flip.
+    """
+    slopemap_shm = SHM(f"slopemap{idx:01d}")
+    flux_shm = SHM(f"flux{idx:01d}")
+    data = []
+    while len(data) < nframes:
+        # the next frame is counter+1 or later, so it's safe if counter+1
+        # is past after+1
+        fresh = after is None or slopemap_shm.get_counter() > after
+        slopemap = slopemap_shm.get_data(check=True)
+        if fresh:
+            data.append((slopemap, flux_shm.get_data()))
+    slopemap = np.mean([d[0] for d in data], axis=0)
+    fluxmap = np.mean([d[1] for d in data], axis=0)
+    return slopemap, fluxmap
+
+
+def lut_jacobian(*, n_subx, n_suby, img_w, img_h, **geometry):
+    """jacobian of the LUT centres w.r.t. REFINE_PARAMS, by central
+    differences of `build_lut_batch` (for all parameters in one call).
+    Returns:
+        ((2*n_subx*n_suby, len(REFINE_PARAMS)), float) : rows are the x
+            centres followed by the y centres, as in the slopemap
+    """
+    steps = np.array(REFINE_STEPS)
+    offsets = np.concatenate([np.diag(steps), -np.diag(steps)])
+    xx_c, yy_c, _, _, _ = build_lut_batch(
+        n_subx=n_subx, n_suby=n_suby, img_w=img_w, img_h=img_h,
+        fov_x=1, fov_y=1,  # not relevant, we only use the centres
+        **{
+            param: geometry[param] + offsets[:, i]
+            for i, param in enumerate(REFINE_PARAMS)
+        }
+    )
+    centres = np.concatenate([xx_c, yy_c], axis=1)
+    nparams = len(REFINE_PARAMS)
+    return ((centres[:nparams] - centres[nparams:])/(2*steps[:, None])).T
+
+
+def refine_step(slopemap, fluxmap, *, flux_thresh=0.5, **geometry):
+    """least-squares update of the geometry from a measured slope field.
+
+    The slopes are the offsets of the spots from the LUT centres, so for
+    small errors in the geometry:
+        slopes ~= J @ (params_true - params)
+    with J the jacobian of the LUT centres (see `lut_jacobian`), which is
+    solved over the subapertures with flux above `flux_thresh` of the max.
+
+    Returns:
+        dict of update to add to each of REFINE_PARAMS,
+        rms of the slopes used (pixels),
+        rms of the slopes left unexplained by the update (pixels)
+    """
+    valid = np.tile(fluxmap.ravel() >= flux_thresh*fluxmap.max(), 2)
+    jac = lut_jacobian(**geometry)[valid]
+    slopes = slopemap.ravel()[valid]
+    # normalise the columns, since shifts, rotation and pitch have very
+    # different scales
+    scale = np.linalg.norm(jac, axis=0)
+    update, _, _, _ = np.linalg.lstsq(jac/scale, slopes, rcond=None)
+    update /= scale
+    residual = slopes - jac @ update
+    return (
+        dict(zip(REFINE_PARAMS, update.tolist())),
+        float(np.sqrt(np.mean(slopes**2))),
+        float(np.sqrt(np.mean(residual**2))),
+    )
@@ -0,0 +1,482 @@
+#!/usr/bin/env python3
+"""End-to-end latency harness for the centroider pipeline.
+
+Frames are injected into `scmos{idx}_data` at a fixed pace, and listeners
+block on each downstream stream (`slopemap{idx}`, `slopevec`, `recon_phi`),
+recording the arrival time and stream counter of every update. Slopemaps
+are matched back to the injection that produced them using the stream
+counter as a frame stamp (the n-th update after the start of the run belongs
+to the n-th injected frame), which is robust to latencies longer than the
+pacing period. Downstream of the sync, which may publish more than once per
+frame, each frame is matched to the first update after its inputs arrived.
+`recon_phi` is matched to the last slopemap of each frame rather than to
+`slopevec`, since the pipelined reconstructor (`cent recon --pipelined`)
+doesn't wait for `slopevec`, so the reconstruct stage covers everything
+after the last centroid (including the sync, if any). The camera (or replay
+buffer) must be stopped while this runs, otherwise its frames will be
+interleaved with the injected ones.
+"""
+
+import glob
+import json
+import math
+import os
+import socket
+import threading
+import time
+import numpy as np
+from centroidertools import backend
+from centroidertools.backend import SHM, FPS
+from centroidertools.telemetry import TELEM_FIELDS, SYNCTELEM_WAITMODE
+
+
+PERCENTILES = [50, 90, 99, 99.9]
+# how long to wait for a run loop to stop or start, or for a restart to take
+# effect (seconds)
+RESTART_TIMEOUT = 5.0
+
+
+class StreamListener(threading.Thread):
+    """Record (time, counter) for every update of a stream, and optionally
+    the data of every update (in `data`)"""
+
+    def __init__(self, name, keep_data=False):
+        super().__init__(daemon=True)
+        self.name = name
+        self.shm = SHM(name)
+        self.cnt0 = self.shm.get_counter()
+        self.events = []
+        self.data = []
+        self._keep_data = keep_data
+        self._running = True
+
+    def run(self):
+        while self._running:
+            data = self.shm.get_data(check=True)
+            self.events.append((time.perf_counter(), self.shm.get_counter()))
+            if self._keep_data:
+                self.data.append(data.copy())
+
+    def stop(self):
+        self._running = False
+
+    def arrivals_by_counter(self, t_inject):
+        """map each injected frame to the arrival time of its output, using
+        the stream counter as the frame stamp. Only valid for streams that
+        are updated exactly once per input frame (e.g., `slopemap{idx}`).
+
+        Returns an array the same length as `t_inject`, with NaN for frames
+        that were never observed on this stream (or whose stamp couldn't be
+        matched consistently).
+        """
+        t_out = np.full(len(t_inject), np.nan)
+        for t, cnt in self.events:
+            k = cnt - self.cnt0 - 1
+            if k < 0 or k >= len(t_inject):
+                continue
+            if t < t_inject[k] or not np.isnan(t_out[k]):
+                continue
+            t_out[k] = t
+        return t_out
+
+    def arrivals_after(self, t_upstream):
+        """map each frame to the first update of this stream at or after the
+        frame arrived upstream. Used for stages that may publish more than
+        once per frame (e.g., `slopevec` after a sync timeout).
+        """
+        t_events = np.array([t for t, _ in self.events] + [np.inf])
+        k = np.searchsorted(t_events, np.nan_to_num(t_upstream, nan=np.inf))
+        t_out = t_events[k]
+        t_out[~np.isfinite(t_out)] = np.nan
+        return t_out
+
+
+class StepTimer():
+    """Histograms of the time spent in each phase of a loop, cheap enough to
+    record every step of a real-time loop (durations are passed positionally,
+    in the order of `phases`, into counters allocated up front, with one log
+    per phase) and summarised as percentiles on request, e.g.:
+
+        timer = StepTimer(["wait", "compute"])
+        while True:
+            ...
+            timer.record(t1-t0, t2-t1)
+        timer.print_report()
+
+    Bins are logarithmic (`bins_per_decade`), so percentiles are reported as
+    the upper edge of their bin (about 12% resolution by default).
+    """
+
+    def __init__(self, phases, *, t_min=1e-6, t_max=10.0,
+                 bins_per_decade=20):
+        self.phases = list(phases)
+        self._t_min = t_min
+        self._scale = bins_per_decade/math.log(10)
+        self._nbins = int(math.ceil(
+            math.log10(t_max/t_min)*bins_per_decade
+        )) + 1
+        self.edges = t_min*10**(np.arange(1, self._nbins+1)/bins_per_decade)
+        self.reset()
+
+    def reset(self):
+        self.n = 0
+        self.counts = [[0]*self._nbins for _ in self.phases]
+        self.total = [0.0]*len(self.phases)
+        self.max = [0.0]*len(self.phases)
+
+    def record(self, *durations):
+        """record the duration (seconds) of each phase of one step, in the
+        order of `phases`"""
+        for i, dt in enumerate(durations):
+            k = 0
+            if dt > self._t_min:
+                k = min(int(math.log(dt/self._t_min)*self._scale),
+                        self._nbins-1)
+            self.counts[i][k] += 1
+            self.total[i] += dt
+            if dt > self.max[i]:
+                self.max[i] = dt
+        self.n += 1
+
+    def summary(self):
+        """per-phase summaries, in the same format as `summarise` (us)"""
+        result = {}
+        for i, phase in enumerate(self.phases):
+            counts = np.array(self.counts[i])
+            n = int(counts.sum())
+            if n == 0:
+                result[phase] = {"n": 0}
+                continue
+            cumulative = np.cumsum(counts)/n
+            result[phase] = {
+                "n": n,
+                "mean": 1e6*self.total[i]/n,
+                "max": 1e6*self.max[i],
+            }
+            for p in PERCENTILES:
+                k = np.searchsorted(cumulative, p/100)
+                result[phase][f"p{p:g}"] = float(
+                    1e6*min(self.edges[k], self.max[i])
+                )
+        return result
+
+    def print_report(self):
+        print_report({"stages": self.summary()})
+
+
+def summarise(latencies):
+    """percentiles etc. of a latency array (seconds), reported in us"""
+    latencies = latencies[~np.isnan(latencies)]*1e6
+    if len(latencies) == 0:
+        return {"n": 0}
+    summary = {
+        "n": int(len(latencies)),
+        "mean": float(latencies.mean()),
+        "min": float(latencies.min()),
+        "max": float(latencies.max()),
+    }
+    for p in PERCENTILES:
+        summary[f"p{p:g}"] = float(np.percentile(latencies, p))
+    return summary
+
+
+def measure_latency(indices, *, nframes=1000, period=0.01, recon=True,
+                    quiet=False):
+    """inject `nframes` frames into each WFS and time the downstream streams
+
+    The frame injected is a snapshot of whatever currently sits in each
+    `scmos{idx}_data`, so the centroider sees realistic data.
+
+    Returns a dict of per-stage latency summaries (microseconds).
+    """
+    inputs = {idx: SHM(f"scmos{idx:01d}_data") for idx in indices}
+    frames = {idx: shm.get_data() for idx, shm in inputs.items()}
+
+    listeners = {
+        f"slopemap{idx:01d}": StreamListener(f"slopemap{idx:01d}")
+        for idx in indices
+    }
+    listeners["slopevec"] = StreamListener("slopevec")
+    if recon:
+        try:
+            listeners["recon_phi"] = StreamListener("recon_phi")
+        except FileNotFoundError:
+            if not quiet:
+                print("recon_phi doesn't exist, skipping reconstruct stage")
+    for listener in listeners.values():
+        listener.start()
+    # give the listeners a chance to block on their semaphores
+    time.sleep(0.1)
+
+    t_inject = np.zeros(nframes)
+    t_next = time.perf_counter()
+    for k in range(nframes):
+        while time.perf_counter() < t_next:
+            pass
+        t_inject[k] = time.perf_counter()
+        for idx, shm in inputs.items():
+            shm.set_data(frames[idx])
+        t_next = t_inject[k] + period
+    # let the last frames drain through the pipeline
+    time.sleep(max(10*period, 0.2))
+    for listener in listeners.values():
+        listener.stop()
+
+    arrivals = {
+        f"slopemap{idx:01d}":
+            listeners[f"slopemap{idx:01d}"].arrivals_by_counter(t_inject)
+        for idx in indices
+    }
+    # time at which the last WFS of each frame landed (NaN if any missing)
+    t_centroided = np.max(np.stack([
+        arrivals[f"slopemap{idx:01d}"] for idx in indices
+    ], axis=0), axis=0)
+    arrivals["slopevec"] = listeners["slopevec"].arrivals_after(t_centroided)
+    if "recon_phi" in listeners:
+        arrivals["recon_phi"] = listeners["recon_phi"].arrivals_after(
+            t_centroided
+        )
+
+    stages = {}
+    for idx in indices:
+        stages[f"centroid{idx:01d}"] = summarise(
+            arrivals[f"slopemap{idx:01d}"] - t_inject
+        )
+    stages["centroid"] = summarise(t_centroided - t_inject)
+    stages["sync"] = summarise(arrivals["slopevec"] - t_centroided)
+    stages["slopevec"] = summarise(arrivals["slopevec"] - t_inject)
+    if "recon_phi" in arrivals:
+        stages["reconstruct"] = summarise(
+            arrivals["recon_phi"] - t_centroided
+        )
+        stages["end_to_end"] = summarise(arrivals["recon_phi"] - t_inject)
+
+    return {
+        "meta": {
+            "host": socket.gethostname(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "indices": list(indices),
+            "nframes": nframes,
+            "period": period,
+            "units": "us",
+        },
+        "stages": stages,
+    }
+
+
+def print_report(result):
+    stats = ["n", "mean"] + [f"p{p:g}" for p in PERCENTILES] + ["max"]
+    print(f"{'stage':12s} | " + " | ".join(f"{s:>9s}" for s in stats))
+    for stage, summary in result["stages"].items():
+        if summary["n"] == 0:
+            print(f"{stage:12s} | {'no data':>9s}")
+            continue
+        print(f"{stage:12s} | " + " | ".join(
+            f"{summary[s]:9d}" if s == "n" else f"{summary[s]:9.1f}"
+            for s in stats
+        ))
+
+
+def save_result(result, filename):
+    with open(filename, "w") as f:
+        json.dump(result, f, indent=2)
+
+
+def find_pid(name):
+    """process id of the running milk process `name` (e.g., "slopevec"),
+    from its processinfo stream"""
+    if backend.LOCAL:
+        return FPS(name).pid()
+    procs = glob.glob(os.path.join(backend.SHM_DIR, f"proc.{name}.*.shm"))
+    if len(procs) == 0:
+        raise FileNotFoundError(f"no processinfo found for {name}")
+    latest = max(procs, key=os.path.getmtime)
+    return int(os.path.basename(latest).split(".")[2])
+
+
+def cpu_time(pid):
+    """user+system CPU time (in seconds) used so far by process `pid`"""
+    with open(f"/proc/{pid}/stat") as f:
+        # the command name may contain spaces, so split after it
+        fields = f.read().rsplit(")", 1)[1].split()
+    utime, stime = int(fields[11]), int(fields[12])
+    return (utime + stime)/os.sysconf("SC_CLK_TCK")
+
+
+def _wait_until(condition, message, timeout=RESTART_TIMEOUT):
+    """poll `condition` until it's true, raising TimeoutError(message) if it
+    isn't within `timeout` seconds"""
+    t0 = time.perf_counter()
+    while not condition():
+        if time.perf_counter() - t0 > timeout:
+            raise TimeoutError(f"{message} within {timeout} s")
+        time.sleep(0.01)
+
+
+def restart(name, fps, params, timeout=RESTART_TIMEOUT):
+    """stop the run loop of `fps` (the FPS `name`), set `params` (a dict)
+    and start it again, waiting (for up to `timeout` seconds each) for the
+    loop to stop, the params to be set and the loop to start"""
+    def stopped():
+        if fps.run_isrunning():
+            fps.run_stop()
+            return False
+        return True
+
+    def started():
+        if not fps.run_isrunning():
+            fps.run_start()
+            return False
+        return True
+
+    def param_set(key, value):
+        if fps.get_param(key) != value:
+            fps.set_param(key, value)
+            return False
+        return True
+
+    _wait_until(stopped, f"{name} didn't stop", timeout)
+    for key, value in params.items():
+        _wait_until(
+            lambda: param_set(key, value),
+            f"{name} didn't take {key}={value}", timeout
+        )
+    _wait_until(started, f"{name} didn't start", timeout)
+
+
+def _restart_slopevec(fps, waitmode):
+    """restart slopevec in `waitmode`, and wait for it to report (in
+    synctelem, at run start) that it's using it"""
+    synctelem = SHM("synctelem")
+    cnt = synctelem.get_counter()
+    restart("slopevec", fps, {"waitmode": waitmode})
+    _wait_until(
+        lambda: synctelem.get_counter() > cnt and int(
+            synctelem.get_data().flatten()[SYNCTELEM_WAITMODE]
+        ) == waitmode,
+        f"slopevec didn't report waitmode {waitmode}"
+    )
+
+
+def compare_sync_modes(indices, *, nframes=1000, period=0.01, quiet=False):
+    """measure the sync latency and the CPU used by slopevec in each of its
+    wait modes (0: busy poll, 1: block on the slopemaps)
+
+    `waitmode` is only read when the run loop starts, so slopevec is
+    restarted for each mode (waiting until it reports the new mode), and
+    left in its original mode afterwards.
+
+    Returns a dict of per-mode results, with the sync stage summary and the
+    slopevec CPU time per injected frame (microseconds).
+    """
+    fps = FPS("slopevec")
+    pid = find_pid("slopevec")
+    waitmode_orig = fps.get_param("waitmode")
+    result = {"meta": None, "modes": {}}
+    try:
+        for waitmode in [0, 1]:
+            _restart_slopevec(fps, waitmode)
+            cpu_start = cpu_time(pid)
+            measured = measure_latency(
+                indices, nframes=nframes, period=period, recon=False,
+                quiet=quiet
+            )
+            cpu = cpu_time(pid) - cpu_start
+            result["meta"] = measured["meta"]
+            result["modes"][waitmode] = {
+                "sync": measured["stages"]["sync"],
+                "slopevec": measured["stages"]["slopevec"],
+                "cpu_per_frame": 1e6*cpu/nframes,
+            }
+    finally:
+        _restart_slopevec(fps, waitmode_orig)
+    return result
+
+
+def print_sync_report(result):
+    names = {0: "poll", 1: "block"}
+    print(f"{'waitmode':10s} | {'cpu/frame':>9s} | {'sync p50':>9s} | "
+          f"{'sync p99':>9s} | {'sync max':>9s}")
+    for waitmode, summary in result["modes"].items():
+        sync = summary["sync"]
+        if sync["n"] == 0:
+            print(f"{names[waitmode]:10s} | {'no data':>9s}")
+            continue
+        print(f"{names[waitmode]:10s} | {summary['cpu_per_frame']:9.1f} | "
+              f"{sync['p50']:9.1f} | {sync['p99']:9.1f} | "
+              f"{sync['max']:9.1f}")
+
+
+def compare_nthreads(indices, *, nthreads=(1, 2, 4), nframes=1000,
+                     period=0.01, quiet=False):
+    """measure the per-frame compute time of the centroiders (as reported in
+    their telemetry) and the centroid latency, for each thread count
+
+    `nthreads` is only read when the run loop starts, so the centroiders are
+    restarted for each setting (waiting for them to stop and start), and
+    left at their original one afterwards. The pool size each frame was
+    computed with is read back from the telemetry, and a RuntimeError is
+    raised if it isn't the requested one.
+
+    Returns a dict of per-thread-count results, with the summaries of the
+    compute time and centroid latency (microseconds).
+    """
+    names = [f"centroider{idx:01d}" for idx in indices]
+    fps_list = [FPS(name) for name in names]
+    nthreads_orig = [fps.get_param("nthreads") for fps in fps_list]
+    compute_idx = TELEM_FIELDS.index("compute_us")
+    nthreads_idx = TELEM_FIELDS.index("nthreads")
+    result = {"meta": None, "nthreads": {}}
+    try:
+        for n in nthreads:
+            for name, fps in zip(names, fps_list):
+                restart(name, fps, {"nthreads": n})
+            listeners = [
+                StreamListener(f"telem{idx:01d}", keep_data=True)
+                for idx in indices
+            ]
+            for listener in listeners:
+                listener.start()
+            measured = measure_latency(
+                indices, nframes=nframes, period=period, recon=False,
+                quiet=quiet
+            )
+            for listener in listeners:
+                listener.stop()
+            for name, listener in zip(names, listeners):
+                pool = {int(data.flatten()[nthreads_idx])
+                        for data in listener.data}
+                if pool - {n}:
+                    raise RuntimeError(
+                        f"{name} computed frames with {sorted(pool)} "
+                        f"threads, rather than {n}"
+                    )
+            compute_us = np.concatenate([
+                [data.flatten()[compute_idx] for data in listener.data]
+                for listener in listeners
+            ])
+            result["meta"] = measured["meta"]
+            result["nthreads"][n] = {
+                # summarise takes seconds
+                "compute": summarise(compute_us*1e-6),
+                "centroid": measured["stages"]["centroid"],
+            }
+    finally:
+        for name, fps, n in zip(names, fps_list, nthreads_orig):
+            restart(name, fps, {"nthreads": n})
+    return result
+
+
+def print_threads_report(result):
+    print(f"{'nthreads':10s} | {'compute':>9s} | {'compute':>9s} | "
+          f"{'centroid':>9s} | {'centroid':>9s}")
+    print(f"{'':10s} | {'p50':>9s} | {'p99':>9s} | {'p50':>9s} | "
+          f"{'p99':>9s}")
+    for n, summary in result["nthreads"].items():
+        compute = summary["compute"]
+        centroid = summary["centroid"]
+        if compute["n"] == 0 or centroid["n"] == 0:
+            print(f"{n:<10d} | {'no data':>9s}")
+            continue
+        print(f"{n:<10d} | {compute['p50']:9.1f} | {compute['p99']:9.1f} | "
+              f"{centroid['p50']:9.1f} | {centroid['p99']:9.1f}")
@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+"""Stand-in for the subset of the pyMilk `SHM` and `FPS` API used by the
+centroidertools, built on plain `mmap`'d files so that the tools can be run
+(and profiled) on a machine without milk.
+
+Streams are stored as `<name>.im.shm` in `SHM_DIR`, with a small header
+holding the dtype, shape, a frame counter (`cnt0`) and a write sequence
+number used to detect torn reads. FPSs are stored as `<name>.fps.shm`
+files holding the parameters and the conf/run states as json, which are
+updated under an exclusive `flock` of the file, since several processes
+(e.g., the CLI and the running centroider) update them concurrently.
+
+Select it with `CENT_BACKEND=local` (see `centroidertools.backend`).
+"""
+
+import contextlib
+import fcntl
+import json
+import mmap
+import os
+import struct
+import time
+import numpy as np
+
+SHM_DIR = os.environ.get("CENT_LOCAL_SHM_DIR", "/tmp/cent_local_shm")
+
+# magic, ndim, cnt0, wseq, dtype, shape[4]
+_HEADER = struct.Struct("<4sIQQ8s4Q")
+_HEADER_SIZE = 128
+_MAGIC = b"CSHM"
+_CNT0_OFFSET = 8
+_WSEQ_OFFSET = 16
+
+# magic, padding, generation (incremented around every write, like wseq)
+_FPS_HEADER = struct.Struct("<4sIQ")
+_FPS_MAGIC = b"CFPS"
+_GEN_OFFSET = 8
+_FPS_SIZE = 65536
+
+
+def _shm_path(name):
+    return os.path.join(SHM_DIR, f"{name}.im.shm")
+
+
+def _fps_path(name):
+    return os.path.join(SHM_DIR, f"{name}.fps.shm")
+
+
+class SHM():
+    """Shared memory stream, mirroring pyMilk's `SHM`:
+
+        SHM(name)                  # connect to existing, or FileNotFoundError
+        SHM(name, data)            # create (or overwrite) from ndarray
+        SHM(name, (shape, dtype))  # create (or overwrite) zeroed
+    """
+
+    def __init__(self, name, data=None):
+        self.name = name
+        self.path = _shm_path(name)
+        if data is not None:
+            if isinstance(data, tuple):
+                shape, dtype = data
+                data = np.zeros(shape, dtype=dtype)
+            self._create(np.asarray(data))
+        self._open()
+
+    def _create(self, data):
+        os.makedirs(SHM_DIR, exist_ok=True)
+        if data.ndim > 4:
+            raise ValueError(f"{data.ndim=}, only up to 4 dims supported")
+        shape = list(data.shape) + [0]*(4-data.ndim)
+        header = _HEADER.pack(
+            _MAGIC, data.ndim, 0, 0, data.dtype.str.encode(), *shape
+        )
+        # write to a temporary file then move it into place, so that readers
+        # never see a partially created stream
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(header.ljust(_HEADER_SIZE, b"\0"))
+            f.write(np.ascontiguousarray(data).tobytes())
+        os.replace(tmp_path, self.path)
+
+    def _open(self):
+        with open(self.path, "r+b") as f:
+            self._mm = mmap.mmap(f.fileno(), 0)
+        magic, ndim, _, _, dtype, *shape = _HEADER.unpack_from(self._mm, 0)
+        if magic != _MAGIC:
+            raise RuntimeError(f"{self.path} is not a local shm stream")
+        self.shape = tuple(shape[:ndim])
+        self.dtype = np.dtype(dtype.rstrip(b"\0").decode())
+        self._cnt0 = np.frombuffer(self._mm, np.uint64, 1, _CNT0_OFFSET)
+        self._wseq = np.frombuffer(self._mm, np.uint64, 1, _WSEQ_OFFSET)
+        self._data = np.frombuffer(
+            self._mm, self.dtype, int(np.prod(self.shape)), _HEADER_SIZE
+        ).reshape(self.shape)
+        self._last_cnt = self.get_counter()
+
+    def get_counter(self) -> int:
+        return int(self._cnt0[0])
+
+    def wait(self, timeout=None, sleep_t=20e-6) -> bool:
+        """block until the stream has been written to since this handle last
+        read it. Returns False on timeout."""
+        t0 = time.perf_counter()
+        while self._cnt0[0] == self._last_cnt:
+            if timeout is not None and time.perf_counter()-t0 > timeout:
+                return False
+            time.sleep(sleep_t)
+        return True
+
+    def get_data(self, check=False, *, timeout=None, out=None, copy=True):
+        """read the stream. If `check`, block until there's a new frame.
+
+        `out` can be a preallocated array to read into, to avoid allocating a
+        new array every frame. With `copy=False`, the shared buffer itself is
+        returned (as in pyMilk), which may be overwritten while in use.
+        """
+        if check:
+            self.wait(timeout=timeout)
+        if not copy:
+            self._last_cnt = self.get_counter()
+            return self._data
+        if out is None:
+            out = np.empty(self.shape, dtype=self.dtype)
+        while True:
+            wseq = self._wseq[0]
+            if wseq % 2 == 1:
+                # writer is midway through
+                continue
+            cnt = self._cnt0[0]
+            np.copyto(out, self._data, casting="unsafe")
+            if self._wseq[0] == wseq:
+                break
+        self._last_cnt = int(cnt)
+        return out
+
+    def set_data(self, data):
+        self._wseq[0] += 1
+        np.copyto(self._data, np.reshape(data, self.shape), casting="unsafe")
+        self._wseq[0] += 1
+        self._cnt0[0] += 1
+
+
+class FPS():
+    """Function parameter structure, mirroring pyMilk's `FPS`
+
+    `FPS(name)` connects to an existing FPS (RuntimeError if it doesn't
+    exist), `FPS.create(name, params)` creates one.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.path = _fps_path(name)
+        if not os.path.exists(self.path):
+            raise RuntimeError(f"FPS {name} doesn't exist")
+        with open(self.path, "r+b") as f:
+            self._mm = mmap.mmap(f.fileno(), 0)
+        # held open for `_locked`
+        self._lock_file = open(self.path, "rb")
+        if _FPS_HEADER.unpack_from(self._mm, 0)[0] != _FPS_MAGIC:
+            raise RuntimeError(f"{self.path} is not a local FPS")
+        self._gen = np.frombuffer(self._mm, np.uint64, 1, _GEN_OFFSET)
+        self._cached_gen = None
+        self._state = None
+
+    @classmethod
+    def create(cls, name, params):
+        os.makedirs(SHM_DIR, exist_ok=True)
+        path = _fps_path(name)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(_FPS_HEADER.pack(_FPS_MAGIC, 0, 0))
+            f.write(b"\0"*_FPS_SIZE)
+        os.replace(tmp_path, path)
+        fps = cls(name)
+        fps._write({
+            "params": params,
+            "conf_running": False,
+            "run_running": False,
+            "pid": os.getpid(),
+        })
+        return fps
+
+    def _read(self):
+        """return the FPS state, only re-parsing it if it has changed"""
+        while True:
+            gen = int(self._gen[0])
+            if gen % 2 == 1:
+                # writer is midway through
+                continue
+            if gen == self._cached_gen:
+                return self._state
+            length, = struct.unpack_from("<I", self._mm, _FPS_HEADER.size)
+            start = _FPS_HEADER.size + 4
+            raw = self._mm[start:start+length]
+            if int(self._gen[0]) == gen:
+                break
+        self._state = json.loads(raw)
+        self._cached_gen = gen
+        return self._state
+
+    def _write(self, state):
+        raw = json.dumps(state).encode()
+        if len(raw) > _FPS_SIZE - 4:
+            raise ValueError(f"FPS {self.name} state too large")
+        self._gen[0] += 1
+        struct.pack_into("<I", self._mm, _FPS_HEADER.size, len(raw))
+        start = _FPS_HEADER.size + 4
+        self._mm[start:start+len(raw)] = raw
+        self._gen[0] += 1
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """hold an exclusive lock on the FPS file, so that read-modify-write
+        updates from different processes can't drop each other"""
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _update(self, key, value):
+        with self._locked():
+            state = dict(self._read())
+            state[key] = value
+            self._write(state)
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def get_param(self, key):
+        return self._read()["params"][key]
+
+    def get_params(self) -> dict:
+        return dict(self._read()["params"])
+
+    def set_param(self, key, value):
+        with self._locked():
+            state = dict(self._read())
+            state["params"] = dict(state["params"], **{key: value})
+            self._write(state)
+
+    def pid(self) -> int:
+        """process id of the process that created the FPS"""
+        return self._read()["pid"]
+
+    def conf_isrunning(self) -> bool:
+        # a deleted FPS can't be running
+        return self._read()["conf_running"] and self.exists()
+
+    def run_isrunning(self) -> bool:
+        return self._read()["run_running"]
+
+    def conf_start(self):
+        self._update("conf_running", True)
+
+    def conf_stop(self):
+        self._update("conf_running", False)
+
+    def run_start(self):
+        with self._locked():
+            state = dict(self._read())
+            if not state["run_running"]:
+                state["run_starts"] = state.get("run_starts", 0) + 1
+            state["run_running"] = True
+            self._write(state)
+
+    def run_starts(self) -> int:
+        """number of times the run loop has been started (not in pyMilk).
+        The Python processes use it to notice a stop and start between two
+        polls, to re-read the params that milk only reads at run start"""
+        return self._read().get("run_starts", 0)
+
+    def run_stop(self):
+        self._update("run_running", False)
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""Double-buffered subaperture LUTs, so that geometry updates (e.g., from
+`cent config fit` or `cent config watch`) apply between two frames without
+stopping the centroider.
+
+`lutx{idx}`/`luty{idx}` hold two LUT slots (shape (2, nsub)), and
+`lutslot{idx}` holds the index of the slot the centroider reads from. A
+writer fills the inactive slot and then flips `lutslot{idx}`, and the
+centroider reads the slot index once at the start of each frame, so every
+frame sees one complete LUT. A single slot LUT (shape (nsub,)), as written
+by older versions of these tools, is read as slot 0.
+
+Changing the layout (the number of subapertures, or from a single slot LUT)
+recreates the streams, which the centroider can't do safely under a running
+loop, so `write_lut` refuses to unless told that it's stopped.
+
+The same protocol is implemented in ltaomod_centroider/centroider.c.
+"""
+
+import time
+import numpy as np
+from centroidertools.backend import SHM
+
+NSLOTS = 2
+
+
+def _connect(name):
+    try:
+        return SHM(name)
+    except FileNotFoundError:
+        return None
+
+
+def active_slot(lut, lutslot) -> int:
+    """index of the slot of `lut` (data of lutx/luty) currently in use,
+    given the data of lutslot (or None if it doesn't exist)"""
+    if lut.ndim != 2 or lut.shape[0] != NSLOTS or lutslot is None:
+        return 0
+    return int(lutslot.ravel()[0] != 0)
+
+
+def active_lut(lut, lutslot):
+    """the active slot of `lut` (data of lutx/luty), of shape (nsub,)"""
+    if lut.ndim != 2 or lut.shape[0] != NSLOTS:
+        return lut.ravel()
+    return lut[active_slot(lut, lutslot)]
+
+
+def read_lut(idx):
+    """the active (lutx, luty) of WFS idx, each of shape (nsub,)"""
+    lutslot = _connect(f"lutslot{idx:01d}")
+    slot_data = None if lutslot is None else lutslot.get_data()
+    return tuple(
+        active_lut(SHM(name).get_data(), slot_data)
+        for name in [f"lutx{idx:01d}", f"luty{idx:01d}"]
+    )
+
+
+def relayout_needed(idx, nsub) -> bool:
+    """whether writing a LUT of `nsub` subapertures for WFS idx would
+    recreate existing lutx/luty streams (of another layout)"""
+    shape = (NSLOTS, nsub)
+    for name in [f"lutx{idx:01d}", f"luty{idx:01d}"]:
+        shm = _connect(name)
+        if shm is not None and tuple(shm.shape) != shape:
+            return True
+    return False
+
+
+def write_lut(idx, xx_c, yy_c, timeout=0.1, stopped=False):
+    """write a new LUT for WFS idx to the inactive slot and make it active,
+    returning the new active slot.
+
+    After the flip, waits (for up to `timeout` seconds) for the centroider to
+    finish two frames, so that no frame is still reading the old slot when
+    the next update overwrites it.
+
+    If the layout changes (see `relayout_needed`), the streams are recreated
+    with the new LUT in every slot, which raises a RuntimeError unless
+    `stopped` (i.e., the caller has stopped the centroider's run loop).
+    """
+    xx_c = np.asarray(xx_c, dtype=np.float32).ravel()
+    yy_c = np.asarray(yy_c, dtype=np.float32).ravel()
+    if not stopped and relayout_needed(idx, xx_c.shape[0]):
+        raise RuntimeError(
+            f"the LUT of wfs{idx:01d} changes layout (to {xx_c.shape[0]} "
+            "subapertures), which recreates its streams: stop the "
+            "centroider first"
+        )
+    lutx = _connect(f"lutx{idx:01d}")
+    luty = _connect(f"luty{idx:01d}")
+    lutslot = _connect(f"lutslot{idx:01d}")
+    if lutslot is None:
+        lutslot = SHM(f"lutslot{idx:01d}", np.zeros((1, 1), np.float32))
+    shape = (NSLOTS, xx_c.shape[0])
+    if lutx is None or luty is None or lutx.shape != shape or \
+            luty.shape != shape:
+        # nothing is reading a LUT of this layout, so fill every slot
+        SHM(f"lutx{idx:01d}", np.tile(xx_c, (NSLOTS, 1)))
+        SHM(f"luty{idx:01d}", np.tile(yy_c, (NSLOTS, 1)))
+        lutslot.set_data(np.zeros((1, 1), np.float32))
+        return 0
+
+    slot = 1 - active_slot(lutx.get_data(), lutslot.get_data())
+    for shm, lut in [(lutx, xx_c), (luty, yy_c)]:
+        # rewriting the active slot with its own values is harmless
+        data = np.array(shm.get_data(), dtype=np.float32)
+        data[slot] = lut
+        shm.set_data(data)
+
+    slopemap = _connect(f"slopemap{idx:01d}")
+    cnt0 = None if slopemap is None else slopemap.get_counter()
+    lutslot.set_data(np.full((1, 1), slot, dtype=np.float32))
+    t0 = time.perf_counter()
+    while cnt0 is not None and slopemap.get_counter() < cnt0 + 2 and \
+            time.perf_counter() - t0 < timeout:
+        time.sleep(1e-3)
+    return slot
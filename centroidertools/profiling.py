@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""Phase timing for the `cent` commands (`cent --profile ...`).
+
+Code marks the phases it spends time in with nested `phase` blocks, e.g.:
+
+    with profiling.phase("fit"):
+        with profiling.phase("acquire frames"):
+            ...
+
+which do nothing unless profiling has been enabled (by `--profile`). When
+enabled, a breakdown of the time spent in each phase (total and self, i.e.,
+excluding nested phases) is printed on exit, and the phases can be written
+as a Chrome trace (json) file, viewable with chrome://tracing or
+https://ui.perfetto.dev. With `--cprofile`, the command is also run under
+cProfile.
+"""
+
+import atexit
+import contextlib
+import cProfile
+import io
+import json
+import os
+import pstats
+import threading
+import time
+
+_enabled = False
+_events = []  # (path, t_start, duration, thread id, args)
+_local = threading.local()
+# import this module before any others to include them in the "imports"
+# phase
+_t0 = time.perf_counter()
+
+
+def _stack():
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+@contextlib.contextmanager
+def _phase(name, args):
+    stack = _stack()
+    stack.append(name)
+    path = tuple(stack)
+    t_start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _events.append((
+            path, t_start, time.perf_counter() - t_start,
+            threading.get_ident(), args
+        ))
+        stack.pop()
+
+
+def phase(name, **args):
+    """context manager timing a (nested) phase named `name`, `args` are
+    saved in the trace"""
+    if not _enabled:
+        return contextlib.nullcontext()
+    return _phase(name, args)
+
+
+def record(name, t_start, t_end, **args):
+    """record a phase that has already happened (e.g., the imports, before
+    profiling could be enabled), from perf_counter times"""
+    if _enabled:
+        _events.append((
+            (*_stack(), name), t_start, t_end - t_start,
+            threading.get_ident(), args
+        ))
+
+
+def enable(*, trace=None, cprofile=False, cprofile_file=None):
+    """start profiling. The breakdown (and the trace, if `trace` is a
+    filename, and the cProfile stats if `cprofile`) are output on exit."""
+    global _enabled
+    _enabled = True
+    record("imports", _t0, time.perf_counter())
+    profiler = None
+    if cprofile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    def finish():
+        if profiler is not None:
+            profiler.disable()
+        print_report()
+        if trace:
+            write_trace(trace)
+            print(f"wrote trace to:\n{trace}")
+        if profiler is not None:
+            print_cprofile(profiler)
+            if cprofile_file:
+                profiler.dump_stats(cprofile_file)
+                print(f"wrote cProfile stats to:\n{cprofile_file}")
+
+    atexit.register(finish)
+
+
+def summary():
+    """total time, self time and count of each phase, keyed by its path of
+    nested phase names, in order of first start"""
+    phases = {}
+    for path, t_start, duration, _, _ in sorted(_events, key=lambda e: e[1]):
+        entry = phases.setdefault(
+            path, {"total": 0.0, "self": 0.0, "count": 0}
+        )
+        entry["total"] += duration
+        entry["self"] += duration
+        entry["count"] += 1
+    for path, _, duration, _, _ in _events:
+        parent = path[:-1]
+        if parent in phases:
+            phases[parent]["self"] -= duration
+    return phases
+
+
+def print_report():
+    phases = summary()
+    if not phases:
+        return
+    print(f"{'phase':40s} | {'count':>5s} | {'total (ms)':>10s} | "
+          f"{'self (ms)':>10s}")
+
+    # print children under their parents
+    def children(parent):
+        return [path for path in phases if path[:-1] == parent]
+
+    def print_tree(parent):
+        for path in children(parent):
+            entry = phases[path]
+            name = "  "*(len(path)-1) + path[-1]
+            print(f"{name:40s} | {entry['count']:5d} | "
+                  f"{1e3*entry['total']:10.2f} | {1e3*entry['self']:10.2f}")
+            print_tree(path)
+
+    print_tree(())
+
+
+def write_trace(filename):
+    """write the phases as Chrome trace format ("complete" events)"""
+    pid = os.getpid()
+    events = [
+        {
+            "name": path[-1],
+            "cat": "/".join(path[:-1]),
+            "ph": "X",
+            "ts": 1e6*(t_start - _t0),
+            "dur": 1e6*duration,
+            "pid": pid,
+            "tid": tid,
+            "args": {key: str(value) for key, value in args.items()},
+        } for path, t_start, duration, tid, args in _events
+    ]
+    with open(filename, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+def print_cprofile(profiler, nlines=25):
+    stream = io.StringIO()
+    stats = pstats.Stats(profiler, stream=stream)
+    stats.sort_stats("cumulative").print_stats(nlines)
+    print(stream.getvalue())
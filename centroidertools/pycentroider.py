@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+"""Python implementation of the `ltao.centroider` and `ltao.slopevec` milk
+processes, for running the pipeline against the local SHM/FPS stand-in
+(`CENT_BACKEND=local`). The algorithms follow `ltaomod_centroider/*.c`, and
+the FPS parameters have the same names, so the rest of the tools can't tell
+the difference. Launched by `cent start`, or by hand with e.g.:
+
+    python -m centroidertools.pycentroider centroider 1
+    python -m centroidertools.pycentroider slopevec
+"""
+
+import argparse
+import time
+import numpy as np
+from centroidertools.localshm import SHM, FPS
+from centroidertools import calib
+from centroidertools import lutbuf
+from centroidertools.telemetry import (
+    TELEM_FIELDS, MAX_NWFS, SYNCTELEM_SIZE, SYNCTELEM_WAITMODE
+)
+
+CENTROIDER_DEFAULTS = {
+    "wfsnumber": 1,
+    "nsubx": 32,
+    "nsuby": 32,
+    "fovx": 6,
+    "fovy": 6,
+    "cogthresh": 0.0,
+    "bgnpix": 0,
+    "fluxthresh": 0.3,
+    "nthreads": 1,
+    "cpuset": 0,
+}
+
+SLOPEVEC_DEFAULTS = {
+    "wfsflags": 30,
+    "nsubx": 32,
+    "nsuby": 32,
+    "synctimeout": 200.0,
+    "waitmode": 0,
+}
+
+
+def subap_pixels(lutx, luty, *, fovx, fovy, img_w):
+    """pixel indices (into the flattened image) of every subaperture window,
+    along with the sub-pixel offsets of the subaperture centres, as used by
+    `docentroids`.
+
+    Returns:
+        pix : ((nsub, fovy, fovx), int) : flat pixel index of each window
+        rows : ((nsub, fovy, 1), int) : image row of each window row
+        x_offset : ((nsub,), float) : offset of centre in window (x)
+        y_offset : ((nsub,), float) : offset of centre in window (y)
+    """
+    # C integer division and round-half-away-from-zero
+    x0 = np.floor(lutx - fovx//2 + 0.5).astype(np.int64)
+    y0 = np.floor(luty - fovy//2 + 0.5).astype(np.int64)
+    x_offset = (lutx - x0 - 0.5).astype(np.float32)
+    y_offset = (luty - y0 - 0.5).astype(np.float32)
+    rows = y0[:, None, None] + np.arange(fovy)[None, :, None]
+    cols = x0[:, None, None] + np.arange(fovx)[None, None, :]
+    pix = rows*img_w + cols
+    return pix, rows, x_offset, y_offset
+
+
+def docentroids(im, bg, offset, gain, rows_used, pix, rows, x_offset,
+                y_offset, *, thresh, bgnpix):
+    """vectorised equivalent of `docentroids` in centroider.c, using the
+    calibration from `calib.prepare_calib`
+
+    Returns:
+        slopes : ((2*nsub,), float) : x slopes followed by y slopes
+        flux : ((nsub,), float) : subaperture intensities
+    """
+    img_w = im.shape[1]
+    bg_row = np.zeros(im.shape[0], dtype=np.float32)
+    if bgnpix > 0:
+        edges = np.r_[0:bgnpix, img_w-bgnpix:img_w]
+        bg_row[rows_used] = (
+            im[rows_used[:, None], edges] - bg[rows_used[:, None], edges]
+        ).mean(axis=1)
+    # background, flat (and threshold) are folded into gain and offset
+    pixels = (
+        (im.ravel()[pix] - bg_row[rows])*gain.ravel()[pix]
+        - offset.ravel()[pix]
+    )
+    if thresh > -1.0:
+        np.maximum(pixels, 0.0, out=pixels)
+    fovy, fovx = pixels.shape[1:]
+    wx = np.arange(fovx)[None, :] - x_offset[:, None]
+    wy = np.arange(fovy)[None, :] - y_offset[:, None]
+    intensity = pixels.sum(axis=(1, 2))
+    intensityx = (pixels.sum(axis=1) * wx).sum(axis=1)
+    intensityy = (pixels.sum(axis=2) * wy).sum(axis=1)
+    slopes = np.concatenate([
+        intensityx/(intensity+1e-1),
+        intensityy/(intensity+1e-1),
+    ]).astype(np.float32)
+    return slopes, intensity.astype(np.float32)
+
+
+def reducemeasurements(slopes, flux, *, fluxthresh, compute_us=0.0,
+                       nthreads=1):
+    """equivalent of `reducemeasurements` in centroider.c, returns the
+    telemetry vector (see `centroidertools.telemetry.TELEM_FIELDS`)"""
+    nsub = flux.shape[0]
+    max_flux = flux.max()
+    valid = flux >= fluxthresh*max_flux
+    num_valid = valid.sum()
+    tt_x = tt_y = 0.0
+    if num_valid > 0:
+        tt_x = slopes[:nsub][valid].mean()
+        tt_y = slopes[nsub:][valid].mean()
+    return np.array(
+        [num_valid, tt_x, tt_y, max_flux, compute_us, nthreads],
+        dtype=np.float32
+    )
+
+
+def _connect_create(name, shape):
+    try:
+        shm = SHM(name)
+        if shm.shape != shape:
+            shm = SHM(name, (shape, np.float32))
+    except FileNotFoundError:
+        shm = SHM(name, (shape, np.float32))
+    return shm
+
+
+def run_centroider(idx):
+    # outputs are created before the FPS, so they exist by the time anyone
+    # (e.g., slopevec) sees this process as started
+    flux_map = _connect_create(f"flux{idx:01d}", (32, 32))
+    slope_map = _connect_create(f"slopemap{idx:01d}", (64, 32))
+    telem = _connect_create(f"telem{idx:01d}", (len(TELEM_FIELDS), 1))
+    fps = FPS.create(
+        f"centroider{idx:01d}", dict(CENTROIDER_DEFAULTS, wfsnumber=idx)
+    )
+    while not fps.conf_isrunning():
+        time.sleep(0.01)
+
+    wfs_img = SHM(f"scmos{idx:01d}_data")
+    wfs_bg = SHM(f"scmos{idx:01d}_bg")
+    subap_lut_x = SHM(f"lutx{idx:01d}")
+    subap_lut_y = SHM(f"luty{idx:01d}")
+    lut_slot = _connect_create(f"lutslot{idx:01d}", (1, 1))
+
+    # as in centroider.c, an all-0 flat means no flat-fielding
+    wfs_flat = _connect_create(f"wfsflat{idx:01d}", wfs_img.shape)
+    calib_img = _connect_create(f"calib{idx:01d}", wfs_img.shape)
+
+    im = np.empty(wfs_img.shape, dtype=np.float32)
+    bg = np.empty(wfs_bg.shape, dtype=np.float32)
+    lut_cnt = None
+    calib_key = None
+    # like the milk semaphore trigger, process once per input frame (on the
+    # latest data), so outputs stay in step with the input counter
+    cnt_done = wfs_img.get_counter()
+    run = None
+    while fps.conf_isrunning():
+        if not fps.run_isrunning():
+            time.sleep(0.01)
+            cnt_done = wfs_img.get_counter()
+            continue
+        if fps.run_starts() != run:
+            # as in centroider.c, nthreads is read at run start (and
+            # reported in the telemetry)
+            run = fps.run_starts()
+            nthreads = max(fps.get_param("nthreads"), 1)
+        if wfs_img.get_counter() == cnt_done:
+            time.sleep(20e-6)
+            continue
+        cnt_done += 1
+        wfs_img.get_data(out=im)
+        params = fps.get_params()
+        # as in centroider.c, the LUT slot is picked once per frame (and the
+        # slot counter changes whenever it's flipped, see lutbuf.py)
+        key = (lut_slot.get_counter(), subap_lut_x.get_counter(),
+               subap_lut_y.get_counter(), params["fovx"], params["fovy"])
+        if key != lut_cnt:
+            # only rebuild the pixel lookups when the LUT or FOV changes
+            slot = lut_slot.get_data()
+            lutx = lutbuf.active_lut(subap_lut_x.get_data(), slot)
+            luty = lutbuf.active_lut(subap_lut_y.get_data(), slot)
+            geometry = subap_pixels(
+                lutx, luty,
+                fovx=params["fovx"], fovy=params["fovy"], img_w=im.shape[1]
+            )
+            lut_cnt = key
+        key = (wfs_bg.get_counter(), wfs_flat.get_counter(), lut_cnt,
+               params["cogthresh"])
+        if key != calib_key:
+            # as in prepcalib, only rebuild when an input has changed
+            wfs_bg.get_data(out=bg)
+            offset, gain, rows_used = calib.prepare_calib(
+                bg, luty,
+                thresh=params["cogthresh"], fovy=params["fovy"],
+                flat=wfs_flat.get_data()
+            )
+            calib_img.set_data(offset)
+            calib_key = key
+        # numpy already vectorises over subapertures, so nthreads/cpuset
+        # are accepted (and reported) but not used here
+        t0 = time.perf_counter()
+        slopes, flux = docentroids(
+            im, bg, offset, gain, rows_used, *geometry,
+            thresh=params["cogthresh"], bgnpix=params["bgnpix"]
+        )
+        compute_us = 1e6*(time.perf_counter() - t0)
+        flux_map.set_data(flux)
+        slope_map.set_data(slopes)
+        telem.set_data(reducemeasurements(
+            slopes, flux.ravel(), fluxthresh=params["fluxthresh"],
+            compute_us=compute_us, nthreads=nthreads
+        ))
+
+
+def run_slopevec():
+    fps = FPS.create("slopevec", dict(SLOPEVEC_DEFAULTS))
+    while not fps.conf_isrunning():
+        time.sleep(0.01)
+
+    params = fps.get_params()
+    indices = [i for i in range(MAX_NWFS) if params["wfsflags"] & (1 << i)]
+    slope_maps = [SHM(f"slopemap{i:01d}") for i in indices]
+    nslopes = params["nsubx"]*params["nsuby"]*2
+    slope_vec = _connect_create("slopevec", (nslopes*len(indices), 1))
+    vec = np.zeros(slope_vec.shape, dtype=np.float32)
+    blocks = [
+        vec[i*nslopes:(i+1)*nslopes].reshape(slope_map.shape)
+        for i, slope_map in enumerate(slope_maps)
+    ]
+    counters = [slope_map.get_counter() for slope_map in slope_maps]
+    synctelem = _connect_create("synctelem", (SYNCTELEM_SIZE, 1))
+    timeouts = np.zeros(synctelem.shape, dtype=np.float32)
+    synctelem.set_data(timeouts)
+
+    run = None
+    while fps.conf_isrunning():
+        if not fps.run_isrunning():
+            time.sleep(0.01)
+            continue
+        if fps.run_starts() != run:
+            # as in slopevec.c, waitmode is read (and reported) at run start
+            run = fps.run_starts()
+            waitmode = fps.get_param("waitmode")
+            timeouts[SYNCTELEM_WAITMODE] = waitmode
+            synctelem.set_data(timeouts)
+        timeout = fps.get_param("synctimeout")*1e-6
+        # there are no semaphores to block on here, so waitmode 1 just backs
+        # off between polls while no frame is in flight
+        idle_sleep = 200e-6 if waitmode else 5e-6
+        ready = [False]*len(indices)
+        start = None
+        stopped = False
+        while not all(ready):
+            if start is not None and time.perf_counter()-start > timeout:
+                for i, idx in enumerate(indices):
+                    timeouts[idx] += not ready[i]
+                timeouts[MAX_NWFS] += 1
+                synctelem.set_data(timeouts)
+                break
+            for i, slope_map in enumerate(slope_maps):
+                if ready[i] or slope_map.get_counter() == counters[i]:
+                    continue
+                if start is None:
+                    start = time.perf_counter()
+                slope_map.get_data(out=blocks[i])
+                counters[i] = slope_map.get_counter()
+                ready[i] = True
+            if start is None and (not fps.run_isrunning() or
+                                  fps.run_starts() != run):
+                # stopped (or restarted) between frames, which takes effect
+                # without waiting for a frame
+                stopped = True
+                break
+            time.sleep(5e-6 if start is not None else idle_sleep)
+        if not stopped:
+            slope_vec.set_data(vec)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        "python stand-in for the ltaomodcentroider milk processes"
+    )
+    parser.add_argument(
+        "process", choices=["centroider", "slopevec"],
+        help="which process to run"
+    )
+    parser.add_argument(
+        "idx", type=int, nargs="?", default=None,
+        help="wfs index (for centroider)"
+    )
+    args = parser.parse_args()
+    if args.process == "centroider":
+        if args.idx is None:
+            parser.error("centroider requires a wfs index")
+        run_centroider(args.idx)
+    else:
+        run_slopevec()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,26 @@
 from astropy.io import fits
 import numpy as np
+import scipy.fft
 import scipy.linalg as la
-from pyMilk.interfacing.shm import SHM
+from centroidertools.backend import SHM, FPS
 from tqdm import tqdm
-from time import sleep
+from time import sleep, perf_counter
+import os
 import subprocess
+import threading
+
+NSUB = 32  # subapertures across each WFS
+NSLOPES = 2*NSUB*NSUB  # slopes per WFS in slopevec
+NPHASE = 64  # phase points across recon_phi
+DEFAULT_INDICES = [1, 2, 3, 4]
+RCM_FILE = "/tmp/ultimate_rcm.fits"
+# reconstructor over the valid slopes only, with the slope index in HDU 1
+RCM_VALID_FILE = "/tmp/ultimate_rcm_valid.fits"
+# Toeplitz kernels of cmm (HDU 0) and, if it is Toeplitz, ctm (HDU 1), for
+# the iterative reconstructor, stamped with the input matrices they came from
+KERNELS_FILE = "/tmp/ultimate_kernels.fits"
+# max relative rms error for ctm to be applied as a Toeplitz operator
+CTM_TOEPLITZ_TOL = 1e-2
 
 
 def get_shm_stacked(shm_name, nframes):
@@ -15,16 +31,32 @@ def get_shm_stacked(shm_name, nframes):
     ], axis=0)
 
 
-def save_control_matrices():
-    def solve_cmat(dtc, ctm, cmm, dcc_reg, cmm_reg):
-        x = la.solve(dtc.T @ dtc + dcc_reg, dtc.T, assume_a="pos").T
-        x = x @ la.solve(cmm + cmm_reg, ctm.T, assume_a="pos").T
-        return x
+def valid_subaps(flux, fluxthresh):
+    """indices of the subapertures with flux >= fluxthresh*max(flux), as in
+    `reducemeasurements` in centroider.c"""
+    flux = flux.flatten()
+    return np.flatnonzero(flux >= fluxthresh*flux.max())
 
-    def solve_recon(ctm, cmm, cmm_reg):
-        x = la.solve(cmm + cmm_reg, ctm.T, assume_a="pos").T
-        return x
 
+def slope_index(valids, nsub=NSLOPES//2):
+    """indices into slopevec of the valid slopes
+
+    Args:
+        valids : list of the valid subaperture indices of each WFS in
+            slopevec (in slopevec order), or None for all of them
+    Returns:
+        index : ((nvalid_slopes,), int) : x slopes then y slopes of each WFS
+    """
+    index = []
+    for i, valid in enumerate(valids):
+        if valid is None:
+            valid = np.arange(nsub)
+        valid = np.asarray(valid, dtype=int)
+        index += [i*2*nsub + valid, i*2*nsub + nsub + valid]
+    return np.concatenate(index)
+
+
+def load_matrices():
     try:
         matrices = {
             key: fits.open(f"/tmp/ultimate_{key}.fits")[0].data
@@ -37,34 +69,98 @@ def save_control_matrices():
             key: fits.open(f"/tmp/ultimate_{key}.fits")[0].data
             for key in ["dmc", "dtc", "cmm", "ctm"]
         }
+    return matrices
+
+
+def save_control_matrices(index=None, indices=DEFAULT_INDICES):
+    """solve the reconstructor and save it to RCM_FILE or, if `index` (see
+    `slope_index`) is given, over only those slopes to RCM_VALID_FILE.
+
+    Only the rows/columns of cmm and ctm for the valid slopes are used, so
+    the solve and the reconstructor shrink with the invalid fraction, and
+    changing the mask only needs a re-solve from the cached input matrices.
+    """
+    def solve_cmat(dtc, ctm, cmm, dcc_reg, cmm_reg):
+        x = la.solve(dtc.T @ dtc + dcc_reg, dtc.T, assume_a="pos").T
+        x = x @ la.solve(cmm + cmm_reg, ctm.T, assume_a="pos").T
+        return x
+
+    def solve_recon(ctm, cmm, cmm_reg):
+        x = la.solve(cmm + cmm_reg, ctm.T, assume_a="pos").T
+        return x
+
+    matrices = load_matrices()
 
     # dtc = matrices["dtc"]
     ctm = matrices["ctm"]
     cmm = matrices["cmm"]
     # dcc_reg = 1.0*np.eye(dtc.shape[1])
 
-    shm_fluxes = get_flux_vec(nframes=10)
-    cmm_reg = np.diag(100/(shm_fluxes+1e-10)+10.0)
+    shm_fluxes = get_flux_vec(nframes=10, indices=indices)
+    if index is not None:
+        ctm = ctm[:, index]
+        cmm = cmm[np.ix_(index, index)]
+        shm_fluxes = shm_fluxes[index]
+    cmm_reg = np.diag(noise_regularisation(shm_fluxes))
     # cmm_reg = np.diag(0*shm_fluxes+5.0)
     print("solving matrices")
     rcm = solve_recon(ctm, cmm, cmm_reg)
-    fits.writeto("/tmp/ultimate_rcm.fits", rcm, overwrite=True)
+    if index is None:
+        fits.writeto(RCM_FILE, rcm, overwrite=True)
+    else:
+        fits.HDUList([
+            fits.PrimaryHDU(rcm), fits.ImageHDU(index.astype(np.int32))
+        ]).writeto(RCM_VALID_FILE, overwrite=True)
 
 
-def get_flux_vec(nframes=10):
-    print("stacking flux frames")
-    shm_fluxes = []
-    for i in tqdm([1, 2, 3, 4], leave=True):
-        flux = get_shm_stacked(f"flux{i:01d}", nframes=nframes)
-        shm_fluxes += list(flux.flatten())
-        shm_fluxes += list(flux.flatten())
+def noise_regularisation(fluxes):
+    """diagonal added to cmm for the measurement noise of each slope, given
+    its subaperture's flux"""
+    return 100/(fluxes+1e-10)+10.0
 
-    shm_fluxes = np.array(shm_fluxes)
-    return shm_fluxes
+
+def load_rcm(index=None, indices=DEFAULT_INDICES):
+    """load the reconstructor (over the slopes in `index`, if given) from
+    disk, solving it first if it's not there (or was solved for a different
+    set of valid slopes)"""
+    if index is None:
+        try:
+            rcm = fits.open(RCM_FILE)[0].data.astype(np.float32)
+            print("loaded reconstructor from disk")
+            return rcm
+        except FileNotFoundError:
+            pass
+    else:
+        try:
+            hdus = fits.open(RCM_VALID_FILE)
+            if np.array_equal(hdus[1].data, index):
+                print("loaded valid-slope reconstructor from disk")
+                return hdus[0].data.astype(np.float32)
+            print("valid subapertures changed, re-solving")
+        except FileNotFoundError:
+            pass
+    print("no reconstructor on disk, making new")
+    save_control_matrices(index=index, indices=indices)
+    print("done")
+    return load_rcm(index=index, indices=indices)
 
 
-def reconstruct_phase(rcm, shm_in, ref, shm_out=None):
+def get_flux_vec(nframes=10, indices=DEFAULT_INDICES):
+    print("stacking flux frames")
+    fluxes = [
+        get_shm_stacked(f"flux{i:01d}", nframes=nframes).flatten()
+        for i in tqdm(indices, leave=True)
+    ]
+    # one entry per slope (x slopes then y slopes), as in slopevec
+    return np.concatenate([np.tile(flux, 2) for flux in fluxes])
+
+
+def reconstruct_phase(rcm, shm_in, ref, shm_out=None, index=None):
     s = shm_in.get_data(check=True)
+    if index is not None:
+        # only the valid slopes
+        s = s.reshape(-1)[index]
+        ref = ref.reshape(-1)[index]
     phi = rcm @ (s-ref)
     phi = phi.reshape([64, 64])
     if shm_out is None:
@@ -78,6 +174,502 @@ def reconstruct_phase(rcm, shm_in, ref, shm_out=None):
         shm_out.set_data(phi)
 
 
+def slopevec_indices():
+    """WFS indices in slopevec, in order (from its wfsflags, if running)"""
+    try:
+        flags = FPS("slopevec").get_param("wfsflags")
+    except RuntimeError:
+        return DEFAULT_INDICES
+    return [i for i in range(32) if flags & (1 << i)]
+
+
+class PipelinedReconstructor():
+    """Reconstruct the phase from the slopemaps as they arrive, rather than
+    from the synchronised slopevec.
+
+    rcm is split into per-WFS column blocks, and a waiter thread per WFS
+    computes `rcm_block @ (slopemap - ref_block)` as soon as its slopemap
+    lands. The thread that completes the last partial of a frame sums them
+    and publishes `recon_phi`, so the latency after the last WFS lands is
+    one block matvec rather than the sync plus the full matvec.
+
+    Each partial is tagged with its slopemap's frame counter. A frame is only
+    summed if every WFS has landed within `timeout` seconds of the first, and
+    every slopemap counter has advanced by the same number of frames since
+    the last summed frame. Otherwise the frame is dropped, and counted in
+    `misses` (per WFS, for those that didn't land in time) or `mismatches`
+    (counters out of step, e.g., a WFS dropped a frame).
+    """
+
+    def __init__(self, rcm, ref, indices, shm_out=None, index=None,
+                 timeout=0.01):
+        self.indices = list(indices)
+        ref = ref.flatten()
+        if index is None:
+            index = np.arange(len(self.indices)*NSLOPES)
+        # columns of rcm, and slopes of each slopemap, used by each WFS
+        columns = [
+            np.flatnonzero((index >= i*NSLOPES) & (index < (i+1)*NSLOPES))
+            for i in range(len(self.indices))
+        ]
+        self.slopes = [
+            index[cols] - i*NSLOPES for i, cols in enumerate(columns)
+        ]
+        self.blocks = [np.ascontiguousarray(rcm[:, cols]) for cols in columns]
+        self.refs = [
+            ref[index[cols]].astype(np.float32) for cols in columns
+        ]
+        self.partials = np.zeros(
+            (len(self.indices), rcm.shape[0]), dtype=np.float32
+        )
+        self.fresh = [False]*len(self.indices)
+        self.counters = np.zeros(len(self.indices), dtype=np.int64)
+        self.phi = np.zeros(rcm.shape[0], dtype=np.float32)
+        self.nframes = 0
+        self.timeout = timeout
+        self.misses = np.zeros(len(self.indices), dtype=int)
+        self.mismatches = 0
+        self._last_counters = None  # counters of the last summed frame
+        self._frame_start = None  # arrival time of the frame's first partial
+        self._lock = threading.Lock()
+        if shm_out is None:
+            try:
+                shm_out = SHM("recon_phi")
+            except FileNotFoundError:
+                shm_out = SHM("recon_phi", self.phi.reshape([64, 64]))
+        self.shm_out = shm_out
+        self._threads = [
+            threading.Thread(target=self._wait, args=(i,), daemon=True)
+            for i in range(len(self.indices))
+        ]
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+
+    def _wait(self, i):
+        shm = SHM(f"slopemap{self.indices[i]:01d}")
+        s = np.zeros(len(self.slopes[i]), dtype=np.float32)
+        partial = np.zeros(self.phi.shape, dtype=np.float32)
+        counter = shm.get_counter()
+        while True:
+            data = shm.get_data(check=True, timeout=self.timeout)
+            if shm.get_counter() == counter:
+                # nothing new, but the frame may have expired
+                with self._lock:
+                    self._expire()
+                continue
+            counter = shm.get_counter()
+            np.take(data.reshape(-1), self.slopes[i], out=s)
+            s -= self.refs[i]
+            np.matmul(self.blocks[i], s, out=partial)
+            with self._lock:
+                self._add_partial(i, partial, counter)
+
+    def _drop_frame(self):
+        # count the WFSs that didn't make it against them
+        self.misses += np.logical_not(self.fresh)
+        self.fresh = [False]*len(self.indices)
+        self._frame_start = None
+
+    def _expire(self):
+        if self._frame_start is not None and \
+                perf_counter() - self._frame_start > self.timeout:
+            self._drop_frame()
+
+    def _add_partial(self, i, partial, counter):
+        self._expire()
+        if self.fresh[i]:
+            # this WFS is on its next frame before the others landed
+            self._drop_frame()
+        if self._frame_start is None:
+            self._frame_start = perf_counter()
+        self.partials[i] = partial
+        self.counters[i] = counter
+        self.fresh[i] = True
+        if not all(self.fresh):
+            return
+        last = self._last_counters
+        self._last_counters = self.counters.copy()
+        self.fresh = [False]*len(self.indices)
+        self._frame_start = None
+        if last is not None and \
+                len(np.unique(self.counters - last)) > 1:
+            # e.g., a WFS dropped a frame, so these partials are of
+            # different frames. The next frame is compared to these.
+            self.mismatches += 1
+            return
+        np.sum(self.partials, axis=0, out=self.phi)
+        self.shm_out.set_data(self.phi.reshape([64, 64]))
+        self.nframes += 1
+
+
+class ToeplitzOperator():
+    """A matrix of blocks that are two-level (block) Toeplitz, i.e., whose
+    entries depend only on the offset between the output and input grid
+    points, applied with FFTs without forming the matrix.
+
+    The input (output) vector is `nin` (`nout`) blocks, each a row-major
+    grid of `in_shape` (`out_shape`) points, with neighbouring input points
+    `stride` output points apart, so that
+
+        (A @ x)[p, i, j] = sum_{q, k, l} kernels[p, q, i - stride*k + oy,
+                                             j - stride*l + ox] x[q, k, l]
+
+    with (oy, ox) = stride*(in_shape - 1). For cmm the blocks are the x and
+    y slopes of each WFS (as in slopevec) with stride 1, and for ctm the
+    output is the phase, sampled `stride` times per subaperture.
+    """
+
+    def __init__(self, kernels, in_shape, out_shape, stride=1):
+        self.kernels = np.asarray(kernels, dtype=np.float32)
+        self.in_shape = tuple(in_shape)
+        self.out_shape = tuple(out_shape)
+        self.stride = stride
+        nout, nin = self.kernels.shape[:2]
+        self.shape = (
+            nout*int(np.prod(out_shape)), nin*int(np.prod(in_shape))
+        )
+        # the input, with stride-1 zeros between its points
+        self._up_shape = tuple(stride*(n-1)+1 for n in self.in_shape)
+        lags = tuple(o+u-1 for o, u in zip(self.out_shape, self._up_shape))
+        if self.kernels.shape[2:] != lags:
+            raise ValueError(
+                f"kernels should be of shape (nout, nin, *{lags}), not "
+                f"{self.kernels.shape}"
+            )
+        # embed the kernels in circulants long enough not to wrap around,
+        # with lag d at index d mod length
+        self._fft_shape = tuple(
+            scipy.fft.next_fast_len(n, real=True) for n in lags
+        )
+        circulant = np.zeros(
+            (nout, nin, *self._fft_shape), dtype=np.float32
+        )
+        circulant[..., :lags[0], :lags[1]] = self.kernels
+        circulant = np.roll(
+            circulant, (1-self._up_shape[0], 1-self._up_shape[1]),
+            axis=(-2, -1)
+        )
+        # (frequency, frequency, nout, nin), to apply as a batched matmul
+        self._kernels_ft = np.ascontiguousarray(np.moveaxis(
+            scipy.fft.rfft2(circulant, axes=(-2, -1)), (0, 1), (-2, -1)
+        ))
+
+    @property
+    def nbytes(self):
+        return self.kernels.nbytes + self._kernels_ft.nbytes
+
+    def matvec(self, x):
+        """A @ x, for x of shape (..., ncols), e.g., a block of frames"""
+        x = np.asarray(x, dtype=np.float32)
+        batch = x.shape[:-1]
+        nin = self.kernels.shape[1]
+        x = x.reshape(*batch, nin, *self.in_shape)
+        if self.stride > 1:
+            up = np.zeros((*batch, nin, *self._up_shape), dtype=np.float32)
+            up[..., ::self.stride, ::self.stride] = x
+            x = up
+        x_ft = scipy.fft.rfft2(x, s=self._fft_shape, axes=(-2, -1))
+        y_ft = self._kernels_ft @ np.moveaxis(x_ft, -3, -1)[..., None]
+        y = scipy.fft.irfft2(
+            np.moveaxis(y_ft[..., 0], -1, -3), s=self._fft_shape,
+            axes=(-2, -1)
+        )
+        y = y[..., :self.out_shape[0], :self.out_shape[1]]
+        return y.reshape(*batch, self.shape[0])
+
+    def diagonal(self):
+        """the diagonal of A (which must be square, with stride 1)"""
+        if self.shape[0] != self.shape[1] or self.stride != 1:
+            raise ValueError("only a square operator has a diagonal")
+        oy, ox = (n-1 for n in self.in_shape)
+        zero_lag = np.diagonal(self.kernels[..., oy, ox])
+        return np.repeat(zero_lag, int(np.prod(self.in_shape)))
+
+    def _lags(self, out_points, in_points):
+        """kernel indices (lag y, lag x) between output and input points"""
+        (iy, ix), (ky, kx) = out_points, in_points
+        return (
+            iy - self.stride*ky + self._up_shape[0] - 1,
+            ix - self.stride*kx + self._up_shape[1] - 1,
+        )
+
+    def to_dense(self, rows=None, cols=None, dtype=np.float64,
+                 chunk=256):
+        """the (rows, cols) submatrix of A, or all of it"""
+        rows = np.arange(self.shape[0]) if rows is None else rows
+        cols = np.arange(self.shape[1]) if cols is None else cols
+        nout, nin = self.kernels.shape[:2]
+        p, *out_points = np.unravel_index(rows, (nout, *self.out_shape))
+        q, *in_points = np.unravel_index(cols, (nin, *self.in_shape))
+        dense = np.empty((len(rows), len(cols)), dtype=dtype)
+        for start in range(0, len(rows), chunk):
+            rs = slice(start, start+chunk)
+            lag_y, lag_x = self._lags(
+                [points[rs, None] for points in out_points],
+                [points[None, :] for points in in_points]
+            )
+            dense[rs] = self.kernels[p[rs, None], q[None, :], lag_y, lag_x]
+        return dense
+
+    @classmethod
+    def from_dense(cls, matrix, nout, nin, in_shape, out_shape, stride=1):
+        """fit the kernels to a dense `matrix`, averaging the entries at
+        each lag. Returns the operator and the relative rms error of the
+        fit, which is 0 if the blocks of `matrix` are exactly Toeplitz."""
+        op = cls(
+            np.zeros((
+                nout, nin,
+                *(o + stride*(n-1) for o, n in zip(out_shape, in_shape))
+            )), in_shape, out_shape, stride=stride
+        )
+        nlags = int(np.prod(op.kernels.shape[2:]))
+        npix_out, npix_in = int(np.prod(out_shape)), int(np.prod(in_shape))
+        # lag index of every entry of a block
+        lag_y, lag_x = op._lags(
+            [points[:, None] for points in np.indices(out_shape).reshape(
+                2, -1
+            )],
+            [points[None, :] for points in np.indices(in_shape).reshape(
+                2, -1
+            )],
+        )
+        lag = (lag_y*op.kernels.shape[3] + lag_x).ravel()
+        counts = np.maximum(np.bincount(lag, minlength=nlags), 1)
+        kernels = np.zeros(op.kernels.shape)
+        err2 = 0.0
+        norm2 = 0.0
+        for p in range(nout):
+            for q in range(nin):
+                block = np.asarray(matrix[
+                    p*npix_out:(p+1)*npix_out, q*npix_in:(q+1)*npix_in
+                ], dtype=np.float64).ravel()
+                kernel = np.bincount(lag, weights=block, minlength=nlags)
+                kernel /= counts
+                err2 += np.sum((block - kernel[lag])**2)
+                norm2 += np.sum(block**2)
+                kernels[p, q] = kernel.reshape(kernels.shape[2:])
+        error = np.sqrt(err2/norm2)
+        return cls(kernels, in_shape, out_shape, stride=stride), error
+
+
+class SpectralPreconditioner():
+    """Approximate inverse of cmm + reg (over the valid slopes), from the
+    `nmodes` largest eigenpairs of cmm, found matrix-free with Lanczos
+    iterations. These are the low order modes, which hold most of the
+    turbulence and make the system ill-conditioned. The preconditioner
+    inverts them exactly, and scales the other modes by the next eigenvalue,
+    so the conditioning is that of the remaining spectrum."""
+
+    def __init__(self, matvec, n, reg, nmodes=100):
+        from scipy.sparse.linalg import LinearOperator, eigsh
+        op = LinearOperator(
+            (n, n), dtype=np.float64,
+            matvec=lambda x: matvec(x.astype(np.float32).ravel())
+        )
+        eigvals, eigvecs = eigsh(op, k=nmodes+1, which="LA", tol=1e-3)
+        order = np.argsort(eigvals)[::-1]
+        eigvals, eigvecs = eigvals[order], eigvecs[:, order]
+        reg = np.mean(reg)
+        self._scale = 1/(eigvals[nmodes] + reg)
+        self._modes = np.ascontiguousarray(eigvecs[:, :nmodes], np.float32)
+        self._gains = (
+            1/(eigvals[:nmodes] + reg) - self._scale
+        ).astype(np.float32)
+
+    @property
+    def nbytes(self):
+        return self._modes.nbytes + self._gains.nbytes
+
+    def apply(self, x):
+        """approximately solve (cmm + reg) y = x, for x of shape (..., n)"""
+        return self._scale*x + (x @ self._modes)*self._gains @ self._modes.T
+
+
+def _input_stamps():
+    """modification time and shape of each input matrix that the kernels are
+    fitted to, as FITS header cards (None if any of them is missing)"""
+    stamps = {}
+    for key in ["cmm", "ctm"]:
+        filename = f"/tmp/ultimate_{key}.fits"
+        try:
+            mtime = os.stat(filename).st_mtime_ns
+            header = fits.getheader(filename)
+        except FileNotFoundError:
+            return None
+        shape = tuple(header[f"NAXIS{i}"]
+                      for i in range(header["NAXIS"], 0, -1))
+        stamps[f"{key.upper()}STMP"] = f"{mtime} {shape}"
+    return stamps
+
+
+def load_structured(refit=False):
+    """the Toeplitz cmm operator and ctm (as an operator, if it is Toeplitz
+    to within CTM_TOEPLITZ_TOL, otherwise dense), fitted to the dense input
+    matrices and cached in KERNELS_FILE. The cache is refitted if the input
+    matrices have changed (modification time or shape) since, or if
+    `refit`."""
+    shapes = dict(in_shape=(NSUB, NSUB))
+    ctm_shapes = dict(shapes, out_shape=(NPHASE, NPHASE),
+                      stride=NPHASE//NSUB)
+    stamps = _input_stamps()
+    try:
+        hdus = fits.open(KERNELS_FILE)
+        header = hdus[0].header
+        if refit:
+            print("refitting structured covariances")
+        elif stamps is None or any(
+            header.get(card) != stamp for card, stamp in stamps.items()
+        ):
+            print("input matrices changed since the structured covariances "
+                  "were fitted")
+        else:
+            cmm = ToeplitzOperator(
+                hdus[0].data, out_shape=(NSUB, NSUB), **shapes
+            )
+            if len(hdus) > 1:
+                ctm = ToeplitzOperator(hdus[1].data, **ctm_shapes)
+            else:
+                ctm = load_matrices()["ctm"].astype(np.float32)
+            print("loaded structured covariances from disk")
+            return cmm, ctm
+    except FileNotFoundError:
+        pass
+    print("fitting structured covariances")
+    matrices = load_matrices()
+    # stamp after loading, which builds the inputs if they were missing
+    stamps = _input_stamps()
+    nblocks = matrices["cmm"].shape[0]//(NSUB*NSUB)
+    cmm, error = ToeplitzOperator.from_dense(
+        matrices["cmm"], nblocks, nblocks, out_shape=(NSUB, NSUB), **shapes
+    )
+    print(f"cmm is Toeplitz to {100*error:.2g}% rms")
+    hdus = [fits.PrimaryHDU(cmm.kernels)]
+    for card, stamp in (stamps or {}).items():
+        hdus[0].header[card] = stamp
+    ctm_op, error = ToeplitzOperator.from_dense(
+        matrices["ctm"], 1, nblocks, **ctm_shapes
+    )
+    print(f"ctm is Toeplitz to {100*error:.2g}% rms")
+    if error < CTM_TOEPLITZ_TOL:
+        ctm = ctm_op
+        hdus.append(fits.ImageHDU(ctm.kernels))
+    else:
+        print("using dense ctm")
+        ctm = matrices["ctm"].astype(np.float32)
+    fits.HDUList(hdus).writeto(KERNELS_FILE, overwrite=True)
+    return cmm, ctm
+
+
+class IterativeReconstructor():
+    """Minimum-variance reconstruction without forming rcm. Each frame (or
+    block of frames, as the rows of `slopes`) solves
+
+        (cmm + diag(reg)) x = s - ref,    phi = ctm @ x
+
+    over the valid slopes with preconditioned conjugate gradients, applying
+    cmm (and ctm, if it is a `ToeplitzOperator`) with FFTs. The
+    preconditioner is either "spectral" (see `SpectralPreconditioner`, with
+    `nmodes` modes) or "jacobi" (the inverse diagonal). Each solve starts
+    from the solution of the previous frame, which the turbulence changes
+    little between frames.
+    """
+
+    def __init__(self, cmm, ctm, reg, ref, index=None, tol=1e-3,
+                 maxiter=100, preconditioner="spectral", nmodes=100):
+        self.cmm = cmm
+        if index is None:
+            index = np.arange(cmm.shape[1])
+        self.index = index
+        if isinstance(ctm, ToeplitzOperator):
+            self.ctm = ctm
+        else:
+            self.ctm = np.ascontiguousarray(ctm[:, index], dtype=np.float32)
+        self.reg = np.asarray(reg, dtype=np.float32)
+        self.ref = ref.reshape(-1)[index].astype(np.float32)
+        if preconditioner == "spectral":
+            self.precond = SpectralPreconditioner(
+                self._cmm_matvec, len(index), self.reg, nmodes=nmodes
+            )
+        elif preconditioner == "jacobi":
+            self.precond = 1/(cmm.diagonal()[index] + self.reg)
+        else:
+            raise ValueError(f"unknown preconditioner: {preconditioner}")
+        self.tol = tol
+        self.maxiter = maxiter
+        self.x = np.zeros(len(index), dtype=np.float32)
+        self.niter = 0  # iterations of the last solve
+
+    @property
+    def nbytes(self):
+        precond = self.precond.nbytes
+        return self.cmm.nbytes + self.ctm.nbytes + precond + \
+            4*self.x.nbytes
+
+    def _scatter(self, x):
+        full = np.zeros((*x.shape[:-1], self.cmm.shape[1]), dtype=np.float32)
+        full[..., self.index] = x
+        return full
+
+    def _precondition(self, r):
+        if isinstance(self.precond, SpectralPreconditioner):
+            return self.precond.apply(r)
+        return self.precond*r
+
+    def _cmm_matvec(self, x):
+        return self.cmm.matvec(self._scatter(x))[..., self.index]
+
+    def _matvec(self, x):
+        return self._cmm_matvec(x) + self.reg*x
+
+    def solve(self, b, x0=None):
+        """solve (cmm + diag(reg)) x = b for each row of b"""
+        x = np.zeros_like(b) if x0 is None else np.array(
+            np.broadcast_to(x0, b.shape), dtype=np.float32
+        )
+        r = b - self._matvec(x)
+        z = self._precondition(r)
+        p = z.copy()
+        rz = np.sum(r*z, axis=-1, keepdims=True)
+        b_norm = np.maximum(np.linalg.norm(b, axis=-1, keepdims=True), 1e-30)
+        for niter in range(self.maxiter):
+            if np.all(np.linalg.norm(r, axis=-1, keepdims=True) <=
+                      self.tol*b_norm):
+                break
+            ap = self._matvec(p)
+            pap = np.sum(p*ap, axis=-1, keepdims=True)
+            alpha = np.divide(rz, pap, out=np.zeros_like(rz), where=pap > 0)
+            x += alpha*p
+            r -= alpha*ap
+            z = self._precondition(r)
+            rz_new = np.sum(r*z, axis=-1, keepdims=True)
+            beta = np.divide(
+                rz_new, rz, out=np.zeros_like(rz), where=rz > 0
+            )
+            rz = rz_new
+            p = z + beta*p
+        else:
+            niter = self.maxiter
+        self.niter = niter
+        return x
+
+    def reconstruct(self, slopes, warm=True):
+        """phase of shape (NPHASE*NPHASE,) (or (nframes, NPHASE*NPHASE))
+        from the full slopevec of one frame (or a block of nframes, as
+        rows)"""
+        slopes = np.asarray(slopes, dtype=np.float32)
+        single = slopes.size == self.cmm.shape[1]
+        s = slopes.reshape(-1, self.cmm.shape[1])[:, self.index] - self.ref
+        x = self.solve(s, x0=self.x if warm else None)
+        self.x = x[-1]
+        if isinstance(self.ctm, ToeplitzOperator):
+            phi = self.ctm.matvec(self._scatter(x))
+        else:
+            phi = x @ self.ctm.T
+        return phi[0] if single else phi
+
+
 def read_offsets():
     shm_offsets = SHM("slopevecref")
     return shm_offsets.get_data()
@@ -92,25 +684,68 @@ def save_offsets(nframes=50):
         shm_out = SHM("slopevecref", slopes)
 
 
-def main():
-    try:
-        rcm = fits.open("/tmp/ultimate_rcm.fits")[0].data.astype(np.float32)
-        print("loaded reconstructor from disk")
-    except FileNotFoundError:
-        print("no reconstructor on disk, making new")
-        save_control_matrices()
-        rcm = fits.open("/tmp/ultimate_rcm.fits")[0].data.astype(np.float32)
-        print("done")
+def main(pipelined=False, valids=None, iterative=False, refit=False):
+    """run the reconstructor. `valids` is an optional dict of the valid
+    subaperture indices of each WFS (e.g., from the centroider config), in
+    which case only the valid slopes are used. If `iterative`, each frame is
+    solved with `IterativeReconstructor` rather than multiplied by rcm (and
+    `refit` refits its cached covariance kernels)."""
+    indices = slopevec_indices()
+    index = None
+    if valids is not None and any(
+        valids.get(idx) is not None for idx in indices
+    ):
+        index = slope_index([valids.get(idx) for idx in indices])
+        print(f"using {len(index)}/{len(indices)*NSLOPES} valid slopes")
+    if iterative:
+        return main_iterative(indices, index, refit=refit)
+    rcm = load_rcm(index=index, indices=indices)
 
     save_offsets(nframes=50)
     ref = read_offsets()
     print("starting reconstruction")
+    if pipelined:
+        recon = PipelinedReconstructor(rcm, ref, indices, index=index)
+        recon.start()
+        pbar = tqdm()
+        while True:
+            sleep(0.1)
+            pbar.set_postfix(
+                misses=recon.misses.tolist(), mismatches=recon.mismatches,
+                refresh=False
+            )
+            pbar.update(recon.nframes - pbar.n)
+    shm_in = SHM("slopevec")
+    shm_out = reconstruct_phase(rcm, shm_in, ref, index=index)
+    pbar = tqdm(True)
+    while pbar:
+        reconstruct_phase(rcm, shm_in, ref, shm_out=shm_out, index=index)
+        sleep(0.1)
+        pbar.update()
+
+
+def main_iterative(indices, index=None, refit=False):
+    cmm, ctm = load_structured(refit=refit)
+    reg = noise_regularisation(get_flux_vec(nframes=10, indices=indices))
+    if index is not None:
+        reg = reg[index]
+    save_offsets(nframes=50)
+    ref = read_offsets()
+    recon = IterativeReconstructor(cmm, ctm, reg, ref, index=index)
+    print("starting iterative reconstruction")
     shm_in = SHM("slopevec")
-    shm_out = reconstruct_phase(rcm, shm_in, ref)
+    phi = recon.reconstruct(shm_in.get_data(check=True))
+    try:
+        shm_out = SHM("recon_phi")
+        shm_out.set_data(phi.reshape([NPHASE, NPHASE]))
+    except FileNotFoundError:
+        shm_out = SHM("recon_phi", phi.reshape([NPHASE, NPHASE]))
     pbar = tqdm(True)
     while pbar:
-        reconstruct_phase(rcm, shm_in, ref, shm_out=shm_out)
+        phi = recon.reconstruct(shm_in.get_data(check=True))
+        shm_out.set_data(phi.reshape([NPHASE, NPHASE]))
         sleep(0.1)
+        pbar.set_postfix(niter=recon.niter, refresh=False)
         pbar.update()
 
 
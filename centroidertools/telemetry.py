@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""Readers for the telemetry streams published by the centroider processes:
+
+    telem{idx} : per-frame diagnostics of WFS idx (see TELEM_FIELDS)
+    synctelem  : number of sync timeouts each WFS was late for, followed by
+                 the total number of sync timeouts, and the waitmode in use
+                 (see slopevec.c)
+
+The layouts must match `ltaomod_centroider/centroider.c` and `slopevec.c`.
+"""
+
+import numpy as np
+from centroidertools.backend import SHM
+
+TELEM_FIELDS = [
+    "num_valid", "tt_x", "tt_y", "max_flux", "compute_us", "nthreads"
+]
+MAX_NWFS = 5
+SYNCTELEM_WAITMODE = MAX_NWFS + 1
+SYNCTELEM_SIZE = MAX_NWFS + 2
+
+
+def read_telemetry(idx, nframes=1):
+    """read the telemetry of WFS idx, averaged over `nframes` new frames (or
+    the latest frame if `nframes` is 0).
+
+    Returns a dict with the TELEM_FIELDS and `timeouts`, the number of sync
+    timeouts this WFS has been late for (None if slopevec isn't running).
+    """
+    shm = SHM(f"telem{idx:01d}")
+    if nframes == 0:
+        data = shm.get_data().flatten()
+    else:
+        data = np.mean([
+            shm.get_data(check=True).flatten()
+            for _ in range(nframes)
+        ], axis=0)
+    telemetry = {
+        field: float(value)
+        for field, value in zip(TELEM_FIELDS, data)
+    }
+    telemetry["timeouts"] = None
+    try:
+        timeouts = SHM("synctelem").get_data().flatten()
+        telemetry["timeouts"] = int(timeouts[idx])
+    except FileNotFoundError:
+        pass
+    return telemetry
+
+
+def read_sync_timeouts():
+    """total number of sync timeouts since slopevec started"""
+    return int(SHM("synctelem").get_data().flatten()[MAX_NWFS])
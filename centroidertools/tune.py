@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+"""Offline tuning of the centroider parameters (`cogthresh`, `bgnpix` and
+the FOV) on recorded WFS frames (e.g., those played by
+`scripts/play_images.py`), used by `cent config tune`.
+
+Every candidate is run through the same vectorised centroiding as the Python
+centroider (`pycentroider.docentroids`, with the calibration from
+`calib.prepare_calib`), and scored on:
+
+    noise : frame-to-frame slope jitter, divided by the gain (pixels)
+    nonlinearity : rms error of the response to known sub-pixel shifts of
+        the spots (Fourier shifts of the background-subtracted frames),
+        after fitting a gain (pixels)
+
+with score = noise + nonlinearity (lower is better). The spots are shifted
+rather than the LUT, since shifting the LUT moves the window with the
+centre, so can't see the change in CoG gain that `cogthresh` causes. The
+noise estimate includes any turbulence in the recording, but that is the
+same for every candidate so doesn't change which one wins. Every candidate
+is scored over the same valid subapertures (those of the current params),
+and candidates are spread over a process pool.
+"""
+
+import glob
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from centroidertools import calib
+from centroidertools.pycentroider import subap_pixels, docentroids
+
+# spot shifts (pixels) used to measure the linearity
+SHIFTS = (-0.5, -0.25, 0.25, 0.5)
+# max frames used for the linearity (it costs len(SHIFTS) passes)
+LIN_FRAMES = 10
+
+# per-process copy of the recording (and of its shifted frames and valid
+# slopes), set by `_init_worker`
+_frames = None
+_bg = None
+_shifted = None
+_valid = None
+
+
+def load_recording(directory):
+    """load recorded frames, as saved for `scripts/play_images.py`
+
+    Returns:
+        dict of WFS index -> (frames ((nframes, img_h, img_w), float),
+                              bg ((img_h, img_w), float))
+    """
+    from astropy.io import fits
+    frames = {}
+    bgs = {}
+    for fname in glob.glob(os.path.join(directory, "scmos*.fits")):
+        with fits.open(fname) as hdul:
+            camera = hdul[0].header["CAMERA"]
+            data = hdul[0].data.astype(np.float32)
+        # as in play_images.py, camera 5 is the NGS (wfs 0)
+        idx = int(camera.replace("scmos", "").replace("5", "0"))
+        if "_bg_" in fname:
+            bgs[idx] = data
+        else:
+            frames[idx] = data
+    return {
+        idx: (frames[idx], bgs.get(idx, np.zeros_like(frames[idx][0])))
+        for idx in frames
+    }
+
+
+def centroid_frames(frames, bg, lutx, luty, *, fovx, fovy, cogthresh,
+                    bgnpix):
+    """slopes ((nframes, 2*nsub), float) and flux ((nframes, nsub), float)
+    of each frame, as the centroider would measure them"""
+    offset, gain, rows_used = calib.prepare_calib(
+        bg, luty, thresh=cogthresh, fovy=fovy
+    )
+    geometry = subap_pixels(lutx, luty, fovx=fovx, fovy=fovy,
+                            img_w=bg.shape[1])
+    results = [
+        docentroids(im, bg, offset, gain, rows_used, *geometry,
+                    thresh=cogthresh, bgnpix=bgnpix)
+        for im in frames
+    ]
+    slopes = np.array([r[0] for r in results])
+    flux = np.array([r[1] for r in results])
+    return slopes, flux
+
+
+def shift_frames(frames, bg, shifts=SHIFTS):
+    """the first LIN_FRAMES `frames`, with the light (but not the
+    background) shifted by each of `shifts` pixels in x and y, by a Fourier
+    shift (which keeps the shape of the spots, unlike interpolation)
+
+    Returns:
+        ((len(shifts), nframes, img_h, img_w), float)
+    """
+    light = frames[:LIN_FRAMES] - bg
+    spectrum = np.fft.rfft2(light)
+    ky = np.fft.fftfreq(light.shape[1])[:, None]
+    kx = np.fft.rfftfreq(light.shape[2])[None, :]
+    return np.array([
+        bg + np.fft.irfft2(
+            spectrum*np.exp(-2j*np.pi*(kx + ky)*shift), s=light.shape[1:]
+        ) for shift in shifts
+    ], dtype=np.float32)
+
+
+def valid_slopes(flux, fluxthresh=0.3):
+    """mask of the slopes ((2*nsub,), bool) of the subapertures whose mean
+    flux (over the frames of `flux` ((nframes, nsub), float)) is at least
+    `fluxthresh` of the brightest"""
+    mean_flux = flux.mean(axis=0)
+    return np.tile(mean_flux >= fluxthresh*mean_flux.max(), 2)
+
+
+def score(frames, bg, lutx, luty, *, fovx, fovy, cogthresh, bgnpix,
+          fluxthresh=0.3, shifted=None, valid=None):
+    """score a candidate on the recording, returns a dict of the metrics
+    (see the module docstring). `shifted` (from `shift_frames`) and `valid`
+    (from `valid_slopes`) are computed from the recording (with this
+    candidate's flux) if not given, but should be shared when comparing
+    candidates."""
+    nsub = lutx.shape[0]
+    kwargs = dict(fovx=fovx, fovy=fovy, cogthresh=cogthresh, bgnpix=bgnpix)
+    slopes, flux = centroid_frames(frames, bg, lutx, luty, **kwargs)
+    if valid is None:
+        valid = valid_slopes(flux, fluxthresh)
+    if shifted is None:
+        shifted = shift_frames(frames, bg)
+
+    # response to shifting the spots, ideally slope -> slope + shift
+    base = slopes[:LIN_FRAMES, valid].mean(axis=0)
+    response = []
+    for lin_frames in shifted:
+        shifted_slopes, _ = centroid_frames(
+            lin_frames, bg, lutx, luty, **kwargs
+        )
+        response.append(shifted_slopes[:, valid].mean(axis=0) - base)
+    response = np.array(response)
+    expected = np.array(SHIFTS)[:, None]*np.ones((1, response.shape[1]))
+    gain = (response*expected).sum()/(expected**2).sum()
+    nonlinearity = np.sqrt(np.mean((response - gain*expected)**2))/gain
+
+    if slopes.shape[0] > 1:
+        jitter = np.diff(slopes[:, valid], axis=0).std()/np.sqrt(2)
+    else:
+        jitter = 0.0
+    noise = jitter/gain
+    return {
+        "noise": float(noise),
+        "gain": float(gain),
+        "nonlinearity": float(nonlinearity),
+        "score": float(noise + nonlinearity),
+        "nvalid": int(valid[:nsub].sum()),
+    }
+
+
+def dark_noise(frames, bg, ncols=4):
+    """std (ADU) of the background-subtracted edge columns of the frames,
+    which see no light"""
+    edges = np.r_[0:ncols, bg.shape[1]-ncols:bg.shape[1]]
+    return float((frames[:, :, edges] - bg[:, edges]).std())
+
+
+def candidates(config, frames, bg, *, nthresh=6, bgnpix=(0, 4, 8, 16, 22),
+               dfov=(-2, 0, 2)):
+    """grid of candidate params for a WFS `config` (a `Config`), with
+    `cogthresh` in multiples of the dark noise, `bgnpix` limited to the
+    columns left of the pupil, and square FOVs around the current one (as
+    well as the current params)"""
+    sigma = dark_noise(frames, bg)
+    xx_c = config.build_lut()[0]
+    margin = int(np.floor(xx_c.min() - config.fov_x//2 + 0.5))
+    fovs = sorted({
+        max(config.fov_x + d, 2) for d in dfov
+    })
+    # always include the current params, for comparison
+    grid = [{
+        "fov_x": config.fov_x,
+        "fov_y": config.fov_y,
+        "bgnpix": config.bgnpix,
+        "cogthresh": config.cogthresh,
+    }]
+    for fov, npix, k in itertools.product(
+        fovs, bgnpix, range(nthresh)
+    ):
+        candidate = {
+            "fov_x": fov,
+            "fov_y": fov,
+            "bgnpix": npix,
+            "cogthresh": round(float(k*sigma), 2),
+        }
+        if npix >= margin or _is_current(candidate, config):
+            continue
+        grid.append(candidate)
+    return grid
+
+
+def _init_worker(frames, bg, shifted, valid):
+    global _frames, _bg, _shifted, _valid
+    _frames = frames
+    _bg = bg
+    _shifted = shifted
+    _valid = valid
+
+
+def _score_candidate(config, candidate):
+    config = type(config)(**dict(config.to_dict(), **candidate))
+    try:
+        lutx, luty, _, _ = config.build_lut()
+    except ValueError:
+        # FOV too large for this geometry
+        return None
+    result = score(
+        _frames, _bg, lutx, luty,
+        fovx=config.fov_x, fovy=config.fov_y,
+        cogthresh=config.cogthresh, bgnpix=config.bgnpix,
+        shifted=_shifted, valid=_valid
+    )
+    return dict(candidate, **result)
+
+
+def tune(config, frames, bg, *, workers=None, grid=None):
+    """score every candidate (see `candidates`) on the recorded `frames`,
+    returning the results sorted from best to worst"""
+    if grid is None:
+        grid = candidates(config, frames, bg)
+    # the same shifted frames, and valid subapertures (from the current
+    # params), for every candidate
+    shifted = shift_frames(frames, bg)
+    lutx, luty, _, _ = config.build_lut()
+    _, flux = centroid_frames(
+        frames, bg, lutx, luty, fovx=config.fov_x, fovy=config.fov_y,
+        cogthresh=config.cogthresh, bgnpix=config.bgnpix
+    )
+    valid = valid_slopes(flux)
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_worker,
+        initargs=(frames, bg, shifted, valid)
+    ) as pool:
+        results = list(pool.map(
+            _score_candidate, itertools.repeat(config), grid
+        ))
+    results = [result for result in results if result is not None]
+    return sorted(results, key=lambda result: result["score"])
+
+
+def _is_current(result, config):
+    return (
+        result["fov_x"] == config.fov_x and
+        result["fov_y"] == config.fov_y and
+        result["bgnpix"] == config.bgnpix and
+        bool(np.isclose(result["cogthresh"], config.cogthresh))
+    )
+
+
+def print_report(idx, config, results, ntop=5):
+    """print the best `ntop` results, and the current params if not in them"""
+    print(f"wfs{idx:01d}: {len(results)} candidates")
+    print(f"    {'rank':>4s} | {'fov':>4s} | {'bgnpix':>6s} | "
+          f"{'cogthresh':>9s} | {'noise':>7s} | {'gain':>5s} | "
+          f"{'nonlin':>7s} | {'score':>7s}")
+    for rank, result in enumerate(results):
+        current = _is_current(result, config)
+        if rank >= ntop and not current:
+            continue
+        print(f"    {rank+1:4d} | {result['fov_x']:4d} | "
+              f"{result['bgnpix']:6d} | {result['cogthresh']:9.2f} | "
+              f"{result['noise']:7.4f} | {result['gain']:5.3f} | "
+              f"{result['nonlinearity']:7.4f} | {result['score']:7.4f}" +
+              (" (current)" if current else ""))
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""Watch the centroider config file for changes (used by `cent config
+watch`), and work out which WFS entries changed.
+
+Uses inotify (via ctypes) on the directory of the file, so that editors
+which save by writing a new file and renaming it over the old one are
+caught too, falling back to polling the mtime where inotify isn't available.
+Only completed saves (the file closed after writing, or renamed into place)
+count as changes, so a half-written file is never reloaded.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+
+# inotify event masks, from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = 0o4000
+_EVENT = struct.Struct("iIII")  # wd, mask, cookie, len
+
+# which config fields need what to apply them
+GEOMETRY_FIELDS = {
+    "deltax", "deltay", "img_w", "img_h", "pitch_x", "pitch_y", "n_subx",
+    "n_suby", "theta",
+}
+FOV_FIELDS = {"fov_x", "fov_y"}
+PARAM_FIELDS = {"cogthresh", "bgnpix"}
+
+
+class FileWatcher():
+    """Block until a file is changed, e.g.:
+
+        watcher = FileWatcher(filename)
+        while True:
+            if watcher.wait(timeout=1.0):
+                reload(filename)
+    """
+
+    def __init__(self, filename):
+        self.filename = os.path.abspath(filename)
+        self._fd = None
+        self._mtime = self._get_mtime()
+        libc_name = ctypes.util.find_library("c")
+        try:
+            libc = ctypes.CDLL(libc_name, use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+            wd = libc.inotify_add_watch(
+                fd, os.path.dirname(self.filename).encode(),
+                IN_CLOSE_WRITE | IN_MOVED_TO
+            )
+            if wd < 0:
+                os.close(fd)
+                raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+            self._fd = fd
+        except (OSError, AttributeError):
+            # no inotify (e.g., not linux), poll the mtime instead
+            self._fd = None
+
+    def _get_mtime(self):
+        try:
+            return os.stat(self.filename).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def wait(self, timeout=None) -> bool:
+        """wait for the file to change, returns False on timeout"""
+        if self._fd is None:
+            return self._wait_poll(timeout)
+        t_end = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None
+            if t_end is not None:
+                remaining = max(t_end - time.monotonic(), 0.0)
+            ready, _, _ = select.select([self._fd], [], [], remaining)
+            if not ready:
+                return False
+            if self._read_events():
+                return True
+
+    def _read_events(self) -> bool:
+        """read pending events, returns True if any are for our file"""
+        changed = False
+        name = os.path.basename(self.filename).encode()
+        try:
+            data = os.read(self._fd, 65536)
+        except BlockingIOError:
+            return False
+        offset = 0
+        while offset < len(data):
+            _, mask, _, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            event_name = data[offset:offset+length].rstrip(b"\0")
+            offset += length
+            if event_name == name:
+                changed = True
+        return changed
+
+    def _wait_poll(self, timeout=None, sleep_t=0.1) -> bool:
+        t0 = time.monotonic()
+        while timeout is None or time.monotonic() - t0 < timeout:
+            mtime = self._get_mtime()
+            if mtime != self._mtime:
+                # wait for the writes to settle, so we don't see a
+                # half-written file
+                time.sleep(sleep_t)
+                if self._get_mtime() != mtime:
+                    continue
+                self._mtime = mtime
+                return True
+            time.sleep(sleep_t)
+        return False
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+def diff_configs(old, new):
+    """which fields of which WFS configs have changed
+
+    Args:
+        old, new : dicts of WFS index -> `Config`
+    Returns:
+        dict of WFS index -> set of changed field names, for WFSs in `new`
+        that changed (all fields for WFSs not in `old`)
+    """
+    changes = {}
+    for idx, config in new.items():
+        new_dict = config.to_dict()
+        if idx not in old:
+            changes[idx] = set(new_dict)
+            continue
+        old_dict = old[idx].to_dict()
+        fields = {
+            field for field, value in new_dict.items()
+            if old_dict.get(field) != value
+        }
+        if fields:
+            changes[idx] = fields
+    return changes
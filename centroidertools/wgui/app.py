@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 from flask import Flask, render_template, Response, request
-from pyMilk.interfacing.isio_shmlib import SHM
+from centroidertools.backend import SHM
 from PIL import Image
 import io
 import matplotlib as mpl
@@ -27,6 +27,19 @@ def get_shm_wrapper(shm_name):
     return shm
 
 
+def encode_frame(im, cmap=cm.turbo, norm=None):
+    """colour map an image and encode it as a png part of the multipart
+    stream"""
+    if norm is None:
+        norm = mpl.colors.Normalize()
+    frame = Image.fromarray(np.uint8(cmap(norm(im))*255))
+    file = io.BytesIO()
+    frame.convert("RGB").save(file, format="png")
+    file.seek(0)
+    return (b'--frame\r\n'
+            b'Content-Type: image/png\r\n\r\n' + file.read() + b'\r\n')
+
+
 def read_stacked_shms(*, prefix="", suffix=""):
     shms = []
     blank_dims = None
@@ -50,12 +63,7 @@ def read_stacked_shms(*, prefix="", suffix=""):
         ims = [im-im.min() for im in ims]
         ims = [im/im.max() for im in ims]
         im = np.concatenate(ims, axis=1)
-        frame = Image.fromarray(np.uint8(cmap(norm(im))*255))
-        file = io.BytesIO()
-        frame.convert("RGB").save(file, format="png")
-        file.seek(0)
-        yield (b'--frame\r\n'
-               b'Content-Type: image/png\r\n\r\n' + file.read() + b'\r\n')
+        yield encode_frame(im, cmap, norm)
 
 
 def read_single_shm(name):
@@ -70,12 +78,7 @@ def read_single_shm(name):
         im = shm.get_data()
         im -= im.min()
         im /= im.max()
-        frame = Image.fromarray(np.uint8(cmap(norm(im))*255))
-        file = io.BytesIO()
-        frame.convert("RGB").save(file, format="png")
-        file.seek(0)
-        yield (b'--frame\r\n'
-               b'Content-Type: image/png\r\n\r\n' + file.read() + b'\r\n')
+        yield encode_frame(im, cmap, norm)
 
 
 @app.route('/stream', methods=["GET"])
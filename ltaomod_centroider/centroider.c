@@ -5,8 +5,17 @@
  * Calculate centroids from image stream
  */
 
+#ifndef _GNU_SOURCE
+#define _GNU_SOURCE  // pthread_setaffinity_np
+#endif
+
 #include "CommandLineInterface/CLIcore.h"
 #include "math.h"
+#include <stdlib.h>
+#include <string.h>
+#include <pthread.h>
+#include <sched.h>
+#include <time.h>
 
 // Local variables pointers
 static uint32_t *wfsnumber;
@@ -17,6 +26,8 @@ static uint32_t *fovy;
 static float *thresh;
 static uint32_t *bgnpix;
 static float *fluxthresh;
+static uint32_t *nthreads;
+static uint32_t *cpuset;
 
 
 static CLICMDARGDEF farg[] =
@@ -93,6 +104,24 @@ static CLICMDARGDEF farg[] =
         (void **) &fluxthresh,
         NULL
     },
+    {
+        CLIARG_UINT32,
+        ".nthreads",
+        "number of threads to split the subapertures across (read at run start)",
+        "1",
+        CLIARG_HIDDEN_DEFAULT,
+        (void **) &nthreads,
+        NULL
+    },
+    {
+        CLIARG_UINT32,
+        ".cpuset",
+        "bitmask of CPUs to pin the worker threads to, 0 for no pinning (read at run start)",
+        "0",
+        CLIARG_HIDDEN_DEFAULT,
+        (void **) &cpuset,
+        NULL
+    },
 };
 
 static errno_t customCONFsetup(){return RETURN_SUCCESS;}
@@ -111,55 +140,221 @@ static errno_t help_function()
     return RETURN_SUCCESS;
 }
 
-static errno_t docentroids(
+// Precomputed calibration, folding the static background, flat field and
+// threshold into a gain and an offset frame so that the per-pixel work in
+// docentroids is one multiply-subtract (plus the per-row background). Only
+// rebuilt when the inputs it depends on change, detected via the stream
+// counters and FPS parameters. The same calibration is implemented in
+// centroidertools/calib.py.
+typedef struct
+{
+    float *offset;     // gain*wfs_bg (+ thresh), one value per pixel
+    float *gain;       // 1/wfs_flat (0 for dead pixels), one value per pixel
+    uint32_t *rows;    // image rows touched by at least one subaperture
+    uint32_t nrows;
+    uint32_t npix;     // size of the offset frame
+    // inputs used for the current build
+    uint64_t bg_cnt;
+    uint64_t flat_cnt;
+    uint64_t luty_cnt;
+    uint64_t slot_cnt;
+    float thresh;
+    uint32_t fovy;
+    int built;
+} CALIB;
+
+static CALIB calib = {0};
+
+// The LUTs are double buffered: lutx/luty hold two slots of nsub entries,
+// and lutslot holds the index of the active one. Writers fill the inactive
+// slot and then flip lutslot, so picking the slot once per frame gives every
+// frame one complete LUT without stopping the loop. A single slot LUT (as
+// written by older tools) is always slot 0. See centroidertools/lutbuf.py.
+static uint32_t activeslot(
+    IMGID *subap_lut,
+    IMGID *lut_slot,
+    uint32_t nsub
+)
+{
+    uint64_t nelem = (uint64_t) subap_lut->md->size[0]*subap_lut->md->size[1];
+    if (nelem < 2*nsub) {
+        return 0;
+    }
+    return (lut_slot->im->array.F[0] != 0.0) ? 1 : 0;
+}
+
+static errno_t prepcalib(
     IMGID *wfs_img,  // wfs raw image
-    IMGID *flux_map,  // flux map
-    IMGID *slope_map,  // slope map
-    IMGID *subap_lut_x,  // pixel position (x) of centre of subap
-    IMGID *subap_lut_y,  // pixel position (y) of centre of subap
-    //IMGID *wfs_flat,  // pixel position (y) of centre of subap
-    IMGID *wfs_bg, // pixel position (y) of centre of subap
+    IMGID *subap_lut_y,  // pixel position (y) of centre of subap, all slots
+    IMGID *lut_slot,  // active LUT slot
+    float *lut_y,  // pixel position (y) of centre of subap, active slot
+    IMGID *wfs_bg,  // static background
+    IMGID *wfs_flat,  // flat field, normalised per subaperture (or all 0)
+    IMGID *calib_img,  // published copy of the calibration frame
     float thresh,
-    uint32_t fovx,
     uint32_t fovy,
     uint32_t nsubx,
-    uint32_t nsuby,
-    uint32_t bgnpix
+    uint32_t nsuby
 )
 {
     DEBUG_TRACE_FSTART();
-    // custom stream process function code
 
-    // resolve imgpos
-    resolveIMGID(wfs_img, ERRMODE_ABORT);
+    if (calib.built &&
+            calib.bg_cnt == wfs_bg->md->cnt0 &&
+            calib.flat_cnt == wfs_flat->md->cnt0 &&
+            calib.luty_cnt == subap_lut_y->md->cnt0 &&
+            calib.slot_cnt == lut_slot->md->cnt0 &&
+            calib.thresh == thresh &&
+            calib.fovy == fovy) {
+        // nothing has changed
+        DEBUG_TRACE_FEXIT();
+        return RETURN_SUCCESS;
+    }
 
-    // Create output image if needed
-    imcreateIMGID(flux_map);
-    imcreateIMGID(slope_map);
+    uint32_t img_w = wfs_img->md->size[0];
+    uint32_t img_h = wfs_img->md->size[1];
+    if (calib.npix != img_w*img_h) {
+        free(calib.offset);
+        free(calib.gain);
+        free(calib.rows);
+        calib.npix = img_w*img_h;
+        calib.offset = (float *) malloc(sizeof(float)*calib.npix);
+        calib.gain = (float *) malloc(sizeof(float)*calib.npix);
+        calib.rows = (uint32_t *) malloc(sizeof(uint32_t)*img_h);
+    }
 
-    flux_map->md->write = 1;
-    slope_map->md->write = 1;
+    // the flat stream is created zeroed if nobody has published one, in
+    // which case (or if it doesn't match the image) there's no flat-fielding
+    int have_flat = 0;
+    if (wfs_flat->md->size[0] == img_w && wfs_flat->md->size[1] == img_h) {
+        for (uint32_t ii=0; ii<calib.npix; ii++) {
+            if (wfs_flat->im->array.F[ii] != 0.0) {
+                have_flat = 1;
+                break;
+            }
+        }
+    }
+    for (uint32_t ii=0; ii<calib.npix; ii++) {
+        if (!have_flat) {
+            calib.gain[ii] = 1.0;
+        } else if (wfs_flat->im->array.F[ii] > 0.0) {
+            calib.gain[ii] = 1.0/wfs_flat->im->array.F[ii];
+        } else {
+            // dead pixel
+            calib.gain[ii] = 0.0;
+        }
+    }
+
+    // fold background, flat and threshold into a single frame
+    float thresh_offset = (thresh > -1.0) ? thresh : 0.0;
+    for (uint32_t ii=0; ii<calib.npix; ii++) {
+        calib.offset[ii] = calib.gain[ii]*wfs_bg->im->array.F[ii] + thresh_offset;
+    }
 
-    float bg_row[wfs_img[0].md[0].size[1]];
-    for (int row=0; row<wfs_img[0].md[0].size[1]; row++){
-        bg_row[row] = 0.0;
-        for (int column_offset=0; column_offset<bgnpix; column_offset++){
-            bg_row[row] += wfs_img[0].im->array.UI16[wfs_img[0].md[0].size[0]*(row)+column_offset] - 
-                           wfs_bg[0].im->array.F[wfs_img[0].md[0].size[0]*(row)+column_offset];
-            bg_row[row] += wfs_img[0].im->array.UI16[wfs_img[0].md[0].size[0]*(row+1)-column_offset-1] -
-                           wfs_bg[0].im->array.F[wfs_img[0].md[0].size[0]*(row+1)-column_offset-1];
+    // only rows that are read by a subaperture need a row background
+    uint8_t row_used[img_h];
+    memset(row_used, 0, img_h);
+    for (int i=0; i<nsubx*nsuby; i++) {
+        uint32_t y0 = round(lut_y[i] - fovy/2);
+        for (int jjj=0; jjj<fovy; jjj++) {
+            if (y0+jjj < img_h) {
+                row_used[y0+jjj] = 1;
+            }
         }
-        if (bgnpix>0) {
-            bg_row[row] /= (2*bgnpix);
-        }   
     }
-    
-	for (int i=0; i<nsubx*nsuby; i++){
+    calib.nrows = 0;
+    for (uint32_t row=0; row<img_h; row++) {
+        if (row_used[row]) {
+            calib.rows[calib.nrows++] = row;
+        }
+    }
+
+    calib.bg_cnt = wfs_bg->md->cnt0;
+    calib.flat_cnt = wfs_flat->md->cnt0;
+    calib.luty_cnt = subap_lut_y->md->cnt0;
+    calib.slot_cnt = lut_slot->md->cnt0;
+    calib.thresh = thresh;
+    calib.fovy = fovy;
+    calib.built = 1;
+
+    // publish for inspection (e.g., by `cent config calib`)
+    calib_img->md->write = 1;
+    memcpy(calib_img->im->array.F, calib.offset, sizeof(float)*calib.npix);
+
+    DEBUG_TRACE_FEXIT();
+    return RETURN_SUCCESS;
+}
+
+// Arguments of the current frame, shared by the worker threads. Each
+// worker takes a contiguous block of the rows (for the row background) and
+// then of the subapertures, with a barrier in between since subapertures
+// read the row background of rows owned by other workers.
+typedef struct
+{
+    IMGID *wfs_img;
+    IMGID *flux_map;
+    IMGID *slope_map;
+    float *lut_x;
+    float *lut_y;
+    IMGID *wfs_bg;
+    float *bg_row;
+    float thresh;
+    uint32_t fovx;
+    uint32_t fovy;
+    uint32_t nsubx;
+    uint32_t nsuby;
+    uint32_t bgnpix;
+} CENTROIDJOB;
+
+static CENTROIDJOB job;
+
+#define MAX_NTHREADS 16
+
+typedef struct
+{
+    uint32_t worker;
+    uint32_t nworkers;
+} WORKER;
+
+static pthread_barrier_t pool_barrier;
+static WORKER workers[MAX_NTHREADS];
+static pthread_t pool_threads[MAX_NTHREADS];
+static uint32_t pool_size = 1;
+// set (before a final barrier) to make the workers exit, see stoppool
+static int pool_quit = 0;
+
+static void bgrows(uint32_t first, uint32_t last)
+{
+    uint32_t img_w = job.wfs_img->md->size[0];
+    uint16_t *raw = job.wfs_img->im->array.UI16;
+    float *bg = job.wfs_bg->im->array.F;
+    for (uint32_t r=first; r<last; r++){
+        uint32_t row = calib.rows[r];
+        job.bg_row[row] = 0.0;
+        for (int column_offset=0; column_offset<job.bgnpix; column_offset++){
+            job.bg_row[row] += raw[img_w*(row)+column_offset] -
+                               bg[img_w*(row)+column_offset];
+            job.bg_row[row] += raw[img_w*(row+1)-column_offset-1] -
+                               bg[img_w*(row+1)-column_offset-1];
+        }
+        if (job.bgnpix>0) {
+            job.bg_row[row] /= (2*job.bgnpix);
+        }
+    }
+}
+
+static void centroidsubaps(uint32_t first, uint32_t last)
+{
+    uint32_t img_w = job.wfs_img->md->size[0];
+    uint32_t nsub = job.nsubx*job.nsuby;
+    uint32_t fovx = job.fovx;
+    uint32_t fovy = job.fovy;
+	for (int i=first; i<last; i++){
 		float intensityx = 0.0;
 		float intensityy = 0.0;
 		float intensity = 0.0;
-		float xc = subap_lut_x[0].im->array.F[i];
-	    float yc = subap_lut_y[0].im->array.F[i];
+		float xc = job.lut_x[i];
+	    float yc = job.lut_y[i];
         uint32_t x0 = round(xc - fovx/2);
         uint32_t y0 = round(yc - fovy/2);
         float x_offset = xc - x0 - 0.5;
@@ -167,13 +362,10 @@ static errno_t docentroids(
 
 		for (int iii=0; iii<fovx; iii++){
 			for (int jjj=0; jjj<fovy; jjj++){
-                uint32_t idx = wfs_img[0].md[0].size[0]*(y0+jjj)+x0+iii;
-				float pixel = wfs_img[0].im->array.UI16[idx];
-                //pixel *= wfs_flat[0].im->array.F[idx];
-                pixel -= wfs_bg[0].im->array.F[idx];
-				pixel -= bg_row[y0+jjj];
-                if (thresh > -1.0) {
-					pixel -= thresh;
+                uint32_t idx = img_w*(y0+jjj)+x0+iii;
+                // background, flat (and threshold) are folded into calib
+				float pixel = (job.wfs_img->im->array.UI16[idx] - job.bg_row[y0+jjj])*calib.gain[idx] - calib.offset[idx];
+                if (job.thresh > -1.0) {
 					if (pixel < 0.0) {
 						pixel = 0.0;
 					}
@@ -183,22 +375,172 @@ static errno_t docentroids(
 				intensity += pixel;
 			}
 		}
-		slope_map[0].im->array.F[i] = intensityx/(intensity+1e-1);
-		slope_map[0].im->array.F[i+nsubx*nsuby] = intensityy/(intensity+1e-1);
-		flux_map[0].im->array.F[i] = intensity;
+		job.slope_map->im->array.F[i] = intensityx/(intensity+1e-1);
+		job.slope_map->im->array.F[i+nsub] = intensityy/(intensity+1e-1);
+		job.flux_map->im->array.F[i] = intensity;
 	}
-    
+}
+
+// process this worker's share of the current job
+static void centroidblock(WORKER *w)
+{
+    uint32_t nsub = job.nsubx*job.nsuby;
+    bgrows(calib.nrows*w->worker/w->nworkers,
+           calib.nrows*(w->worker+1)/w->nworkers);
+    if (w->nworkers > 1) {
+        pthread_barrier_wait(&pool_barrier);
+    }
+    centroidsubaps(nsub*w->worker/w->nworkers,
+                   nsub*(w->worker+1)/w->nworkers);
+}
+
+static void *centroidworker(void *arg)
+{
+    WORKER *w = (WORKER *) arg;
+    while (1) {
+        // wait for the next frame, do our share, then wait for the others
+        pthread_barrier_wait(&pool_barrier);
+        if (pool_quit) {
+            break;
+        }
+        centroidblock(w);
+        pthread_barrier_wait(&pool_barrier);
+    }
+    return NULL;
+}
+
+// start the persistent worker pool. The calling thread acts as worker 0.
+static errno_t startpool(uint32_t nworkers, uint32_t cpus)
+{
+    if (nworkers < 1) {
+        nworkers = 1;
+    }
+    if (nworkers > MAX_NTHREADS) {
+        nworkers = MAX_NTHREADS;
+    }
+    pool_size = nworkers;
+    for (uint32_t w=0; w<nworkers; w++) {
+        workers[w].worker = w;
+        workers[w].nworkers = nworkers;
+    }
+    if (nworkers == 1) {
+        return RETURN_SUCCESS;
+    }
+    pthread_barrier_init(&pool_barrier, NULL, nworkers);
+    // pin the helper threads round-robin over the CPUs in cpuset (the main
+    // thread is left to the processinfo CPU set)
+    int cpu_list[32];
+    int ncpus = 0;
+    for (int cpu=0; cpu<32; cpu++) {
+        if (cpus & (1u << cpu)) {
+            cpu_list[ncpus++] = cpu;
+        }
+    }
+    for (uint32_t w=1; w<nworkers; w++) {
+        pthread_create(&pool_threads[w], NULL, centroidworker, &workers[w]);
+        if (ncpus > 0) {
+            cpu_set_t set;
+            CPU_ZERO(&set);
+            CPU_SET(cpu_list[(w-1) % ncpus], &set);
+            pthread_setaffinity_np(pool_threads[w], sizeof(cpu_set_t), &set);
+        }
+    }
+    return RETURN_SUCCESS;
+}
+
+// stop the worker pool, when the run loop ends, so that the next run start
+// (e.g., with a different nthreads) gets a fresh pool and barrier
+static errno_t stoppool()
+{
+    if (pool_size > 1) {
+        // the workers are waiting for the next frame, release them to quit
+        pool_quit = 1;
+        pthread_barrier_wait(&pool_barrier);
+        for (uint32_t w=1; w<pool_size; w++) {
+            pthread_join(pool_threads[w], NULL);
+        }
+        pthread_barrier_destroy(&pool_barrier);
+        pool_quit = 0;
+    }
+    pool_size = 1;
+    return RETURN_SUCCESS;
+}
+
+static errno_t docentroids(
+    IMGID *wfs_img,  // wfs raw image
+    IMGID *flux_map,  // flux map
+    IMGID *slope_map,  // slope map
+    float *lut_x,  // pixel position (x) of centre of subap, active slot
+    float *lut_y,  // pixel position (y) of centre of subap, active slot
+    IMGID *wfs_bg, // static background
+    float *bg_row,  // per-row background, one value per image row
+    float thresh,
+    uint32_t fovx,
+    uint32_t fovy,
+    uint32_t nsubx,
+    uint32_t nsuby,
+    uint32_t bgnpix
+)
+{
+    DEBUG_TRACE_FSTART();
+    // custom stream process function code
+
+    // resolve imgpos
+    resolveIMGID(wfs_img, ERRMODE_ABORT);
+
+    // Create output image if needed
+    imcreateIMGID(flux_map);
+    imcreateIMGID(slope_map);
+
+    flux_map->md->write = 1;
+    slope_map->md->write = 1;
+
+    job.wfs_img = wfs_img;
+    job.flux_map = flux_map;
+    job.slope_map = slope_map;
+    job.lut_x = lut_x;
+    job.lut_y = lut_y;
+    job.wfs_bg = wfs_bg;
+    job.bg_row = bg_row;
+    job.thresh = thresh;
+    job.fovx = fovx;
+    job.fovy = fovy;
+    job.nsubx = nsubx;
+    job.nsuby = nsuby;
+    job.bgnpix = bgnpix;
+
+    if (pool_size > 1) {
+        // release the workers, do our share, and wait for theirs
+        pthread_barrier_wait(&pool_barrier);
+        centroidblock(&workers[0]);
+        pthread_barrier_wait(&pool_barrier);
+    } else {
+        centroidblock(&workers[0]);
+    }
+
     DEBUG_TRACE_FEXIT();
     return RETURN_SUCCESS;
 }
 
 
+// layout of the per-WFS telemetry stream (telem%01u), keep in sync with
+// centroidertools/telemetry.py
+#define TELEM_NVALID 0
+#define TELEM_TTX 1
+#define TELEM_TTY 2
+#define TELEM_MAXFLUX 3
+#define TELEM_COMPUTEUS 4
+#define TELEM_NTHREADS 5
+#define TELEM_SIZE 6
+
 static errno_t reducemeasurements(
     IMGID *flux_map,  // flux map
     IMGID *slope_map,  // slope map
+    IMGID *telem,  // per-frame diagnostics
     uint32_t nsubx,
     uint32_t nsuby,
-    float fluxthresh
+    float fluxthresh,
+    float compute_us  // time spent in docentroids
 )
 {
     DEBUG_TRACE_FSTART();
@@ -207,6 +549,7 @@ static errno_t reducemeasurements(
     // resolve imgpos
     resolveIMGID(flux_map, ERRMODE_ABORT);
     resolveIMGID(slope_map, ERRMODE_ABORT);
+    resolveIMGID(telem, ERRMODE_ABORT);
 
     // not sure if -infty is safe, so let's just take the 0th subaperture flux
     // as initial "maximum"
@@ -230,7 +573,16 @@ static errno_t reducemeasurements(
         tt_x /= num_valid;
         tt_y /= num_valid;
     }
-    printf("%5u  %8.3f  %8.3f\n", num_valid, tt_x, tt_y);
+    // publish to the telemetry stream rather than stdout, so that terminal
+    // I/O stays out of the loop
+    telem->md->write = 1;
+    telem->im->array.F[TELEM_NVALID] = num_valid;
+    telem->im->array.F[TELEM_TTX] = tt_x;
+    telem->im->array.F[TELEM_TTY] = tt_y;
+    telem->im->array.F[TELEM_MAXFLUX] = max_flux;
+    telem->im->array.F[TELEM_COMPUTEUS] = compute_us;
+    // the size of the pool in use, since nthreads is only read at run start
+    telem->im->array.F[TELEM_NTHREADS] = pool_size;
 
     DEBUG_TRACE_FEXIT();
     return RETURN_SUCCESS;
@@ -258,14 +610,13 @@ static errno_t compute_function()
         WRITE_IMAGENAME(name, "luty%01u", *wfsnumber);
         subap_lut_y = stream_connect(name);
     }
-    /*
-    IMGID wfs_flat;
+    IMGID lut_slot;
     {
+        // written by the config tools, created (slot 0) if it doesn't exist
         char name[STRINGMAXLEN_STREAMNAME];
-        WRITE_IMAGENAME(name, "wfsflat%02u", *wfsnumber);
-        wfs_flat = stream_connect(name);
+        WRITE_IMAGENAME(name, "lutslot%01u", *wfsnumber);
+        lut_slot = stream_connect_create_2Df32(name, 1, 1);
     }
-    */
     IMGID wfs_bg;
     {
         char name[STRINGMAXLEN_STREAMNAME];
@@ -284,6 +635,31 @@ static errno_t compute_function()
         WRITE_IMAGENAME(name, "slopemap%01u", *wfsnumber);
         slope_map = stream_connect_create_2Df32(name, 32, 64);
     }
+    IMGID telem;
+    {
+        char name[STRINGMAXLEN_STREAMNAME];
+        WRITE_IMAGENAME(name, "telem%01u", *wfsnumber);
+        telem = stream_connect_create_2Df32(name, TELEM_SIZE, 1);
+    }
+    IMGID wfs_flat;
+    {
+        // published by `cent config flat`, created (all 0, i.e., no flat)
+        // here if it doesn't exist yet
+        resolveIMGID(&wfs_img, ERRMODE_ABORT);
+        char name[STRINGMAXLEN_STREAMNAME];
+        WRITE_IMAGENAME(name, "wfsflat%01u", *wfsnumber);
+        wfs_flat = stream_connect_create_2Df32(
+            name, wfs_img.md->size[0], wfs_img.md->size[1]
+        );
+    }
+    IMGID calib_img;
+    {
+        char name[STRINGMAXLEN_STREAMNAME];
+        WRITE_IMAGENAME(name, "calib%01u", *wfsnumber);
+        calib_img = stream_connect_create_2Df32(
+            name, wfs_img.md->size[0], wfs_img.md->size[1]
+        );
+    }
     list_image_ID();
 
     printf(" COMPUTE Flags = %ld\n", CLIcmddata.cmdsettings->flags);
@@ -308,18 +684,43 @@ static errno_t compute_function()
     // With :
     // INSERT_STD_PROCINFO_COMPUTEFUNC_START
 
+    startpool(*nthreads, *cpuset);
+    float *bg_row = (float *) calloc(wfs_img.md->size[1], sizeof(float));
+
     INSERT_STD_PROCINFO_COMPUTEFUNC_LOOPSTART
     {
 
+        // pick the LUT slot once, for the whole frame
+        uint32_t nsub = (*nsubx)*(*nsuby);
+        uint32_t slot = activeslot(&subap_lut_y, &lut_slot, nsub);
+        float *lut_x = subap_lut_x.im->array.F + slot*nsub;
+        float *lut_y = subap_lut_y.im->array.F + slot*nsub;
+
+        prepcalib(&wfs_img, &subap_lut_y, &lut_slot, lut_y, &wfs_bg,
+                  &wfs_flat, &calib_img, *thresh, *fovy, *nsubx, *nsuby);
+        if (calib_img.md->write == 1) {
+            // calibration was rebuilt this frame
+            processinfo_update_output_stream(processinfo, calib_img.ID);
+        }
+        struct timespec t0, t1;
+        clock_gettime(CLOCK_MONOTONIC, &t0);
         docentroids(&wfs_img, &flux_map, &slope_map,
-                    &subap_lut_x, &subap_lut_y, &wfs_bg,
+                    lut_x, lut_y, &wfs_bg, bg_row,
                     *thresh, *fovx, *fovy, *nsubx, *nsuby, *bgnpix);
+        clock_gettime(CLOCK_MONOTONIC, &t1);
+        float compute_us = (t1.tv_sec - t0.tv_sec)*1e6 +
+                           (t1.tv_nsec - t0.tv_nsec)*1e-3;
         processinfo_update_output_stream(processinfo, flux_map.ID);
         processinfo_update_output_stream(processinfo, slope_map.ID);
-        reducemeasurements(&flux_map, &slope_map, *nsubx, *nsuby, *fluxthresh);
+        reducemeasurements(&flux_map, &slope_map, &telem,
+                           *nsubx, *nsuby, *fluxthresh, compute_us);
+        processinfo_update_output_stream(processinfo, telem.ID);
     }
     INSERT_STD_PROCINFO_COMPUTEFUNC_END
 
+    stoppool();
+    free(bg_row);
+
     DEBUG_TRACE_FEXIT();
     return RETURN_SUCCESS;
 }
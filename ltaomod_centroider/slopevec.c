@@ -11,13 +11,20 @@
 #include "math.h"
 #include <stdbool.h>
 #include <sys/time.h>
+#include <errno.h>
+#include <pthread.h>
+#include <semaphore.h>
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
 
 // Local variables pointers
 static uint32_t *wfs_flags; // binary mask for valid WFSs
 static uint32_t *nsubx;
 static uint32_t *nsuby;
 static float *synctimeout;
-const uint32_t MAX_NWFS=5;
+static uint32_t *waitmode;
+#define MAX_NWFS 5
 
 
 static CLICMDARGDEF farg[] =
@@ -58,6 +65,15 @@ static CLICMDARGDEF farg[] =
         (void **) &synctimeout,
         NULL
     },
+    {
+        CLIARG_UINT32,
+        ".waitmode",
+        "0: busy poll the slopemaps, 1: block on them (read at run start)",
+        "0",
+        CLIARG_HIDDEN_DEFAULT,
+        (void **) &waitmode,
+        NULL
+    },
 };
 
 static errno_t customCONFsetup(){return RETURN_SUCCESS;}
@@ -76,9 +92,18 @@ static errno_t help_function()
     return RETURN_SUCCESS;
 }
 
+// layout of the sync telemetry stream (synctelem): the number of sync
+// timeouts each WFS was late for, followed by the total number of timeouts,
+// and the waitmode in use (posted at each run start).
+// Keep in sync with centroidertools/telemetry.py
+#define SYNCTELEM_TIMEOUTS MAX_NWFS
+#define SYNCTELEM_WAITMODE (MAX_NWFS+1)
+#define SYNCTELEM_SIZE (MAX_NWFS+2)
+
 static errno_t syncslopevec(
     IMGID slope_maps[],  // local slope map
     IMGID *slope_vec,  // global slope vector
+    IMGID *synctelem,  // timeout counters
     uint32_t wfs_flags,  // index of wfs
     uint32_t nsubx,
     uint32_t nsuby,
@@ -125,7 +150,15 @@ static errno_t syncslopevec(
             // if so, then send them anyway and reset ready_flags.
             if (elapsed > synctimeout) {
                 send = 1;
-                printf("timeout!\n");
+                // count the timeout against each late WFS, rather than
+                // printing, to keep terminal I/O out of the loop
+                synctelem->md->write = 1;
+                for (int i=0; i<MAX_NWFS; i++) {
+                    if ((wfs_flags & (1 << i)) && (ready_flags[i] == 0)) {
+                        synctelem->im->array.F[i] += 1;
+                    }
+                }
+                synctelem->im->array.F[SYNCTELEM_TIMEOUTS] += 1;
                 break;
             }
         }
@@ -170,6 +203,205 @@ static errno_t syncslopevec(
 
 
 
+// Blocking wait mode: one waiter thread per input blocks on its slopemap
+// semaphore, copies the slopes into a private staging vector and posts
+// `arrivals`. The main loop sleeps on `arrivals` (with a deadline once the
+// first WFS of a frame has landed), so no core is burnt between frames, and
+// copies the staging vector into the slope vector (with md->write set) when
+// the frame is complete, so readers never see a mix of two frames. The
+// waiters are started with the run loop (in waitmode 1) and stopped when it
+// ends.
+typedef struct
+{
+    IMGID *slope_map;
+    int wfs;  // wfs index (bit in wfs_flags)
+    int offset;  // offset of this wfs in the slope vector
+    int nslopes;
+} WAITER;
+
+static sem_t arrivals;
+static pthread_mutex_t ready_lock = PTHREAD_MUTEX_INITIALIZER;
+static uint32_t waiter_ready[MAX_NWFS];
+static WAITER waiters[MAX_NWFS];
+static pthread_t waiter_threads[MAX_NWFS];
+static uint32_t waiter_flags = 0;  // wfs_flags of the running waiters
+static volatile int waiters_quit = 0;
+static IMGID *staging_vec;  // slope vector the staging vector is copied to
+static float *staging = NULL;  // slopes of the frame being assembled
+static int staging_size = 0;
+
+// how often the waiters (and the main loop, while no slopemap arrives) check
+// whether to stop (us)
+#define WAITER_POLL_US 100000L
+
+// absolute CLOCK_REALTIME deadline `us` microseconds from now
+static void deadline_in(struct timespec *deadline, long us)
+{
+    clock_gettime(CLOCK_REALTIME, deadline);
+    deadline->tv_nsec += us*1000L;
+    deadline->tv_sec += deadline->tv_nsec / 1000000000L;
+    deadline->tv_nsec %= 1000000000L;
+}
+
+static void *slopemap_waiter(void *arg)
+{
+    WAITER *w = (WAITER *) arg;
+    while (!waiters_quit) {
+        struct timespec deadline;
+        deadline_in(&deadline, WAITER_POLL_US);
+        if (ImageStreamIO_semtimedwait(w->slope_map->im, 0, &deadline) != 0) {
+            // timed out (or interrupted), check whether to quit
+            continue;
+        }
+        // drive the semaphore to 0, as in the polling mode
+        while (ImageStreamIO_semtrywait(w->slope_map->im, 0) == 0) {}
+        pthread_mutex_lock(&ready_lock);
+        memcpy(&staging[w->offset], w->slope_map->im->array.F,
+               sizeof(float)*w->nslopes);
+        waiter_ready[w->wfs] = 1;
+        pthread_mutex_unlock(&ready_lock);
+        sem_post(&arrivals);
+    }
+    return NULL;
+}
+
+static errno_t start_waiters(
+    IMGID slope_maps[],
+    IMGID *slope_vec,
+    uint32_t wfs_flags,
+    uint32_t nsubx,
+    uint32_t nsuby
+)
+{
+    sem_init(&arrivals, 0, 0);
+    waiters_quit = 0;
+    waiter_flags = wfs_flags;
+    // start from the current slope vector, so WFSs that time out keep their
+    // last slopes, as in the polling mode
+    staging_vec = slope_vec;
+    staging_size = slope_vec->md->size[0]*slope_vec->md->size[1];
+    staging = (float *) malloc(sizeof(float)*staging_size);
+    memcpy(staging, slope_vec->im->array.F, sizeof(float)*staging_size);
+    int wfs_idx = 0;
+    for (int i=0; i<MAX_NWFS; i++) {
+        waiter_ready[i] = 0;
+        if (wfs_flags & (1 << i)) {
+            resolveIMGID(&slope_maps[i], ERRMODE_ABORT);
+            waiters[i].slope_map = &slope_maps[i];
+            waiters[i].wfs = i;
+            waiters[i].nslopes = nsubx*nsuby*2;
+            waiters[i].offset = wfs_idx*nsubx*nsuby*2;
+            pthread_create(&waiter_threads[i], NULL, slopemap_waiter,
+                           &waiters[i]);
+            wfs_idx++;
+        }
+    }
+    return RETURN_SUCCESS;
+}
+
+// stop and join the waiters, so that they don't keep taking the slopemap
+// semaphores from the polling mode (or from the next set of waiters)
+static errno_t stop_waiters()
+{
+    waiters_quit = 1;
+    for (int i=0; i<MAX_NWFS; i++) {
+        if (waiter_flags & (1 << i)) {
+            pthread_join(waiter_threads[i], NULL);
+        }
+    }
+    waiter_flags = 0;
+    sem_destroy(&arrivals);
+    free(staging);
+    staging = NULL;
+    return RETURN_SUCCESS;
+}
+
+// check whether all flagged WFSs have arrived (or `force`), and if so, copy
+// the staging vector into the slope vector (marking it as being written, until
+// it's posted) and reset the flags for the next frame. Returns 1 if the frame
+// is complete.
+static int take_ready(uint32_t wfs_flags, IMGID *synctelem, int force)
+{
+    int complete = 1;
+    pthread_mutex_lock(&ready_lock);
+    for (int i=0; i<MAX_NWFS; i++) {
+        if (wfs_flags & (1 << i)) {
+            complete &= (waiter_ready[i] > 0);
+        }
+    }
+    if (!complete && force) {
+        // timed out, count it against each late WFS
+        synctelem->md->write = 1;
+        for (int i=0; i<MAX_NWFS; i++) {
+            if ((wfs_flags & (1 << i)) && (waiter_ready[i] == 0)) {
+                synctelem->im->array.F[i] += 1;
+            }
+        }
+        synctelem->im->array.F[SYNCTELEM_TIMEOUTS] += 1;
+    }
+    if (complete || force) {
+        staging_vec->md->write = 1;
+        memcpy(staging_vec->im->array.F, staging,
+               sizeof(float)*staging_size);
+        for (int i=0; i<MAX_NWFS; i++) {
+            waiter_ready[i] = 0;
+        }
+    }
+    pthread_mutex_unlock(&ready_lock);
+    return complete || force;
+}
+
+static int any_ready()
+{
+    int any = 0;
+    pthread_mutex_lock(&ready_lock);
+    for (int i=0; i<MAX_NWFS; i++) {
+        any |= (waiter_ready[i] > 0);
+    }
+    pthread_mutex_unlock(&ready_lock);
+    return any;
+}
+
+// Returns 1 if a frame was assembled into the slope vector (to be posted), or
+// 0 if no slopemap arrived within WAITER_POLL_US, so that the run loop can
+// check whether it's been stopped.
+static int syncslopevec_blocking(
+    IMGID *synctelem,  // timeout counters
+    uint32_t wfs_flags,  // index of wfs
+    uint32_t synctimeout
+)
+{
+    DEBUG_TRACE_FSTART();
+
+    // sleep until the first WFS of this frame arrives. Posts left over from
+    // the previous frame wake us without any WFS being ready, so re-check.
+    struct timespec deadline;
+    deadline_in(&deadline, WAITER_POLL_US);
+    do {
+        if (sem_timedwait(&arrivals, &deadline) == -1) {
+            if (errno == ETIMEDOUT) {
+                DEBUG_TRACE_FEXIT();
+                return 0;
+            }
+            continue;  // interrupted
+        }
+    } while (!any_ready());
+
+    // then sleep until all have arrived, or until the deadline
+    deadline_in(&deadline, (long) synctimeout);
+    while (!take_ready(wfs_flags, synctelem, 0)) {
+        if (sem_timedwait(&arrivals, &deadline) == -1 && errno == ETIMEDOUT) {
+            take_ready(wfs_flags, synctelem, 1);
+            break;
+        }
+    }
+
+    DEBUG_TRACE_FEXIT();
+    return 1;
+}
+
+
+
 static errno_t compute_function()
 {
     DEBUG_TRACE_FSTART();
@@ -192,6 +424,16 @@ static errno_t compute_function()
         slope_vec = stream_connect_create_2Df32(name, (*nsubx)*(*nsuby)*2*nwfs, 1); // global slope vector
     }
 
+    IMGID synctelem;
+    {
+        char name[STRINGMAXLEN_STREAMNAME];
+        WRITE_IMAGENAME(name, "synctelem");
+        synctelem = stream_connect_create_2Df32(name, SYNCTELEM_SIZE, 1);
+        for (int i=0; i<SYNCTELEM_SIZE; i++) {
+            synctelem.im->array.F[i] = 0.0;
+        }
+    }
+
     list_image_ID();
 
     printf(" COMPUTE Flags = %ld\n", CLIcmddata.cmdsettings->flags);
@@ -213,13 +455,37 @@ static errno_t compute_function()
     // With :
     // INSERT_STD_PROCINFO_COMPUTEFUNC_START
 
+    uint32_t blocking = *waitmode;
+    if (blocking) {
+        start_waiters(slope_maps, &slope_vec, *wfs_flags, *nsubx, *nsuby);
+    }
+    // report the waitmode in use, since it's only read here
+    synctelem.md->write = 1;
+    synctelem.im->array.F[SYNCTELEM_WAITMODE] = blocking;
+    processinfo_update_output_stream(processinfo, synctelem.ID);
+
     INSERT_STD_PROCINFO_COMPUTEFUNC_LOOPSTART
     {
-        syncslopevec(slope_maps, &slope_vec, *wfs_flags, *nsubx, *nsuby, *synctimeout);
-        processinfo_update_output_stream(processinfo, slope_vec.ID);
+        int assembled = 1;
+        if (blocking) {
+            assembled = syncslopevec_blocking(&synctelem, *wfs_flags, *synctimeout);
+        } else {
+            syncslopevec(slope_maps, &slope_vec, &synctelem, *wfs_flags, *nsubx, *nsuby, *synctimeout);
+        }
+        if (assembled) {
+            processinfo_update_output_stream(processinfo, slope_vec.ID);
+            if (synctelem.md->write == 1) {
+                // only post the telemetry when a timeout has been counted
+                processinfo_update_output_stream(processinfo, synctelem.ID);
+            }
+        }
     }
     INSERT_STD_PROCINFO_COMPUTEFUNC_END
 
+    if (blocking) {
+        stop_waiters();
+    }
+
     DEBUG_TRACE_FEXIT();
     return RETURN_SUCCESS;
 }
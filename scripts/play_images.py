@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 
-from pyMilk.interfacing.isio_shmlib import SHM
+from centroidertools.backend import SHM
 from astropy.io import fits
 import numpy as np
 import glob
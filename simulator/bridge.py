@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+"""Copy streams to other streams, reshaping/casting/slicing on the way, as
+configured in a yaml file (see bridge.yaml). One waiter thread per mapping
+blocks on its source and copies each update into a preallocated buffer for
+the destination, and the time from each source update being picked up to
+the destination being written is recorded per mapping, and reported on exit
+(or on SIGUSR1).
+"""
+
+import argparse
+import os
+import signal
+import threading
+import time
+import numpy as np
+import yaml
+from centroidertools import backend
+from centroidertools.backend import SHM
+from centroidertools.latency import StepTimer
+
+
+class Mapping(threading.Thread):
+    """Bridge one source stream to one destination stream"""
+
+    def __init__(self, src, dst, *, reshape=None, dtype=None, slice=None,
+                 create=True, alias=False):
+        super().__init__(daemon=True)
+        self.name = f"{src} -> {dst}"
+        self.src = SHM(src)
+        src_dtype = self.src.get_data().dtype
+        self._slice = np.s_[:] if slice is None else np.s_[slice[0]:slice[1]]
+        nelem = len(range(int(np.prod(self.src.shape)))[self._slice])
+        shape = (nelem,) if reshape is None else tuple(reshape)
+        dst_dtype = src_dtype if dtype is None else np.dtype(dtype)
+        # resolves any -1 in the shape, and checks the number of elements
+        self._buf = np.empty(nelem, dtype=dst_dtype).reshape(shape)
+        self.aliased = False
+        if alias and self._buf.shape == self.src.shape and \
+                dst_dtype == src_dtype and slice is None:
+            self._alias(src, dst)
+            self.aliased = True
+            return
+        try:
+            self.dst = SHM(dst)
+        except FileNotFoundError:
+            if not create:
+                raise
+            self.dst = SHM(dst, self._buf)
+        if self.dst.shape != self._buf.shape:
+            if not create:
+                raise ValueError(
+                    f"{dst} has shape {self.dst.shape}, mapping from {src} "
+                    f"gives {self._buf.shape}"
+                )
+            self.dst = SHM(dst, self._buf)
+        self.timer = StepTimer(["wait", "hop"])
+        self._running = True
+
+    @staticmethod
+    def _alias(src, dst):
+        src_path = os.path.join(backend.SHM_DIR, f"{src}.im.shm")
+        dst_path = os.path.join(backend.SHM_DIR, f"{dst}.im.shm")
+        if os.path.islink(dst_path):
+            os.remove(dst_path)
+        elif os.path.exists(dst_path):
+            raise FileExistsError(
+                f"{dst_path} exists and isn't an alias, remove it first"
+            )
+        os.symlink(src_path, dst_path)
+
+    def run(self):
+        t_done = time.perf_counter()
+        while self._running:
+            data = self.src.get_data(check=True, copy=False)
+            t_arrived = time.perf_counter()
+            np.copyto(
+                self._buf, data.reshape(-1)[self._slice].reshape(
+                    self._buf.shape
+                ), casting="unsafe"
+            )
+            self.dst.set_data(self._buf)
+            t_done_prev, t_done = t_done, time.perf_counter()
+            self.timer.record(t_arrived-t_done_prev, t_done-t_arrived)
+
+    def stop(self):
+        self._running = False
+
+
+def load_mappings(filename):
+    with open(filename, "r") as f:
+        config = yaml.safe_load(f)
+    return [Mapping(**mapping) for mapping in config["mappings"]]
+
+
+def print_reports(mappings):
+    for mapping in mappings:
+        print(mapping.name)
+        if mapping.aliased:
+            print("    aliased, no copy")
+            continue
+        mapping.timer.print_report()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        "bridge streams between the simulator and the RTC",
+    )
+    parser.add_argument(
+        "--config", "-c", type=str,
+        default=os.path.join(os.path.dirname(__file__), "bridge.yaml"),
+        help="yaml file of stream mappings"
+    )
+    args = parser.parse_args()
+
+    mappings = load_mappings(args.config)
+    signal.signal(signal.SIGUSR1, lambda *_: print_reports(mappings))
+    for mapping in mappings:
+        print(f"bridging {mapping.name}")
+        if not mapping.aliased:
+            mapping.start()
+    try:
+        while True:
+            time.sleep(1.0)
+    except KeyboardInterrupt:
+        print("stopping")
+    for mapping in mappings:
+        if not mapping.aliased:
+            mapping.stop()
+    print_reports(mappings)
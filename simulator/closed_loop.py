@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+"""Run the simulator and the example RTC in lockstep in a single process,
+for fast closed-loop studies (e.g., scanning the loop gain and delay).
+
+Each frame the AO system is stepped (producing measurements from the latest
+command), then the RTC is stepped on those measurements, without blocking or
+any other process in between. So the loop runs as fast as the two steps
+allow, and every frame sees exactly the previous frame's command, as in the
+SHM-coupled setup when neither side falls behind.
+
+By default the tensors are passed directly: the simulator's handles on the
+`pyrao_com` and `pyrao_meas` streams are replaced by in-memory
+`DirectLink`s, and the RTC is stepped on the measurement tensor with
+`UltimateRTC.step_direct`. With `--shm`, both sides go through the SHM
+streams instead, and `--check` runs both paths from the same seed and
+compares their DM commands.
+
+The direct path only avoids host copies on the CPU: pyrao reads its
+commands as numpy arrays (through `get_data`), so on CUDA each frame's
+command still goes through host memory (but not through SHM).
+"""
+
+import argparse
+import itertools
+import json
+import os
+import time
+import numpy as np
+import pyrao
+import torch
+import tqdm
+from example_rtc import UltimateRTC
+
+
+COM_STREAM = "pyrao_com"
+MEAS_STREAM = "pyrao_meas"
+
+
+class DirectLink():
+    """In-memory stand-in for the SHM handle the simulator reads its
+    commands from (or writes its measurements to), holding the latest
+    tensor (on whichever device it was set from) rather than copying it
+    through shared memory. `get_data` returns it as a numpy array, as SHM
+    does, so that copies it to the host if it's on a GPU."""
+
+    def __init__(self, shape):
+        self.shape = tuple(shape)
+        self.tensor = torch.zeros(self.shape)
+        self._counter = 0
+
+    def set_data(self, data):
+        self.tensor = torch.as_tensor(data).reshape(self.shape)
+        self._counter += 1
+
+    def get_data(self, check=False, *args, copy=True, **kwargs):
+        data = self.tensor.detach().cpu().numpy()
+        return data.copy() if copy else data
+
+    def get_counter(self):
+        return self._counter
+
+
+def _stream_name(handle):
+    """name of the stream an SHM handle is attached to (pyMilk keeps it as
+    `FNAME`, the local backend as `name`), or None if it isn't one"""
+    if not (hasattr(handle, "get_data") and hasattr(handle, "set_data")):
+        return None
+    for attr in ["FNAME", "name"]:
+        name = getattr(handle, attr, None)
+        if isinstance(name, str):
+            return os.path.basename(name).split(".")[0]
+    return None
+
+
+def link(aosys, rtc):
+    """replace the simulator's handles on the COM_STREAM and MEAS_STREAM
+    streams with `DirectLink`s, returns (com_link, meas_link). Exactly one
+    attribute of `aosys` must be attached to each stream, and any other
+    handles (e.g., for the displays) are left alone."""
+    links = {}
+    for stream, size in [(COM_STREAM, rtc.rcm.shape[0]),
+                         (MEAS_STREAM, rtc.dmc.shape[0])]:
+        attrs = [
+            attr for attr, value in vars(aosys).items()
+            if _stream_name(value) == stream
+        ]
+        if len(attrs) != 1:
+            raise RuntimeError(
+                f"expected one handle on {stream} in the simulator, found "
+                f"{len(attrs)} {attrs}, use --shm"
+            )
+        handle = getattr(aosys, attrs[0])
+        if int(np.prod(handle.shape)) != size:
+            raise RuntimeError(
+                f"{stream} has shape {tuple(handle.shape)}, but the RTC "
+                f"expects {size} values"
+            )
+        links[stream] = DirectLink(handle.shape)
+        setattr(aosys, attrs[0], links[stream])
+    return links[COM_STREAM], links[MEAS_STREAM]
+
+
+def run(aosys, rtc, *, nframes, nburn=100, quiet=False, links=None,
+        coms=None):
+    """close the loop for `nburn` + `nframes` frames, returning the mean
+    performance over the last `nframes` and the loop rate. With `links`
+    (from `link`) the tensors are passed directly, otherwise through SHM.
+    If `coms` is given, each frame's command is appended to it."""
+    rtc.reset()
+    if links is not None:
+        com_link, meas_link = links
+        com_link.set_data(torch.zeros(com_link.shape))
+    wfe = np.zeros(nframes)
+    strehl = np.zeros(nframes)
+    for i in tqdm.trange(nburn + nframes, disable=quiet, leave=False):
+        if i == nburn:
+            t0 = time.perf_counter()
+        aosys.step(blocking=False)
+        if links is None:
+            com = rtc.step(blocking=False)
+        else:
+            com = rtc.step_direct(meas_link.tensor.to(rtc.device))
+            com_link.set_data(com)
+        if coms is not None:
+            coms.append(com.cpu().clone())
+        if i >= nburn:
+            wfe[i-nburn] = aosys.perf["wfe"].item()
+            strehl[i-nburn] = float(aosys.perf["strehl"])
+    dt = time.perf_counter() - t0
+    return {
+        "wfe": float(wfe.mean()),
+        "strehl": float(strehl.mean()),
+        "rate": nframes/dt,
+    }
+
+
+def make_aosys(device, seed):
+    torch.manual_seed(seed)
+    np.random.seed(seed)
+    return pyrao.aosystem.SubaruLTAO(
+        verbose=False,
+        device=device,
+        noise=True
+    )
+
+
+def check(rtc, *, device, nframes, seed=0):
+    """run the direct and SHM paths from the same seed, returns the worst
+    relative difference between their DM commands"""
+    coms = {}
+    for path in ["shm", "direct"]:
+        aosys = make_aosys(device, seed)
+        links = link(aosys, rtc) if path == "direct" else None
+        torch.manual_seed(seed)
+        np.random.seed(seed)
+        coms[path] = []
+        run(aosys, rtc, nframes=nframes, nburn=0, links=links,
+            coms=coms[path])
+    worst = 0.0
+    for com_shm, com_direct in zip(coms["shm"], coms["direct"]):
+        norm = max(float(com_shm.norm()), 1e-30)
+        worst = max(worst, float((com_direct - com_shm).norm())/norm)
+    return worst
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        "in-process closed loop of the simulator and example RTC",
+    )
+    parser.add_argument(
+        "--device", "-d", type=str, default="cpu",
+        help="which device to run on, e.g., cpu, cuda:0, ..."
+    )
+    parser.add_argument(
+        "--nframes", "-n", type=int, default=10000,
+        help="number of frames to average performance over, for each run"
+    )
+    parser.add_argument(
+        "--nburn", type=int, default=100,
+        help="number of frames to let the loop settle before each run"
+    )
+    parser.add_argument(
+        "--gains", type=float, nargs="+", default=[0.5],
+        help="loop gains to scan"
+    )
+    parser.add_argument(
+        "--delays", type=float, nargs="+", default=[1.6],
+        help="loop delays (frames) to scan"
+    )
+    parser.add_argument(
+        "--shm", action="store_true",
+        help="pass the commands and measurements through SHM"
+    )
+    parser.add_argument(
+        "--check", action="store_true",
+        help=("check that the direct and SHM paths give the same DM "
+              "commands (over --nframes, from --seed), then exit")
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0,
+        help="random seed for --check"
+    )
+    parser.add_argument(
+        "--output", "-o", default=None,
+        help="save results to this file (json)"
+    )
+    parser.add_argument(
+        "--quiet", "-q", action="store_true",
+        help="flag for running in quiet mode"
+    )
+    args = parser.parse_args()
+
+    rtc = UltimateRTC(device=args.device)
+    if args.check:
+        worst = check(
+            rtc, device=args.device, nframes=args.nframes, seed=args.seed
+        )
+        print(f"max relative difference in DM commands: {worst:.3e}")
+        exit(0 if worst < 1e-5 else 1)
+
+    aosys = make_aosys(args.device, args.seed)
+    links = None if args.shm else link(aosys, rtc)
+    if links is not None and args.device != "cpu":
+        print("note: pyrao reads its commands through host memory, so the "
+              f"direct path still copies them from {args.device} each frame")
+
+    results = []
+    print(f"{'gain':>6s} | {'delay':>6s} | {'wfe':>8s} | {'sr (%)':>8s} | "
+          f"{'rate (Hz)':>9s}")
+    for gain, delay in itertools.product(args.gains, args.delays):
+        rtc.gain = gain
+        rtc.set_delay(delay)
+        result = run(
+            aosys, rtc, nframes=args.nframes, nburn=args.nburn,
+            quiet=args.quiet, links=links
+        )
+        print(f"{gain:6.3f} | {delay:6.2f} | {result['wfe']:8.3f} | "
+              f"{100*result['strehl']:8.1f} | {result['rate']:9.1f}")
+        results.append(dict(result, gain=gain, delay=delay))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
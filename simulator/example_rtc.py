@@ -1,34 +1,12 @@
-import pyrao
 import argparse
 import itertools
+import os
+import signal
+import time
 from pydantic import BaseModel, ConfigDict
 import torch
-from pyMilk.interfacing.shm import SHM
-
-parser = argparse.ArgumentParser(
-    "AO system simulator for RTS development",
-)
-parser.add_argument(
-    "--device", "-d", type=str, default="cpu",
-    help="which device to run simulator on, e.g., cpu, cuda:0, ..."
-)
-parser.add_argument(
-    "--nonblocking", "-n", action="store_true",
-    help="flag for running in non-blocking mode"
-)
-parser.add_argument(
-    "--quiet", "-q", action="store_true",
-    help="flag for running in quiet mode"
-)
-args = parser.parse_args()
-
-blocking_mode = True
-if args.nonblocking:
-    blocking_mode = False
-
-verbose = True
-if args.quiet:
-    verbose = False
+from centroidertools.backend import SHM
+from centroidertools.latency import StepTimer
 
 
 class UltimateRTC(BaseModel):
@@ -36,16 +14,69 @@ class UltimateRTC(BaseModel):
     com_buffer: torch.Tensor = None
     rcm: torch.Tensor = None
     dmc: torch.Tensor = None
+    rcm_dmc: torch.Tensor = None  # rcm @ dmc, for the fused POL correction
+    fused: bool = True  # use rcm_dmc rather than dmc then rcm
     com_shm: SHM = None
     meas_shm: SHM = None
     gain: float = 0.5
     device: str = "cpu"
     delay: float = 1.6  # frames of delay
     _tmp_com: torch.Tensor = None  # temporary buffer for pre-calculating com
+    # preallocated buffers, so that a step doesn't allocate
+    _meas: torch.Tensor = None  # latest measurements (on device)
+    _com_delayed: torch.Tensor = None
+    _s_pol: torch.Tensor = None
+    _phi: torch.Tensor = None
+    _com_host: torch.Tensor = None  # staging for com_shm (on cpu)
+    # com_buffer is a ring, with the command from j frames ago at
+    # com_buffer[(_head + j) % len(com_buffer)]
+    _head: int = 0
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         import numpy as np
+        if self.rcm is None or self.dmc is None:
+            # (e.g., synthetic matrices can be given for benchmarking)
+            self.rcm, self.dmc = self.solve_matrices()
+        print("initialising RTC")
+        # the reconstruction is linear, so the POL correction can be applied
+        # after the reconstructor: rcm @ (s_cl - dmc @ c) =
+        # rcm @ s_cl - (rcm @ dmc) @ c, which is an nact x nact matvec
+        # instead of an nmeas x nact one
+        print("  combining rcm_dmc = rcm @ dmc")
+        self.rcm_dmc = self.rcm @ self.dmc
+        self.set_delay(self.delay)
+        self._tmp_com = torch.zeros(
+            self.rcm.shape[0],
+            device=self.device,
+        )
+        self._com_delayed = torch.zeros_like(self._tmp_com)
+        self._phi = torch.zeros_like(self._tmp_com)
+        self._meas = torch.zeros(self.dmc.shape[0], device=self.device)
+        self._s_pol = torch.zeros_like(self._meas)
+        self._com_host = torch.zeros(self.rcm.shape[0])
+        if self._com_host.device != self._tmp_com.device:
+            self._com_host = self._com_host.pin_memory()
+        name = "pyrao_com"
+        try:
+            self.com_shm = SHM(name)
+            if self.com_shm.shape[0] != self.com_buffer.shape[1]:
+                self.com_shm = SHM(name, self.com_buffer[0, :].cpu().numpy())
+        except FileNotFoundError:
+            self.com_shm = SHM(name, self.com_buffer[0, :].cpu().numpy())
+        name = "pyrao_meas"
+        try:
+            self.meas_shm = SHM(name)
+            if self.meas_shm.shape[0] != self.dmc.shape[0]:
+                self.meas_shm = SHM(name, ((self.dmc.shape[0],), np.float32))
+        except FileNotFoundError:
+            self.meas_shm = SHM(name, ((self.dmc.shape[0],), np.float32))
+        self.reset()
+
+    def solve_matrices(self):
+        """solve the reconstructor (and the interaction matrix) for the
+        ULTIMATE-START system from pyrao, returns (rcm, dmc)"""
+        import pyrao
         print("building matrices")
         m = pyrao.ultimatestart_recon_matrices()
         print("solving reconstructor")
@@ -65,55 +96,85 @@ class UltimateRTC(BaseModel):
         dct = torch.cholesky_solve(dtc.T, dcc_factor)
         print("  combining rcm = dct @ dtm")
         rcm = dct @ dtm
-        print("initialising RTC")
-        self.rcm = rcm
-        self.dmc = dmc
-        if self.delay < 1.0:
+        return rcm, dmc
+
+    def set_delay(self, delay):
+        """set the loop delay (in frames), resizing the command history.
+        Call `reset` afterwards."""
+        if delay < 1.0:
             raise ValueError(
-                f"{self.delay=}, must be greater than or equal to 1.0"
+                f"{delay=}, must be greater than or equal to 1.0"
             )
+        self.delay = delay
         self.com_buffer = torch.zeros(
-            [int(self.delay // 1.0) + 1, dct.shape[0]],
+            [int(self.delay // 1.0) + 1, self.rcm.shape[0]],
             device=self.device,
         )
-        self._tmp_com = torch.zeros(
-            self.rcm.shape[0],
-            device=self.device,
-        )
-        name = "pyrao_com"
-        try:
-            self.com_shm = SHM(name)
-            if self.com_shm.shape[0] != self.com_buffer.shape[1]:
-                self.com_shm = SHM(name, self.com_buffer[0, :].cpu().numpy())
-        except FileNotFoundError:
-            self.com_shm = SHM(name, self.com_buffer[0, :].cpu().numpy())
-        name = "pyrao_meas"
-        try:
-            self.meas_shm = SHM(name)
-            if self.meas_shm.shape[0] != self.dmc.shape[0]:
-                self.meas_shm = SHM(name, ((self.dmc.shape[0],), np.float32))
-        except FileNotFoundError:
-            self.meas_shm = SHM(name, ((self.dmc.shape[0],), np.float32))
-        self.reset()
+        self._head = 0
 
     def reset(self):
         self.com_buffer *= 0.0
+        self._head = 0
         self.com_shm.set_data(self.com_buffer[0, :].cpu().numpy())
 
-    def step(self, blocking=True):
-        s_cl = torch.tensor(
-            self.meas_shm.get_data(check=blocking),
-            device=self.device
-        )
+    def _past_com(self, j):
+        """command from j frames ago"""
+        return self.com_buffer[(self._head + j) % self.com_buffer.shape[0]]
+
+    def compute_com(self, s_cl, fused=None, out=None):
+        """new command for the closed-loop measurements `s_cl`, without
+        updating any state. `fused` overrides `self.fused`. The result is
+        written to `out` (by default, `self._tmp_com`)."""
+        if fused is None:
+            fused = self.fused
+        if out is None:
+            out = self._tmp_com
+        nbuffer = self.com_buffer.shape[0]
         b = self.delay % 1.0
         a = 1.0 - b
-        s_pol = s_cl - self.dmc @ (
-            self.com_buffer[-2, :]*a + self.com_buffer[-1, :]*b
-        )
-        com = (1-self.gain)*self.com_buffer[0] - self.gain*(self.rcm @ s_pol)
-        self.com_shm.set_data(com.cpu().numpy())
-        self.com_buffer[1:, :] = self.com_buffer[:-1, :]
-        self.com_buffer[0, :] = com
+        com_delayed = self._com_delayed
+        torch.mul(self._past_com(nbuffer-2), a, out=com_delayed)
+        com_delayed.add_(self._past_com(nbuffer-1), alpha=b)
+        phi = self._phi
+        if fused:
+            torch.mv(self.rcm, s_cl, out=phi)
+            phi.addmv_(self.rcm_dmc, com_delayed, alpha=-1.0)
+        else:
+            s_pol = self._s_pol
+            torch.mv(self.dmc, com_delayed, out=s_pol)
+            torch.sub(s_cl, s_pol, out=s_pol)
+            torch.mv(self.rcm, s_pol, out=phi)
+        torch.mul(self._past_com(0), 1-self.gain, out=out)
+        out.add_(phi, alpha=-self.gain)
+        return out
+
+    def read_meas(self, blocking=True):
+        # wrap the shm buffer rather than copying it into a new tensor
+        meas = self.meas_shm.get_data(check=blocking, copy=False)
+        self._meas.copy_(torch.from_numpy(meas.reshape(-1)))
+
+    def update(self, publish=True):
+        """compute (and, if `publish`, publish) the command for the latest
+        measurements, returns it (a view into the command history)"""
+        com = self.compute_com(self._meas)
+        # the oldest command is no longer needed, so the new one replaces it
+        self._head = (self._head - 1) % self.com_buffer.shape[0]
+        self.com_buffer[self._head].copy_(com)
+        if publish:
+            self._com_host.copy_(com)
+            self.com_shm.set_data(self._com_host.numpy())
+        return self.com_buffer[self._head]
+
+    def step(self, blocking=True):
+        self.read_meas(blocking=blocking)
+        return self.update()
+
+    def step_direct(self, meas):
+        """step on the measurements tensor `meas` (e.g., from a simulator in
+        the same process), returning the new command without going through
+        SHM"""
+        self._meas.copy_(meas.reshape(-1))
+        return self.update(publish=False)
 
     def purge(self, *, npurge=10, blocking=True):
         print("purging")
@@ -121,16 +182,141 @@ class UltimateRTC(BaseModel):
         for i in range(npurge):
             self.meas_shm.get_data(check=blocking)
 
-    def start(self, blocking=True):
+    def check_fused(self, ntrials=10):
+        """compare the fused and unfused POL paths on random measurements
+        and command histories. Returns the worst relative difference."""
+        com_buffer = self.com_buffer.clone()
+        com_fused = torch.zeros_like(self._tmp_com)
+        worst = 0.0
+        try:
+            for _ in range(ntrials):
+                self.com_buffer[:] = torch.randn_like(self.com_buffer)
+                s_cl = torch.randn(self.dmc.shape[0], device=self.device)
+                self.compute_com(s_cl, fused=True, out=com_fused)
+                com = self.compute_com(s_cl, fused=False)
+                diff = (com_fused - com).norm() / com.norm()
+                worst = max(worst, float(diff))
+        finally:
+            self.com_buffer[:] = com_buffer
+        return worst
+
+    def time_steps(self, nsteps=1000):
+        """time the command computation (excluding SHM I/O) for the fused
+        and unfused POL paths, and a full non-blocking step (including SHM
+        I/O, the state is reset afterwards). Returns (mean, p99, std) in us
+        for each."""
+        s_cl = torch.randn(self.dmc.shape[0], device=self.device)
+        funcs = {
+            "fused": lambda: self.compute_com(s_cl, fused=True),
+            "unfused": lambda: self.compute_com(s_cl, fused=False),
+            "step": lambda: self.step(blocking=False),
+        }
+        result = {}
+        for name, func in funcs.items():
+            dt = torch.zeros(nsteps, dtype=torch.float64)
+            for i in range(nsteps):
+                t0 = time.perf_counter()
+                func()
+                if self.device.startswith("cuda"):
+                    torch.cuda.synchronize()
+                dt[i] = time.perf_counter() - t0
+            dt *= 1e6
+            result[name] = (
+                float(dt.mean()), float(torch.quantile(dt, 0.99)),
+                float(dt.std()),
+            )
+        self.reset()
+        return result
+
+    def start(self, blocking=True, timer=None):
+        """run the loop until interrupted, recording the time spent waiting
+        for measurements and computing commands in `timer`. The timing
+        report is printed on exit, or on SIGUSR1 (e.g., `pkill -USR1 -f
+        example_rtc`) without stopping."""
+        if timer is None:
+            timer = StepTimer(["wait", "compute"])
+        signal.signal(signal.SIGUSR1, lambda *_: timer.print_report())
         print("running")
         try:
             for i in itertools.count():
-                rtc.step(blocking=True)
+                t0 = time.perf_counter()
+                self.read_meas(blocking=blocking)
+                t1 = time.perf_counter()
+                self.update()
+                if self.device.startswith("cuda"):
+                    torch.cuda.synchronize()
+                t2 = time.perf_counter()
+                timer.record(t1-t0, t2-t1)
         except KeyboardInterrupt:
             print("stopping")
             pass
+        finally:
+            signal.signal(signal.SIGUSR1, signal.SIG_DFL)
+            timer.print_report()
+
+
+def parse_cpus(cpus):
+    """parse a cpu list like "0,2-3" into a set of ints"""
+    result = set()
+    for part in cpus.split(","):
+        first, _, last = part.partition("-")
+        result.update(range(int(first), int(last or first)+1))
+    return result
 
 
 if __name__ == "__main__":
-    rtc = UltimateRTC(device=args.device)
-    rtc.start()
+    parser = argparse.ArgumentParser(
+        "AO system simulator for RTS development",
+    )
+    parser.add_argument(
+        "--device", "-d", type=str, default="cpu",
+        help="which device to run simulator on, e.g., cpu, cuda:0, ..."
+    )
+    parser.add_argument(
+        "--nonblocking", "-n", action="store_true",
+        help="flag for running in non-blocking mode"
+    )
+    parser.add_argument(
+        "--quiet", "-q", action="store_true",
+        help="flag for running in quiet mode"
+    )
+    parser.add_argument(
+        "--unfused", action="store_true",
+        help="apply the POL correction with dmc then rcm (not rcm @ dmc)"
+    )
+    parser.add_argument(
+        "--check", action="store_true",
+        help=("check the fused and unfused POL paths agree, and time them, "
+              "then exit")
+    )
+    parser.add_argument(
+        "--threads", type=int, default=None,
+        help="number of torch intra-op threads (default: torch's choice)"
+    )
+    parser.add_argument(
+        "--cpus", type=str, default=None,
+        help="CPUs to pin the RTC to, e.g., 2 or 2,3 or 2-5"
+    )
+    args = parser.parse_args()
+
+    if args.cpus is not None:
+        os.sched_setaffinity(0, parse_cpus(args.cpus))
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    blocking_mode = True
+    if args.nonblocking:
+        blocking_mode = False
+
+    verbose = True
+    if args.quiet:
+        verbose = False
+
+    rtc = UltimateRTC(device=args.device, fused=not args.unfused)
+    if args.check:
+        print(f"max relative difference: {rtc.check_fused():.3e}")
+        for path, (mean, p99, std) in rtc.time_steps().items():
+            print(f"{path:8s}: mean {mean:8.1f} us, p99 {p99:8.1f} us, "
+                  f"std {std:8.1f} us")
+    else:
+        rtc.start(blocking=blocking_mode)
@@ -1,58 +1,154 @@
 #!/usr/bin/env python
 
+import argparse
+import resource
+import time
 import pyrao
 import torch
-from pyMilk.interfacing.shm import SHM
+from centroidertools.backend import SHM
 import numpy as np
 
-device: str = "cpu"
-tichanov = True
-
-print("building matrices")
-m = pyrao.ultimatestart_recon_matrices()
-print("solving reconstructor")
-cmm = torch.tensor(m.c_meas_meas, device=device)
-cmm_reg = (1.0 / torch.tensor(m.p_meas, device=device)).clamp(50.0, 1e10)
-cmm_reg = torch.diag(cmm_reg)
-ctm = torch.tensor(m.c_ts_meas, device=device)
-dtc = torch.tensor(m.d_ts_com, device=device)
-dcc_reg = 0.01 * torch.eye(dtc.shape[1], device=device)
-print("  factorising cmm")
-cmm_factor = torch.linalg.cholesky(cmm + cmm_reg)
-print("  solving ctm @ cmm^1")
-dtm = torch.cholesky_solve(ctm.T, cmm_factor).T
-if tichanov:
-    # do tichanov regularsied pinv
+
+def build_dtm(device="cpu"):
+    print("building matrices")
+    m = pyrao.ultimatestart_recon_matrices()
+    print("solving reconstructor")
+    cmm = torch.tensor(m.c_meas_meas, device=device)
+    cmm_reg = (1.0 / torch.tensor(m.p_meas, device=device)).clamp(50.0, 1e10)
+    cmm_reg = torch.diag(cmm_reg)
+    ctm = torch.tensor(m.c_ts_meas, device=device)
+    dtc = torch.tensor(m.d_ts_com, device=device)
+    print("  factorising cmm")
+    cmm_factor = torch.linalg.cholesky(cmm + cmm_reg)
+    print("  solving ctm @ cmm^1")
+    dtm = torch.cholesky_solve(ctm.T, cmm_factor).T
+    return dtm, dtc
+
+
+# Each of the following builds rcm = dct @ dtm in factored form, returning
+# (dm_modes, wfs_modes) such that rcm = dm_modes @ wfs_modes, with
+# dm_modes : (nact, nmode) and wfs_modes : (nmode, nmeas).
+
+def tikhonov(dtm, dtc, nmodes=None):
+    """tikhonov regularised pinv (zonal, nmodes is ignored)"""
+    dcc_reg = 0.01 * torch.eye(dtc.shape[1], device=dtc.device)
     print("  factorising dcc")
     dcc_factor = torch.linalg.cholesky(dtc.T @ dtc + dcc_reg)
     print("  solving dcc^1 @ dtc.T")
     dct = torch.cholesky_solve(dtc.T, dcc_factor)
-else:
-    # do modal inversion:
+    print("  combining rcm = dct @ dtm")
+    rcm = dct @ dtm
+    return torch.eye(rcm.shape[0], device=dtc.device), rcm
+
+
+def eigh(dtm, dtc, nmodes=188):
+    """modal inversion, keeping the top nmodes of a full eigendecomposition
+    of dcc"""
     print("  doing eigendecomposition of dcc")
     L, Q = torch.linalg.eigh(dtc.T @ dtc)
-    L = L[-188:]
+    L = L[-nmodes:]
     if any(L < 1e-10):
         raise ValueError("modal inversion failed")
-    Q = Q[:, -188:]
-    print("  inverting")
-    dcc_inv = Q @ torch.diag(1.0 / L) @ Q.T
-    print("  evaluating dct")
-    dct = dcc_inv @ dtc.T
+    Q = Q[:, -nmodes:]
+    # dct @ dtm = Q @ diag(1/L) @ Q.T @ dtc.T @ dtm, applied right to left
+    # rather than forming the inverse
+    print("  evaluating modes")
+    return Q, (Q.T @ (dtc.T @ dtm)) / L[:, None]
+
+
+def lowrank(dtm, dtc, nmodes=188, oversample=10, niter=4):
+    """modal inversion, computing only the leading nmodes singular vectors
+    of dtc with a randomised range finder"""
+    print("  doing randomised svd of dtc")
+    U, S, V = torch.svd_lowrank(dtc, q=nmodes+oversample, niter=niter)
+    U, S, V = U[:, :nmodes], S[:nmodes], V[:, :nmodes]
+    if any(S**2 < 1e-10):
+        raise ValueError("modal inversion failed")
+    # dct = V @ diag(1/S) @ U.T
+    print("  evaluating modes")
+    return V, (U.T @ dtm) / S[:, None]
+
+
+METHODS = {
+    "tikhonov": tikhonov,
+    "eigh": eigh,
+    "lowrank": lowrank,
+}
+
+
+def _rss_mb(field="VmRSS"):
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field):
+                return int(line.split()[1])/1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+
+
+def _reset_peak_rss():
+    # resets VmHWM to the current RSS (linux only)
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def timed(method, dtm, dtc, nmodes):
+    """run a builder, returning its factors, the time taken (s) and the
+    peak memory used on top of what was already resident (MB, cpu only)"""
+    _reset_peak_rss()
+    rss0 = _rss_mb()
+    t0 = time.perf_counter()
+    dm_modes, wfs_modes = METHODS[method](dtm, dtc, nmodes=nmodes)
+    if dtc.device.type == "cuda":
+        torch.cuda.synchronize()
+    dt = time.perf_counter() - t0
+    return dm_modes, wfs_modes, dt, _rss_mb("VmHWM") - rss0
+
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        "build the modal control matrices for cacao from the pyrao model",
+    )
+    parser.add_argument(
+        "--device", "-d", type=str, default="cpu",
+        help="which device to build on, e.g., cpu, cuda:0, ..."
+    )
+    parser.add_argument(
+        "--method", choices=list(METHODS), default="tikhonov",
+        help="how to invert dtc"
+    )
+    parser.add_argument(
+        "--nmodes", type=int, default=188,
+        help="number of modes to keep (eigh and lowrank)"
+    )
+    parser.add_argument(
+        "--compare", action="store_true",
+        help="also time eigh and lowrank, and compare them with --method"
+    )
+    args = parser.parse_args()
 
-print("  combining rcm = dct @ dtm")
-rcm = dct @ dtm
-print("saving matrix")
-rcm = rcm
+    dtm, dtc = build_dtm(device=args.device)
+    dm_modes, wfs_modes, dt, mem = timed(args.method, dtm, dtc, args.nmodes)
+    print(f"{args.method}: {dt:.2f} s, {mem:.0f} MB")
 
-nmeas = rcm.shape[1]
-nactu = rcm.shape[0]
-nmode = nactu
+    if args.compare:
+        rcm = dm_modes @ wfs_modes
+        print(f"{'method':10s} | {'time (s)':>9s} | {'mem (MB)':>9s} | "
+              f"{'rel diff':>9s}")
+        for method in ["eigh", "lowrank"]:
+            _dm_modes, _wfs_modes, _dt, _mem = timed(
+                method, dtm, dtc, args.nmodes
+            )
+            diff = (_dm_modes @ _wfs_modes - rcm).norm() / rcm.norm()
+            print(f"{method:10s} | {_dt:9.2f} | {_mem:9.0f} | "
+                  f"{float(diff):9.2e}")
+            del _dm_modes, _wfs_modes
 
-modesWFS = rcm.T[:, None, :].cpu().numpy().astype(np.float32)
-SHM("aol1_modesWFS", modesWFS)
+    print("saving matrix")
+    # cacao applies com = DMmodes @ (modesWFS.T @ meas)
+    modesWFS = wfs_modes.T[:, None, :].cpu().numpy().astype(np.float32)
+    SHM("aol1_modesWFS", modesWFS)
 
-DMmodes = np.eye(nmode, dtype=np.float32)[None, :, :]
-# DMmodes *= 0.0
-SHM("aol1_DMmodes", DMmodes)
+    DMmodes = dm_modes[None, :, :].cpu().numpy().astype(np.float32)
+    SHM("aol1_DMmodes", DMmodes)
@@ -3,51 +3,113 @@
 import pyrao
 import argparse
 import itertools
+import threading
+import time
 import tqdm
+from centroidertools.latency import StepTimer
+
+
+class DisplayWorker(threading.Thread):
+    """Publish the displays and performance metrics of `aosys` at `rate` Hz
+    from a background thread, so that the AO system step isn't stalled by
+    them. The displays are published from whatever state `aosys` is in at
+    the time (without locking), so may mix consecutive steps, which is fine
+    for displays."""
+
+    def __init__(self, aosys, rate=10.0, pbar=None):
+        super().__init__(daemon=True)
+        self.aosys = aosys
+        self.period = 1.0/rate
+        self.pbar = pbar
+        self._running = True
+
+    def run(self):
+        t_next = time.perf_counter()
+        while self._running:
+            t_next += self.period
+            time.sleep(max(t_next - time.perf_counter(), 0.0))
+            publish(self.aosys, self.pbar)
+
+    def stop(self):
+        self._running = False
+
+
+def publish(aosys, pbar=None):
+    aosys.update_displays()
+    if pbar is not None:
+        pbar.set_description(
+            f"rmswfe: {aosys.perf['wfe'].item():0.3f}, "
+            f"sr: {100*aosys.perf['strehl']:0.1f}"
+        )
 
-parser = argparse.ArgumentParser(
-    "AO system simulator for RTS development",
-)
-parser.add_argument(
-    "--device", "-d", type=str, default="cpu",
-    help="which device to run simulator on, e.g., cpu, cuda:0, ..."
-)
-parser.add_argument(
-    "--blocking", "-b", action="store_true",
-    help="flag for running in non-blocking mode"
-)
-parser.add_argument(
-    "--quiet", "-q", action="store_true",
-    help="flag for running in quiet mode"
-)
-args = parser.parse_args()
-
-blocking_mode = False
-if args.blocking:
-    blocking_mode = True
-
-verbose = True
-if args.quiet:
-    verbose = False
-
-aosys = pyrao.aosystem.SubaruLTAO(
-    verbose=verbose,
-    device=args.device,
-    noise=True
-)
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        "AO system simulator for RTS development",
+    )
+    parser.add_argument(
+        "--device", "-d", type=str, default="cpu",
+        help="which device to run simulator on, e.g., cpu, cuda:0, ..."
+    )
+    parser.add_argument(
+        "--blocking", "-b", action="store_true",
+        help="flag for running in non-blocking mode"
+    )
+    parser.add_argument(
+        "--quiet", "-q", action="store_true",
+        help="flag for running in quiet mode"
+    )
+    parser.add_argument(
+        "--displays", choices=["worker", "inline", "off"], default="worker",
+        help=("publish displays from a background thread (worker), every "
+              "10 steps in the loop (inline), or not at all (off)")
+    )
+    parser.add_argument(
+        "--display-rate", type=float, default=10.0,
+        help="rate (Hz) the display worker publishes at"
+    )
+    parser.add_argument(
+        "--nsteps", type=int, default=None,
+        help="number of steps to run for (default: until interrupted)"
+    )
+    args = parser.parse_args()
+
+    blocking_mode = False
+    if args.blocking:
+        blocking_mode = True
+
+    verbose = True
+    if args.quiet:
+        verbose = False
+
+    aosys = pyrao.aosystem.SubaruLTAO(
+        verbose=verbose,
+        device=args.device,
+        noise=True
+    )
+
     pbar = tqdm.tqdm(
-        itertools.count(),
+        itertools.count() if args.nsteps is None else range(args.nsteps),
         desc=f"wfe: {0:0.3f}",
         disable=(not verbose)
     )
-    for i in pbar:
-        aosys.step(blocking=blocking_mode)
-        if i % 10 == 0:
-            aosys.update_displays()
-            if verbose:
-                pbar.set_description(
-                    f"rmswfe: {aosys.perf['wfe'].item():0.3f}, "
-                    f"sr: {100*aosys.perf['strehl']:0.1f}"
-                )
+    worker = None
+    if args.displays == "worker":
+        worker = DisplayWorker(
+            aosys, rate=args.display_rate, pbar=(pbar if verbose else None)
+        )
+        worker.start()
+    timer = StepTimer(["step"])
+    try:
+        for i in pbar:
+            t0 = time.perf_counter()
+            aosys.step(blocking=blocking_mode)
+            if args.displays == "inline" and i % 10 == 0:
+                publish(aosys, (pbar if verbose else None))
+            timer.record(time.perf_counter()-t0)
+    except KeyboardInterrupt:
+        pass
+    if worker is not None:
+        worker.stop()
+    print(f"step time with displays {args.displays}:")
+    timer.print_report()